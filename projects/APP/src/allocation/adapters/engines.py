@@ -0,0 +1,91 @@
+from typing import Optional
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+from allocation import config
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+POOL_SETTINGS = ("pool_size", "max_overflow", "pool_pre_ping", "pool_recycle")
+
+
+def create_engine(uri: Optional[str] = None, profile: Optional[dict] = None) -> Engine:
+    """
+    An engine for `uri` (config.get_database_uri() by default) set up
+    from an engine profile (config.get_engine_profile() by default).
+    SQLite connections also get config.SQLITE_PRAGMAS.
+    """
+    url = make_url(uri or config.get_database_uri())
+    settings = dict(config.get_engine_profile() if profile is None else profile)
+    if url.get_backend_name() != "sqlite":
+        return sqlalchemy.create_engine(url, **settings)
+
+    if url.database in (None, "", ":memory:"):
+        # a single connection per thread is the whole database: no pool
+        # to size, and nothing for WAL or mmap to do
+        for setting in POOL_SETTINGS:
+            settings.pop(setting, None)
+        pragmas = {"cache_size": config.SQLITE_PRAGMAS["cache_size"]}
+    else:
+        # pysqlite's default for files is to open a connection per checkout;
+        # pooled ones get checked out by whichever thread comes next
+        settings["poolclass"] = QueuePool
+        settings["connect_args"] = dict(check_same_thread=False)
+        pragmas = config.SQLITE_PRAGMAS
+    engine = sqlalchemy.create_engine(url, **settings)
+    event.listen(engine, "connect", _sqlite_pragma_setter(pragmas))
+    return engine
+
+
+def create_read_engine(
+    uri: Optional[str] = None, profile: Optional[dict] = None
+) -> Engine:
+    """
+    Like create_engine, for the read side: config.get_read_database_uri()
+    by default, with its own pool, and connections that refuse to write.
+    """
+    url = make_url(uri or config.get_read_database_uri() or config.get_database_uri())
+    engine = create_engine(str(url), profile)
+    if url.get_backend_name() == "sqlite":
+        event.listen(engine, "connect", _sqlite_pragma_setter({"query_only": "ON"}))
+    elif url.get_backend_name() == "postgresql":
+        engine = engine.execution_options(postgresql_readonly=True)
+    return engine
+
+
+def create_async_engine(
+    uri: Optional[str] = None, profile: Optional[dict] = None
+) -> AsyncEngine:
+    """
+    create_engine's counterpart for AsyncSession, given an async driver
+    URI such as sqlite+aiosqlite:// or postgresql+asyncpg://.
+    """
+    url = make_url(uri or config.get_database_uri())
+    settings = dict(config.get_engine_profile() if profile is None else profile)
+    if url.get_backend_name() != "sqlite":
+        return sqlalchemy.ext.asyncio.create_async_engine(url, **settings)
+
+    if url.database in (None, "", ":memory:"):
+        for setting in POOL_SETTINGS:
+            settings.pop(setting, None)
+        pragmas = {"cache_size": config.SQLITE_PRAGMAS["cache_size"]}
+    else:
+        # aiosqlite's default for files opens a connection, and its thread,
+        # per checkout
+        settings["poolclass"] = AsyncAdaptedQueuePool
+        pragmas = config.SQLITE_PRAGMAS
+    engine = sqlalchemy.ext.asyncio.create_async_engine(url, **settings)
+    event.listen(engine.sync_engine, "connect", _sqlite_pragma_setter(pragmas))
+    return engine
+
+
+def _sqlite_pragma_setter(pragmas: dict):
+    def set_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return set_pragmas
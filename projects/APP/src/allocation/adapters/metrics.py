@@ -0,0 +1,163 @@
+"""
+Counters, gauges and histograms kept in process and rendered in the
+Prometheus text format for the /metrics endpoint. Recording is a lock
+and a couple of list operations, cheap enough to leave on around every
+handler call; the formatting all happens at scrape time.
+"""
+
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from half a millisecond up: handler calls, not page loads
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = Tuple[str, ...]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []  # type: List[Metric]
+
+    def register(self, metric: "Metric"):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []  # type: List[str]
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Registry = REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def _labels(self, values: Labels, **extra) -> str:
+        pairs = list(zip(self.labelnames, values)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+
+class Value(Metric):
+    """
+    A number per set of labels, either kept up to date by its owner or
+    given a function with set_function() that's called at scrape time.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}  # type: Dict[Labels, float]
+        self._functions = {}  # type: Dict[Labels, Callable[[], float]]
+
+    def set_function(self, function: Callable[[], float], labels: Labels = ()):
+        with self._lock:
+            self._functions[labels] = function
+
+    def value(self, labels: Labels = ()) -> float:
+        function = self._functions.get(labels)
+        return function() if function else self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            labels = sorted(set(self._values) | set(self._functions))
+        return [f"{self.name}{self._labels(k)} {self.value(k)}" for k in labels]
+
+
+class Counter(Value):
+    type = "counter"
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Value):
+    type = "gauge"
+
+    def set(self, value: float, labels: Labels = ()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # per labels, a count for each bucket, one for above them all, and
+        # the sum: one list, so observe() is one lookup; the counts are
+        # only made cumulative when rendered
+        self._series = {}  # type: Dict[Labels, List[float]]
+
+    def observe(self, labels: Labels, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                series = self._series[labels]
+            except KeyError:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, labels: Labels = ()) -> int:
+        return sum(self._series.get(labels, [0])[:-1])
+
+    def samples(self):
+        with self._lock:
+            series = [(k, list(v)) for k, v in sorted(self._series.items())]
+        lines = []
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f"{self.name}_bucket{self._labels(labels, le=le)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{self._labels(labels)} {values[-1]}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
@@ -1,6 +1,8 @@
 # pylint: disable=too-few-public-methods
 import abc
+import asyncio
 import smtplib
+import threading
 
 from allocation import config
 
@@ -17,9 +19,19 @@ DEFAULT_PORT = config.get_email_host_and_port()["port"]
 
 class EmailNotifications(AbstractNotifications):
     def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
+        self.smtp_host = smtp_host
+        self.port = port
+        self._local = threading.local()
         self.server.noop()
 
+    @property
+    def server(self) -> smtplib.SMTP:
+        # a connection per thread, so the message bus's handler threads can
+        # send at the same time without interleaving SMTP conversations
+        if not hasattr(self._local, "server"):
+            self._local.server = smtplib.SMTP(self.smtp_host, port=self.port)
+        return self._local.server
+
     def send(self, destination, message):
         msg = f"Subject: allocation service notification\n{message}"
         self.server.sendmail(
@@ -27,3 +39,14 @@ class EmailNotifications(AbstractNotifications):
             to_addrs=[destination],
             msg=msg,
         )
+
+
+class AsyncEmailNotifications(EmailNotifications):
+    """
+    For the AsyncMessageBus: send() returns a coroutine, and the SMTP
+    conversation runs on a worker thread, on that thread's own connection,
+    so several can be under way at once.
+    """
+
+    async def send(self, destination, message):
+        await asyncio.to_thread(super().send, destination, message)
@@ -1,8 +1,32 @@
 import logging
+import sys
+from collections import deque
+from typing import Iterable, List
 
 from allocation.domain import model
-from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, String, Table, event
-from sqlalchemy.orm import mapper, relationship
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Date,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    bindparam,
+    event,
+    func,
+    inspect,
+    select,
+)
+from sqlalchemy.orm import (
+    attributes,
+    make_transient_to_detached,
+    mapper,
+    relationship,
+    with_loader_criteria,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +52,7 @@ batches = Table(
     "batches",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("reference", String(255)),
+    Column("reference", String(255), index=True),
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
@@ -42,6 +66,18 @@ allocations = Table(
     Column("batch_id", ForeignKey("batches.id")),
 )
 
+# events to publish, written in the same transaction as the change that
+# raised them; entrypoints/outbox_relay.py sends them on
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("sku", String(255)),
+    Column("payload", Text, nullable=False),
+    Column("sent", Boolean, nullable=False, default=False, index=True),
+)
+
 allocations_view = Table(
     "allocations_view",
     metadata,
@@ -51,7 +87,12 @@ allocations_view = Table(
 )
 
 
-def start_mappers():
+def start_mappers(loading: str = "selectin"):
+    """
+    `loading` is the strategy for Product.batches and Batch._allocations:
+    "selectin" or "joined" load them along with the product in a fixed
+    number of queries, "select" lazy-loads them one query per batch.
+    """
     logger.info("Starting mappers")
     lines_mapper = mapper(model.OrderLine, order_lines)
     batches_mapper = mapper(
@@ -62,16 +103,141 @@ def start_mappers():
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
+                lazy=loading,
             )
         },
     )
     mapper(
         model.Product,
         products,
-        properties={"batches": relationship(batches_mapper)},
+        properties={"batches": relationship(batches_mapper, lazy=loading)},
+        # the domain bumps version_number itself; the UPDATE then checks the
+        # row still has the version it was loaded with
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
+    )
+
+
+def allocated_quantity(batch_id):
+    return (
+        select(func.coalesce(func.sum(order_lines.c.qty), 0))
+        .select_from(allocations.join(order_lines))
+        .where(allocations.c.batch_id == batch_id)
+        .scalar_subquery()
+    )
+
+
+def only_batches_in_stock():
+    """
+    Loader option that leaves batches with nothing left to allocate out of
+    Product.batches.
+    """
+    return with_loader_criteria(
+        model.Batch,
+        lambda cls: cls._purchased_quantity > allocated_quantity(cls.id),
     )
 
 
+def flush_allocations_in_bulk(session, products: Iterable[model.Product]):
+    """
+    Write the allocations made on `products` since they were loaded: new
+    order lines, then the allocation links added and removed, each as one
+    executemany rather than a statement per object. Everything else is
+    left to an ordinary flush, which runs first so the product version
+    check still guards these writes.
+    """
+    new_lines, added_links, removed_links = [], [], []
+    for product in products:
+        for batch in product.__dict__.get("batches", ()):
+            if inspect(batch).persistent and "_allocations" in batch.__dict__:
+                added, _, removed = attributes.get_history(batch, "_allocations")
+                if not added and not removed:
+                    continue
+                new_lines.extend(l for l in added if inspect(l).pending)
+                added_links.extend((line, batch) for line in added)
+                removed_links.extend((line, batch) for line in removed)
+                # this function writes them now, so the flush mustn't
+                attributes.set_committed_value(
+                    batch, "_allocations", set(batch._allocations)
+                )
+    for line in new_lines:
+        session.expunge(line)
+    session.flush()
+    if not added_links and not removed_links:
+        return
+
+    connection = session.connection()
+    _insert_order_lines(connection, new_lines)
+    for line in new_lines:
+        # detached with its new identity, so a later session can merge it
+        make_transient_to_detached(line)
+    if removed_links:
+        connection.execute(
+            allocations.delete().where(
+                (allocations.c.orderline_id == bindparam("line_id"))
+                & (allocations.c.batch_id == bindparam("batch_id_"))
+            ),
+            [dict(line_id=l.id, batch_id_=b.id) for l, b in removed_links],
+        )
+    if added_links:
+        connection.execute(
+            allocations.insert(),
+            [dict(orderline_id=l.id, batch_id=b.id) for l, b in added_links],
+        )
+
+
+def _insert_order_lines(connection, lines: List[model.OrderLine]):
+    if not lines:
+        return
+    rows = [dict(orderid=l.orderid, sku=l.sku, qty=l.qty) for l in lines]
+    if connection.dialect.insert_executemany_returning:
+        result = connection.execute(
+            order_lines.insert().returning(order_lines.c.id), rows
+        )
+        ids = [row.id for row in result]
+    elif connection.dialect.name == "sqlite":
+        # the first insert takes the write lock and gets max(rowid) + 1;
+        # holding the lock, the ids after it are ours to hand out
+        first_id = connection.execute(order_lines.insert(), rows[0]).lastrowid
+        ids = list(range(first_id, first_id + len(rows)))
+        if len(rows) > 1:
+            connection.execute(
+                order_lines.insert(),
+                [dict(row, id=id_) for row, id_ in zip(rows[1:], ids[1:])],
+            )
+    else:
+        ids = [
+            connection.execute(order_lines.insert(), row).inserted_primary_key[0]
+            for row in rows
+        ]
+    for line, id_ in zip(lines, ids):
+        line.id = id_
+
+
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
-    product.events = []
+    product.events = deque()
+    product._allocation_order = None
+    product._batches_by_ref = None
+
+
+@event.listens_for(model.Product, "refresh")
+@event.listens_for(model.Product, "expire")
+def reset_batch_indexes(product, *_):
+    if product is not None:  # expiry can reach instances already collected
+        product._allocation_order = None
+        product._batches_by_ref = None
+
+
+@event.listens_for(model.Batch, "load")
+@event.listens_for(model.Batch, "refresh")
+@event.listens_for(model.Batch, "expire")
+def reset_allocated_quantity(batch, *_):
+    if batch is not None:  # expiry can reach instances already collected
+        batch._allocated_quantity = None
+
+
+@event.listens_for(model.OrderLine, "load")
+def intern_sku(line, _):
+    if line.sku is not None:  # the column is nullable
+        attributes.set_committed_value(line, "sku", sys.intern(line.sku))
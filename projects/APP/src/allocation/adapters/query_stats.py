@@ -0,0 +1,84 @@
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, List
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@dataclass
+class QueryStats:
+    statements: int = 0
+    rows: int = 0  # as reported by the driver's rowcount; SQLite only counts DML
+    db_time: float = 0.0
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter:
+    """
+    Counts the statements an engine executes, with their rows and time
+    spent in the database, for whatever runs inside measure() on the
+    current thread. Measurements nest: an outer one includes the inner.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._local = threading.local()
+        self._started_key = f"query_started_{id(self)}"
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def remove(self):
+        event.remove(self.engine, "before_cursor_execute", self._before_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_execute)
+        event.remove(self.engine, "handle_error", self._handle_error)
+
+    @contextmanager
+    def measure(self) -> Iterator[QueryStats]:
+        stats = QueryStats()
+        self._active.append(stats)
+        try:
+            yield stats
+        finally:
+            self._active.remove(stats)
+
+    @contextmanager
+    def budget(self, statements: int) -> Iterator[QueryStats]:
+        with self.measure() as stats:
+            yield stats
+        if stats.statements > statements:
+            raise QueryBudgetExceeded(
+                f"{stats.statements} statements executed, budget was {statements}"
+            )
+
+    @property
+    def _active(self) -> List[QueryStats]:
+        if not hasattr(self._local, "active"):
+            self._local.active = []
+        return self._local.active
+
+    def _before_execute(self, conn, *_):
+        conn.info.setdefault(self._started_key, []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, *_):
+        self._record(conn, rows=max(cursor.rowcount, 0))
+
+    def _handle_error(self, context):
+        # a statement that raised never reaches after_cursor_execute; without
+        # this its start time would stay on the pooled connection for good
+        conn = context.connection
+        if conn is not None and conn.info.get(self._started_key):
+            self._record(conn, rows=0)
+
+    def _record(self, conn, rows: int):
+        elapsed = time.perf_counter() - conn.info[self._started_key].pop()
+        for stats in self._active:
+            stats.statements += 1
+            stats.rows += rows
+            stats.db_time += elapsed
@@ -1,6 +1,7 @@
 import json
 import logging
 from dataclasses import asdict
+from typing import Iterable, Tuple
 
 import redis
 from allocation import config
@@ -14,3 +15,14 @@ r = redis.Redis(**config.get_redis_host_and_port())
 def publish(channel, event: events.Event):
     logging.info("publishing: channel=%s, event=%s", channel, event)
     r.publish(channel, json.dumps(asdict(event)))
+
+
+def publish_many(messages: Iterable[Tuple[str, str]], client: redis.Redis = None):
+    """
+    Publish already-serialized (channel, payload) messages, in order, in a
+    single round trip.
+    """
+    pipeline = (client or r).pipeline(transaction=False)
+    for channel, payload in messages:
+        pipeline.publish(channel, payload)
+    pipeline.execute()
@@ -1,60 +1,199 @@
 import abc
-from typing import Set
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional, Set
 
-from allocation.adapters import orm
-from allocation.domain import model
+from allocation.adapters import metrics, orm
+from allocation.domain import events, model
+from sqlalchemy.orm import selectinload
+
+REPOSITORY_SECONDS = metrics.Histogram(
+    "allocation_repository_seconds",
+    "Time spent in a repository call, by method.",
+    ["method"],
+)
 
 
 class AbstractRepository(abc.ABC):
     def __init__(self):
         self.seen = set()  # type: Set[model.Product]
+        # every seen product appends its events straight onto this queue
+        self.new_events = deque()  # type: Deque[events.Event]
+        # skus of seen products whose batches were loaded in_stock_only
+        self.partly_loaded = set()  # type: Set[str]
 
     def add(self, product: model.Product):
+        started = time.perf_counter()
         self._add(product)
-        self.seen.add(product)
+        self._see(product)
+        REPOSITORY_SECONDS.observe(("add",), time.perf_counter() - started)
 
-    def get(self, sku) -> model.Product:
-        product = self._get(sku)
+    def get(self, sku, in_stock_only: bool = False) -> model.Product:
+        """
+        With in_stock_only, Product.batches may leave out batches that have
+        nothing left to allocate, which is all Product.allocate needs. A
+        later get without it loads all of them again.
+        """
+        started = time.perf_counter()
+        product = self._get(sku, in_stock_only=in_stock_only)
         if product:
-            self.seen.add(product)
+            self._see(product, in_stock_only)
+        REPOSITORY_SECONDS.observe(("get",), time.perf_counter() - started)
         return product
 
+    def get_many(
+        self, skus: Iterable[str], in_stock_only: bool = False
+    ) -> Dict[str, model.Product]:
+        """
+        The products for whichever of `skus` exist, by sku. Products this
+        repository has already handed out are reused rather than fetched
+        again.
+        """
+        started = time.perf_counter()
+        wanted = set(skus)
+        products = {
+            p.sku: p
+            for p in self.seen
+            if p.sku in wanted and (in_stock_only or p.sku not in self.partly_loaded)
+        }
+        missing = wanted - products.keys()
+        if missing:
+            for product in self._get_many(missing, in_stock_only=in_stock_only):
+                products[product.sku] = product
+                self._see(product, in_stock_only)
+        REPOSITORY_SECONDS.observe(("get_many",), time.perf_counter() - started)
+        return products
+
     def get_by_batchref(self, batchref) -> model.Product:
+        started = time.perf_counter()
         product = self._get_by_batchref(batchref)
         if product:
-            self.seen.add(product)
+            self._see(product)
+        REPOSITORY_SECONDS.observe(("get_by_batchref",), time.perf_counter() - started)
         return product
 
+    def skus_for_batchrefs(self, batchrefs: Iterable[str]) -> Dict[str, str]:
+        """The sku of each of `batchrefs` there's a batch for, by batchref."""
+        started = time.perf_counter()
+        skus = self._skus_for_batchrefs(set(batchrefs))
+        REPOSITORY_SECONDS.observe(
+            ("skus_for_batchrefs",), time.perf_counter() - started
+        )
+        return skus
+
+    def _see(self, product: model.Product, in_stock_only: bool = False):
+        if not in_stock_only:
+            self.partly_loaded.discard(product.sku)
+        elif product not in self.seen:
+            self.partly_loaded.add(product.sku)
+        if product.events is not self.new_events:
+            self.new_events.extend(product.events)
+            product.events = self.new_events
+        self.seen.add(product)
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def _get(self, sku) -> model.Product:
+    def _get(self, sku, in_stock_only: bool = False) -> model.Product:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _get_many(
+        self, skus: Set[str], in_stock_only: bool = False
+    ) -> Iterable[model.Product]:
         raise NotImplementedError
 
     @abc.abstractmethod
     def _get_by_batchref(self, batchref) -> model.Product:
         raise NotImplementedError
 
+    def _skus_for_batchrefs(self, batchrefs: Set[str]) -> Dict[str, str]:
+        skus = {}
+        for batchref in batchrefs:
+            product = self._get_by_batchref(batchref)
+            if product is not None:
+                skus[batchref] = product.sku
+        return skus
+
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session):
+    # matches the batch size selectin loading uses for its IN lists
+    GET_MANY_CHUNK_SIZE = 500
+
+    def __init__(self, session, batchref_skus: Optional[Dict[str, str]] = None):
         super().__init__()
         self.session = session
+        # a batch never moves to another sku, so this can outlive the session
+        self.batchref_skus = {} if batchref_skus is None else batchref_skus
 
     def _add(self, product):
         self.session.add(product)
 
-    def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+    def _get(self, sku, in_stock_only=False):
+        query = self.session.query(model.Product).filter_by(sku=sku)
+        if in_stock_only:
+            query = query.options(orm.only_batches_in_stock())
+        elif sku in self.partly_loaded:
+            query = self._in_full(query)
+        return query.first()
 
-    def _get_by_batchref(self, batchref):
-        return (
-            self.session.query(model.Product)
-            .join(model.Batch)
-            .filter(
-                orm.batches.c.reference == batchref,
+    def _get_many(self, skus, in_stock_only=False):
+        # one query for the products, then one each for their batches and
+        # allocations, per chunk of skus
+        skus = sorted(skus)
+        for start in range(0, len(skus), self.GET_MANY_CHUNK_SIZE):
+            chunk = skus[start : start + self.GET_MANY_CHUNK_SIZE]
+            query = (
+                self.session.query(model.Product)
+                .filter(orm.products.c.sku.in_(chunk))
+                .options(
+                    selectinload(model.Product.batches).selectinload(
+                        model.Batch._allocations
+                    )
+                )
             )
+            if in_stock_only:
+                query = query.options(orm.only_batches_in_stock())
+            elif self.partly_loaded.intersection(chunk):
+                query = self._in_full(query)
+            yield from query
+
+    @staticmethod
+    def _in_full(query):
+        # the session would hand back products with their batches cut short,
+        # and a lazy load of them would still leave out the used-up ones
+        return query.populate_existing().options(selectinload(model.Product.batches))
+
+    def _get_by_batchref(self, batchref):
+        sku = self.batchref_skus.get(batchref)
+        if sku is not None:
+            product = self._get(sku)
+            if product is not None and product.get_batch(batchref) is not None:
+                return product
+        row = (
+            self.session.query(orm.batches.c.sku)
+            .filter(orm.batches.c.reference == batchref)
             .first()
         )
+        if row is None:
+            return None
+        self.batchref_skus[batchref] = row.sku
+        return self._get(row.sku)
+
+    def _skus_for_batchrefs(self, batchrefs):
+        # just the batches table, and only for refs not already known
+        skus = {
+            ref: self.batchref_skus[ref]
+            for ref in batchrefs & self.batchref_skus.keys()
+        }
+        missing = sorted(batchrefs - skus.keys())
+        for start in range(0, len(missing), self.GET_MANY_CHUNK_SIZE):
+            chunk = missing[start : start + self.GET_MANY_CHUNK_SIZE]
+            rows = self.session.query(
+                orm.batches.c.reference, orm.batches.c.sku
+            ).filter(orm.batches.c.reference.in_(chunk))
+            for row in rows:
+                skus[row.reference] = self.batchref_skus[row.reference] = row.sku
+        return skus
@@ -1,24 +1,41 @@
+import atexit
+import functools
 import inspect
-from typing import Callable
 
-from allocation.adapters import orm, redis_eventpublisher
-from allocation.adapters.notifications import AbstractNotifications, EmailNotifications
-from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.adapters import orm
+from allocation.adapters.notifications import (
+    AbstractNotifications,
+    AsyncEmailNotifications,
+    EmailNotifications,
+)
+from allocation.domain import model
+from allocation.service_layer import deferred, handlers, messagebus, unit_of_work
 
 
 def bootstrap(
     start_orm: bool = True,
     uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
     notifications: AbstractNotifications = None,
-    publish: Callable = redis_eventpublisher.publish,
+    eviction_policy: model.EvictionPolicy = model.evict_fewest_lines,
+    conflict_attempts: int = 5,
+    max_group_size: int = 100,
+    handler_threads: int = 4,
+    deferred_workers: int = 2,
+    deferred_queue_size: int = 1000,
+    deferred_overflow: str = "block",
 ) -> messagebus.MessageBus:
+    is_async = isinstance(uow, unit_of_work.AsyncSqlAlchemyUnitOfWork)
     if notifications is None:
-        notifications = EmailNotifications()
+        notifications = AsyncEmailNotifications() if is_async else EmailNotifications()
 
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
+    dependencies = {
+        "uow": uow,
+        "notifications": notifications,
+        "eviction_policy": eviction_policy,
+    }
     injected_event_handlers = {
         event_type: [
             inject_dependencies(handler, dependencies) for handler in event_handlers
@@ -30,11 +47,30 @@ def bootstrap(
         for command_type, handler in handlers.COMMAND_HANDLERS.items()
     }
 
-    return messagebus.MessageBus(
+    deferred_handlers = None
+    if deferred_workers and not is_async:
+        deferred_handlers = deferred.DeferredHandlers(
+            deferred_workers,
+            deferred_queue_size,
+            deferred_overflow,
+            call=messagebus.timed,
+        )
+
+    bus_class = messagebus.AsyncMessageBus if is_async else messagebus.MessageBus
+    bus = bus_class(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        conflict_attempts=conflict_attempts,
+        max_group_size=max_group_size,
+        # the async bus awaits its handlers rather than handing them to threads
+        handler_threads=0 if is_async else handler_threads,
+        deferred_handlers=deferred_handlers,
     )
+    # finish what's waiting and stop the threads before the process goes,
+    # unless whoever made the bus closes it first
+    atexit.register(bus.close)
+    return bus
 
 
 def inject_dependencies(handler, dependencies):
@@ -42,4 +78,9 @@ def inject_dependencies(handler, dependencies):
     deps = {
         name: dependency for name, dependency in dependencies.items() if name in params
     }
-    return lambda message: handler(message, **deps)
+
+    @functools.wraps(handler)
+    def injected(message):
+        return handler(message, **deps)
+
+    return injected
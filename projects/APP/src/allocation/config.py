@@ -9,6 +9,54 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_database_uri():
+    # substituting POSTGRES with the in-memory sqlite unless told otherwise
+    return os.environ.get("DATABASE_URI", "sqlite+pysqlite:///:memory:")
+
+
+def get_read_database_uri():
+    # a replica, or the same SQLite file, for the views; None means they
+    # share the write engine
+    return os.environ.get("READ_DATABASE_URI")
+
+
+ENGINE_PROFILES = {
+    "dev": dict(
+        pool_size=5,
+        max_overflow=10,
+        pool_pre_ping=False,
+        query_cache_size=500,
+    ),
+    "test": dict(
+        # one for the unit of work, and one spare so a view read while it
+        # holds its session (which borrows this pool) doesn't have to wait
+        pool_size=1,
+        max_overflow=1,
+        pool_pre_ping=False,
+        query_cache_size=500,
+    ),
+    "prod": dict(
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+        query_cache_size=1200,
+    ),
+}
+
+SQLITE_PRAGMAS = dict(
+    journal_mode="WAL",
+    synchronous="NORMAL",
+    mmap_size=256 * 1024 * 1024,
+    cache_size=-64 * 1024,  # negative means KiB: 64MiB
+)
+
+
+def get_engine_profile():
+    name = os.environ.get("DB_PROFILE", "dev")
+    return dict(ENGINE_PROFILES[name], echo=os.environ.get("DB_ECHO") == "1")
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
@@ -0,0 +1,129 @@
+"""
+A column-oriented twin of Product.allocate for what-if simulation: replay
+a whole stream of order lines against a batch plan without building
+Batch and OrderLine objects. Batches that fit are picked exactly as
+Product.allocate picks them: in-stock first, then earliest ETA, ties to
+whichever batch came first.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+
+from . import model
+
+
+@dataclass
+class AllocationResult:
+    line_batchrefs: np.ndarray  # per order line, None where out of stock
+    batchrefs: np.ndarray  # per batch, in the order the plan was given
+    remaining: np.ndarray  # stock left per batch, lined up with batchrefs
+
+    def remaining_by_batchref(self) -> Dict[str, int]:
+        return dict(zip(self.batchrefs.tolist(), self.remaining.tolist()))
+
+
+class ColumnarAllocator:
+    def __init__(
+        self,
+        skus: Sequence[str],
+        refs: Sequence[str],
+        available: Sequence[int],
+        etas: Sequence[Optional[date]],
+    ):
+        skus = np.asarray(skus, dtype=object)
+        self.batchrefs = np.asarray(refs, dtype=object)
+        available = np.asarray(available, dtype=np.int64)
+        etas = np.asarray(etas, dtype="datetime64[D]")
+        # NaT (in stock) is the smallest datetime64, so it sorts first
+        sku_codes, self._skus = _codes(skus)
+        order = np.lexsort(
+            (np.arange(len(skus)), etas.astype(np.int64), ~np.isnat(etas), sku_codes)
+        )
+        self._order = order
+        self._available = np.maximum(available[order], 0)
+        bounds = np.searchsorted(sku_codes[order], np.arange(len(self._skus) + 1))
+        self._slices = {
+            sku: slice(bounds[i], bounds[i + 1]) for i, sku in enumerate(self._skus)
+        }
+
+    @classmethod
+    def from_products(cls, products: Iterable[model.Product]) -> ColumnarAllocator:
+        batches = [b for p in products for b in p.batches]
+        return cls(
+            skus=[b.sku for b in batches],
+            refs=[b.reference for b in batches],
+            available=[b.available_quantity for b in batches],
+            etas=[b.eta for b in batches],
+        )
+
+    def allocate(self, skus: Sequence[str], qtys: Sequence[int]) -> AllocationResult:
+        """
+        Allocate a stream of lines, given as parallel sku and qty columns,
+        in stream order. Lines for a sku the plan doesn't know are
+        treated like out-of-stock ones.
+        """
+        qtys = np.asarray(qtys, dtype=np.int64)
+        line_codes, line_skus = _codes(np.asarray(skus, dtype=object))
+        remaining = self._available.copy()
+        chosen = np.full(len(qtys), -1, dtype=np.int64)
+        by_sku = np.argsort(line_codes, kind="stable")
+        bounds = np.searchsorted(line_codes[by_sku], np.arange(len(line_skus) + 1))
+        for i, sku in enumerate(line_skus):
+            batches = self._slices.get(sku)
+            if batches is None:
+                continue
+            lines = by_sku[bounds[i] : bounds[i + 1]]
+            chosen[lines] = _allocate_sku(remaining[batches], qtys[lines])
+            chosen[lines] += np.where(chosen[lines] >= 0, batches.start, 0)
+        allocated = chosen >= 0
+        line_batchrefs = np.full(len(qtys), None, dtype=object)
+        line_batchrefs[allocated] = self.batchrefs[self._order][chosen[allocated]]
+        unsorted_remaining = np.empty_like(remaining)
+        unsorted_remaining[self._order] = remaining
+        return AllocationResult(line_batchrefs, self.batchrefs, unsorted_remaining)
+
+    def allocate_lines(self, lines: Iterable[model.OrderLine]) -> AllocationResult:
+        lines = list(lines)
+        return self.allocate([l.sku for l in lines], [l.qty for l in lines])
+
+
+def _codes(values: np.ndarray):
+    uniques, codes = np.unique(values, return_inverse=True)
+    return codes.reshape(-1), uniques.tolist()
+
+
+def _allocate_sku(remaining: np.ndarray, qtys: np.ndarray) -> np.ndarray:
+    """
+    Greedy earliest-batch allocation of one sku's lines, updating
+    `remaining` (a view, in allocation order) in place. Returns the index
+    of the chosen batch per line, -1 where nothing fits.
+    """
+    chosen = np.full(len(qtys), -1, dtype=np.int64)
+    totals = np.cumsum(qtys)
+    head, pos = 0, 0
+    while pos < len(qtys):
+        while head < len(remaining) and remaining[head] <= 0:
+            head += 1
+        if head == len(remaining):
+            break
+        # every line of the run whose running total fits in the first batch
+        # with stock goes there; one vector search per run, not per line
+        base = totals[pos - 1] if pos else 0
+        end = int(np.searchsorted(totals, base + remaining[head], side="right"))
+        if end > pos:
+            chosen[pos:end] = head
+            remaining[head] -= totals[end - 1] - base
+            pos = end
+            continue
+        # this line is too big for the head batch: first later one it fits
+        fits = np.flatnonzero(remaining[head + 1 :] >= qtys[pos])
+        if fits.size:
+            chosen[pos] = head + 1 + fits[0]
+            remaining[head + 1 + fits[0]] -= qtys[pos]
+        pos += 1
+    return chosen
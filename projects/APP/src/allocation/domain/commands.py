@@ -1,21 +1,26 @@
 # pylint: disable=too-few-public-methods
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import List, Optional
 
 
 class Command:
-    pass
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class Allocate(Command):
     orderid: str
     sku: str
     qty: int
 
 
-@dataclass
+@dataclass(slots=True)
+class AllocateMany(Command):
+    lines: List[Allocate]
+
+
+@dataclass(slots=True)
 class CreateBatch(Command):
     ref: str
     sku: str
@@ -23,7 +28,7 @@ class CreateBatch(Command):
     eta: Optional[date] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
@@ -3,10 +3,10 @@ from dataclasses import dataclass
 
 
 class Event:
-    pass
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class Allocated(Event):
     orderid: str
     sku: str
@@ -14,13 +14,13 @@ class Allocated(Event):
     batchref: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Deallocated(Event):
     orderid: str
     sku: str
     qty: int
 
 
-@dataclass
+@dataclass(slots=True)
 class OutOfStock(Event):
     sku: str
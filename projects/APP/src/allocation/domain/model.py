@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import bisect
+import itertools
+import sys
+from collections import deque
 from dataclasses import dataclass
 from datetime import date
-from typing import List, Optional, Set
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
 
 from . import commands, events
 
@@ -12,40 +16,105 @@ class Product:
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
-        self.events = []  # type: List[events.Event]
+        # a repository swaps in its unit of work's queue, shared by every
+        # product it has handed out
+        self.events = deque()  # type: Deque[events.Event]
+        self._allocation_order = None  # type: Optional[AllocationOrder]
+        self._batches_by_ref = None  # type: Optional[Dict[str, Batch]]
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        if self._order_is_current():
+            self._allocation_order.add(batch)
+        if self._batches_by_ref is not None:
+            self._batches_by_ref[batch.reference] = batch
+
+    def get_batch(self, ref: str) -> Optional[Batch]:
+        if self._batches_by_ref is None or len(self._batches_by_ref) != len(
+            self.batches
+        ):
+            self._batches_by_ref = {b.reference: b for b in self.batches}
+        return self._batches_by_ref.get(ref)
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
+        batchref = self._allocate(line)
+        if batchref is not None:
             self.version_number += 1
-            self.events.append(
-                events.Allocated(
-                    orderid=line.orderid,
-                    sku=line.sku,
-                    qty=line.qty,
-                    batchref=batch.reference,
-                )
-            )
-            return batch.reference
-        except StopIteration:
+        return batchref
+
+    def allocate_many(self, lines: List[OrderLine]) -> List[Optional[str]]:
+        batchrefs = [self._allocate(line) for line in lines]
+        if any(ref is not None for ref in batchrefs):
+            self.version_number += 1
+        return batchrefs
+
+    def _allocate(self, line: OrderLine) -> Optional[str]:
+        batch = self._order().first_that_can_allocate(line)
+        if batch is None:
             self.events.append(events.OutOfStock(line.sku))
             return None
+        batch.allocate(line)
+        self._allocation_order.update(batch)
+        self.events.append(
+            events.Allocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batch.reference,
+            )
+        )
+        return batch.reference
 
-    def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+    def change_batch_quantity(
+        self, ref: str, qty: int, evict: Optional[EvictionPolicy] = None
+    ):
+        evict = evict or evict_fewest_lines
+        batch = self.get_batch(ref)
         batch._purchased_quantity = qty
+        evicted = []
+        if batch.available_quantity < 0:
+            # a policy may yield lazily, and deallocating changes the set
+            chosen = list(evict(set(batch._allocations), -batch.available_quantity))
+            for line in chosen:
+                batch.deallocate(line)
+                evicted.append(line)
         while batch.available_quantity < 0:
-            line = batch.deallocate_one()
+            evicted.append(batch.deallocate_one())
+        if self._order_is_current():
+            self._allocation_order.update(batch)
+        for line in evicted:
             self.events.append(events.Deallocated(line.orderid, line.sku, line.qty))
+        # reallocate here rather than once per Deallocated event, so every
+        # evicted line is placed in the same transaction
+        for line in evicted:
+            self._allocate(line)
+        # always a new version: the batch row changed even if nothing moved
+        self.version_number += 1
+
+    def _order(self) -> AllocationOrder:
+        if not self._order_is_current():
+            self._allocation_order = AllocationOrder(self.batches)
+        return self._allocation_order
+
+    def _order_is_current(self) -> bool:
+        # batches appended straight onto the list bypass add_batch, so a
+        # length mismatch means the index has to be rebuilt
+        order = self._allocation_order
+        return order is not None and order.batch_count == len(self.batches)
 
 
 @dataclass(unsafe_hash=True)
 class OrderLine:
+    # not slotted: the ORM mapper needs a __dict__ and weakrefs on instances
     orderid: str
     sku: str
     qty: int
 
+    def __post_init__(self):
+        # every line for a SKU shares one string instead of carrying its own
+        if isinstance(self.sku, str):
+            self.sku = sys.intern(self.sku)
+
 
 class Batch:
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
@@ -54,6 +123,7 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -73,16 +143,38 @@ class Batch:
             return True
         return self.eta > other.eta
 
+    @property
+    def priority(self) -> Tuple[bool, date]:
+        # in-stock batches (no eta) sort ahead of every shipment
+        return (self.eta is not None, self.eta or date.min)
+
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            self._allocated_quantity = self.allocated_quantity + line.qty
+
+    def deallocate(self, line: OrderLine):
+        if line in self._allocations:
+            allocated_quantity = self.allocated_quantity
+            self._allocations.remove(line)
+            self._allocated_quantity = allocated_quantity - line.qty
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated_quantity = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated_quantity - line.qty
+        return line
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # None after an ORM load or expiry: recount from the allocations
+        # the first time it's needed rather than loading them eagerly
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
+
+    def allocated_quantity_is_consistent(self) -> bool:
+        return self.allocated_quantity == sum(line.qty for line in self._allocations)
 
     @property
     def available_quantity(self) -> int:
@@ -90,3 +182,93 @@ class Batch:
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
+
+
+class AllocationOrder:
+    """
+    The batches of a product that still have stock, kept in the order
+    Product.allocate should try them: in-stock first, then by ETA, with ties
+    going to whichever batch was added first.
+    """
+
+    def __init__(self, batches: List[Batch]):
+        self.batch_count = len(batches)
+        self._ranks = itertools.count()
+        self._rank = {}  # type: Dict[str, int]
+        self._entries = []  # type: List[Tuple[Tuple[bool, date], int, Batch]]
+        self._entry_for = {}  # type: Dict[str, Tuple[Tuple[bool, date], int, Batch]]
+        for batch in batches:
+            self._rank[batch.reference] = rank = next(self._ranks)
+            if batch.available_quantity > 0:
+                entry = (batch.priority, rank, batch)
+                self._entries.append(entry)
+                self._entry_for[batch.reference] = entry
+        self._entries.sort()
+
+    def __iter__(self):
+        return (batch for _, _, batch in self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def first_that_can_allocate(self, line: OrderLine) -> Optional[Batch]:
+        return next((b for b in self if b.can_allocate(line)), None)
+
+    def add(self, batch: Batch):
+        self.batch_count += 1
+        self._rank[batch.reference] = next(self._ranks)
+        self.update(batch)
+
+    def update(self, batch: Batch):
+        has_stock = batch.available_quantity > 0
+        if has_stock and batch.reference in self._entry_for:
+            return  # a batch's eta never changes, so its slot is still right
+        entry = self._entry_for.pop(batch.reference, None)
+        if entry is not None:
+            del self._entries[bisect.bisect_left(self._entries, entry)]
+        if has_stock:
+            entry = (batch.priority, self._rank[batch.reference], batch)
+            bisect.insort(self._entries, entry)
+            self._entry_for[batch.reference] = entry
+
+
+# An eviction policy picks which of a batch's allocations to give up when
+# its quantity drops below what's allocated: given the allocations and the
+# shortfall, it returns lines whose quantities add up to at least that much.
+# Every line it picks becomes a Deallocated event and a reallocation.
+EvictionPolicy = Callable[[Set[OrderLine], int], Iterable[OrderLine]]
+
+
+def evict_any(allocations: Set[OrderLine], shortfall: int) -> List[OrderLine]:
+    evicted = []
+    for line in allocations:
+        if shortfall <= 0:
+            break
+        evicted.append(line)
+        shortfall -= line.qty
+    return evicted
+
+
+def evict_fewest_lines(allocations: Set[OrderLine], shortfall: int) -> List[OrderLine]:
+    # taking the largest lines first never needs more lines than any other
+    # choice would
+    evicted = []
+    for line in sorted(allocations, key=lambda l: l.qty, reverse=True):
+        if shortfall <= 0:
+            break
+        evicted.append(line)
+        shortfall -= line.qty
+    return evicted
+
+
+def evict_closest_fit(allocations: Set[OrderLine], shortfall: int) -> List[OrderLine]:
+    # the smallest single line that covers what's left if there is one,
+    # otherwise the largest line and go again; keeps over-eviction low
+    candidates = sorted(allocations, key=lambda l: l.qty)
+    evicted = []
+    while shortfall > 0 and candidates:
+        i = bisect.bisect_left(candidates, shortfall, key=lambda l: l.qty)
+        line = candidates.pop(i if i < len(candidates) else -1)
+        evicted.append(line)
+        shortfall -= line.qty
+    return evicted
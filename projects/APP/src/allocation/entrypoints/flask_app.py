@@ -1,12 +1,16 @@
 from datetime import datetime
 
 from allocation import bootstrap, views
+from allocation.adapters import metrics
 from allocation.domain import commands
+from allocation.service_layer import messagebus
 from allocation.service_layer.handlers import InvalidSku
 from flask import Flask, jsonify, request
 
 app = Flask(__name__)
 bus = bootstrap.bootstrap()
+queries = views.read_only_queries(bus.uow)
+messagebus.export_queue_metrics(bus)
 
 
 @app.route("/add_batch", methods=["POST"])
@@ -34,9 +38,30 @@ def allocate_endpoint():
     return "OK", 202
 
 
+@app.route("/allocate/bulk", methods=["POST"])
+def allocate_many_endpoint():
+    try:
+        cmd = commands.AllocateMany(
+            [
+                commands.Allocate(line["orderid"], line["sku"], line["qty"])
+                for line in request.json["lines"]
+            ]
+        )
+        bus.handle(cmd)
+    except InvalidSku as e:
+        return {"message": str(e)}, 400
+
+    return "OK", 202
+
+
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    result = queries.allocations(orderid)
     if not result:
         return "not found", 404
     return jsonify(result), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.REGISTRY.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
@@ -0,0 +1,54 @@
+import logging
+import time
+
+import redis
+from allocation import config
+from allocation.adapters import engines, orm, redis_eventpublisher
+from sqlalchemy import select
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+POLL_INTERVAL = 0.5
+
+
+def relay_batch(engine, client: redis.Redis, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Publish up to batch_size pending outbox rows, oldest first, and mark
+    them sent. Rows are only marked once Redis has taken them all, so a
+    failure part way means they go again: delivery is at-least-once.
+    Taking rows in id order keeps each sku's events in the order they
+    were committed, as long as there's one relay per database.
+    """
+    with engine.begin() as connection:
+        rows = connection.execute(
+            select(orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.payload)
+            .where(orm.outbox.c.sent == False)  # pylint: disable=singleton-comparison
+            .order_by(orm.outbox.c.id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            return 0
+        redis_eventpublisher.publish_many(
+            ((row.channel, row.payload) for row in rows), client=client
+        )
+        connection.execute(
+            orm.outbox.update()
+            .where(orm.outbox.c.id.in_([row.id for row in rows]))
+            .values(sent=True)
+        )
+    logger.debug("relayed %d outbox messages", len(rows))
+    return len(rows)
+
+
+def main():
+    logger.info("Outbox relay starting")
+    engine = engines.create_engine()
+    client = redis.Redis(**config.get_redis_host_and_port())
+    while True:
+        if relay_batch(engine, client) < BATCH_SIZE:
+            time.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
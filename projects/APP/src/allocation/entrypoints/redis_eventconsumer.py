@@ -9,6 +9,9 @@ logger = logging.getLogger(__name__)
 
 r = redis.Redis(**config.get_redis_host_and_port())
 
+# the most messages taken off the subscription before handing them to the bus
+BATCH_SIZE = 500
+
 
 def main():
     logger.info("Redis pubsub starting")
@@ -17,14 +20,32 @@ def main():
     pubsub.subscribe("change_batch_quantity")
 
     for m in pubsub.listen():
-        handle_change_batch_quantity(m, bus)
-
-
-def handle_change_batch_quantity(m, bus):
-    logger.info("handling %s", m)
-    data = json.loads(m["data"])
-    cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    bus.handle(cmd)
+        # whatever else has already arrived goes to the bus along with it
+        batch = [m]
+        while len(batch) < BATCH_SIZE:
+            more = pubsub.get_message()
+            if more is None:
+                break
+            batch.append(more)
+        handle_change_batch_quantities(batch, bus)
+
+
+def handle_change_batch_quantities(ms, bus):
+    logger.info("handling %d messages", len(ms))
+    handled, cmds = [], []
+    for m in ms:
+        # one bad message is logged and dropped, not the whole batch with it
+        try:
+            data = json.loads(m["data"])
+            cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
+        except (ValueError, KeyError, TypeError):
+            logger.exception("skipping malformed message %s", m)
+            continue
+        handled.append(m)
+        cmds.append(cmd)
+    for m, error in zip(handled, bus.handle_many(cmds)):
+        if error is not None:
+            logger.error("failed to handle %s: %r", m, error)
 
 
 if __name__ == "__main__":
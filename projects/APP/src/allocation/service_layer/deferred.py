@@ -0,0 +1,214 @@
+# pylint: disable=broad-except
+from __future__ import annotations
+
+import logging
+import pickle
+import queue
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "spill")
+
+_STOP = object()
+
+
+@dataclass
+class DeferredMetrics:
+    depth: int = 0  # waiting, in memory or spilled
+    lag: float = 0.0  # seconds the oldest waiting one has waited
+    handled: int = 0
+    failed: int = 0
+    dropped: int = 0
+    spilled: int = 0  # ever written to the spill file
+
+
+class SpillFile:
+    """
+    A first-in, first-out queue of pickled records in a temporary file,
+    for what doesn't fit in memory. It doesn't survive a restart: that's
+    what draining on shutdown is for.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._read_at = 0
+        self.count = 0
+
+    def append(self, record):
+        self._file.seek(0, 2)
+        pickle.dump(record, self._file)
+        self.count += 1
+
+    def popleft(self):
+        self._file.seek(self._read_at)
+        record = pickle.load(self._file)
+        self._read_at = self._file.tell()
+        self.count -= 1
+        if not self.count:
+            self._file.truncate(0)
+            self._read_at = 0
+        return record
+
+
+class DeferredHandlers:
+    """
+    Runs event handlers marked handlers.deferred on background worker
+    threads, so the message bus can return without waiting for them. At
+    most max_size of them wait in memory; when that's full, submit()
+    blocks, drops the oldest, or spills to a file on disk, as `overflow`
+    says. close() runs whatever is still waiting before it returns.
+    Each one is run as call(handler, event), handler(event) by default.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        max_size: int = 1000,
+        overflow="block",
+        call: Optional[Callable] = None,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {', '.join(OVERFLOW_POLICIES)}")
+        self.workers = workers
+        self.overflow = overflow
+        self.call = call or (lambda handler, event: handler(event))
+        self._queue = queue.Queue(max_size)
+        self._spill = SpillFile() if overflow == "spill" else None
+        self._lock = threading.Lock()
+        self._handlers = {}  # type: Dict[str, Callable]
+        self._threads = []  # type: List[threading.Thread]
+        self._metrics = DeferredMetrics()
+        self.closed = False
+
+    def submit(self, handler: Callable, event: events.Event):
+        if self.closed:
+            raise RuntimeError("deferred handlers are closed")
+        self._start()
+        name = handler_name(handler)
+        with self._lock:
+            known = self._handlers.setdefault(name, handler)
+        if known != handler:
+            raise ValueError(f"a different handler is already called {name}")
+        item = (name, event, time.monotonic())
+        if self.overflow == "block":
+            self._queue.put(item)
+        elif self.overflow == "drop-oldest":
+            self._put_dropping_oldest(item)
+        else:
+            self._put_or_spill(item)
+
+    def metrics(self) -> DeferredMetrics:
+        with self._queue.mutex:
+            depth = len(self._queue.queue)
+            oldest = self._queue.queue[0] if depth else _STOP
+        if self._spill is not None:
+            depth += self._spill.count
+        lag = 0.0 if oldest is _STOP else time.monotonic() - oldest[2]
+        with self._lock:
+            return DeferredMetrics(
+                depth=depth,
+                lag=lag,
+                handled=self._metrics.handled,
+                failed=self._metrics.failed,
+                dropped=self._metrics.dropped,
+                spilled=self._metrics.spilled,
+            )
+
+    def join(self):
+        """Waits until everything submitted so far has been handled."""
+        while True:
+            self._queue.join()
+            with self._lock:
+                if self._spill is None or not self._spill.count:
+                    return
+                self._refill()
+
+    def close(self, timeout: Optional[float] = None):
+        if self.closed:
+            return
+        self.closed = True
+        self.join()
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _start(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"deferred-handler-{n}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _put_dropping_oldest(self, item: Tuple):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                name, event, _ = self._queue.get_nowait()
+            except queue.Empty:
+                continue
+            self._queue.task_done()
+            with self._lock:
+                self._metrics.dropped += 1
+            logger.warning("queue full, dropped %s for %s", name, event)
+
+    def _put_or_spill(self, item: Tuple):
+        with self._lock:
+            # once anything has spilled, the rest follows it to keep order
+            if not self._spill.count:
+                try:
+                    self._queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    pass
+            self._spill.append(item)
+            self._metrics.spilled += 1
+
+    def _refill(self):
+        # with self._lock held
+        while self._spill.count and not self._queue.full():
+            self._queue.put_nowait(self._spill.popleft())
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            name, event, _ = item
+            failed = False
+            try:
+                self.call(self._handlers[name], event)
+            except Exception:
+                logger.exception("Exception handling event %s in %s", event, name)
+                failed = True
+            with self._lock:
+                if failed:
+                    self._metrics.failed += 1
+                else:
+                    self._metrics.handled += 1
+                if self._spill is not None:
+                    self._refill()
+            self._queue.task_done()
+
+
+def handler_name(handler: Callable) -> str:
+    # what the queue and the spill file hold in place of the handler itself
+    return f"{handler.__module__}.{handler.__qualname__}"
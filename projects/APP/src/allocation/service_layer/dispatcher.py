@@ -0,0 +1,270 @@
+# pylint: disable=broad-except
+from __future__ import annotations
+
+import itertools
+import logging
+import multiprocessing
+import pickle
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Empty
+from typing import Callable, Dict, List, Optional, Set
+
+from allocation import bootstrap
+from allocation.adapters import repository
+from allocation.domain import commands
+from sqlalchemy.orm import sessionmaker
+
+from . import messagebus, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+# the most commands a worker takes off its queue for one handle_many()
+WORKER_BATCH_SIZE = 100
+
+# how often, with no results coming back, the collector looks for workers
+# that have died
+WORKER_CHECK_SECONDS = 0.5
+
+# how many batches' skus the dispatcher remembers
+BATCHREF_CACHE_SIZE = 100_000
+
+
+class WorkerFailed(Exception):
+    """The worker a command was sent to stopped without handling it."""
+
+
+class Dispatcher:
+    """
+    Hands commands to `workers` single-threaded worker processes, each
+    with its own message bus from bus_factory (bootstrap.bootstrap by
+    default, which must be importable by name in a fresh process). All
+    the commands for one sku go to the same worker, in the order they
+    were dispatched, so no two workers ever allocate from the same
+    product at once.
+
+    ChangeBatchQuantity only names a batch: it follows the sku of the
+    CreateBatch the dispatcher sent for that batch, or else of the batch
+    as looked up through session_factory, or failing both goes wherever
+    its reference hashes to. Commands for several skus, like
+    AllocateMany, take turns between the workers. Either way the product
+    version check still catches the odd conflict, and the worker's bus
+    retries it.
+
+    If a worker can't make its bus, or dies, every command waiting on it
+    fails with WorkerFailed, or with the exception bus_factory raised, as
+    does anything dispatched to it afterwards.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        bus_factory: Callable = bootstrap.bootstrap,
+        session_factory: sessionmaker = unit_of_work.DEFAULT_SESSION_FACTORY,
+    ):
+        context = multiprocessing.get_context("spawn")
+        self.session_factory = session_factory
+        self.batchref_skus = LeastRecentlyUsed(BATCHREF_CACHE_SIZE)
+        # per worker, the futures of the commands it hasn't answered yet
+        self._futures = [{} for _ in range(workers)]  # type: List[Dict[int, Future]]
+        self._failures = {}  # type: Dict[int, Exception]
+        self._exited = set()  # type: Set[int]
+        self._ids = itertools.count()
+        self._round_robin = itertools.cycle(range(workers))
+        self._lock = threading.Lock()
+        self._results = context.Queue()
+        self._queues = [context.Queue() for _ in range(workers)]
+        self._processes = [
+            context.Process(
+                target=work,
+                args=(bus_factory, n, queue, self._results),
+                name=f"allocation-worker-{n}",
+                daemon=True,
+            )
+            for n, queue in enumerate(self._queues)
+        ]
+        for process in self._processes:
+            process.start()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def __enter__(self) -> Dispatcher:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def dispatch(self, command: commands.Command) -> Future:
+        """
+        Queues `command` on its worker. The future's result is None once
+        the command has been handled, or its exception if it failed.
+        """
+        future = Future()  # type: Future
+        worker = self.worker_for(command)
+        with self._lock:
+            request_id = next(self._ids)
+            failure = self._failures.get(worker)
+            if failure is None:
+                self._futures[worker][request_id] = future
+        if failure is not None:
+            future.set_exception(failure)
+            return future
+        self._queues[worker].put((request_id, command))
+        return future
+
+    def handle(self, command: commands.Command):
+        """dispatch() and wait, raising whatever the command raised."""
+        return self.dispatch(command).result()
+
+    def worker_for(self, command: commands.Command) -> int:
+        if isinstance(command, commands.CreateBatch):
+            self.batchref_skus.put(command.ref, command.sku)
+        if isinstance(command, commands.ChangeBatchQuantity):
+            key = self.sku_of_batch(command.ref) or command.ref
+        else:
+            key = getattr(command, "sku", None)
+        if key is None:
+            return next(self._round_robin)
+        return zlib.crc32(key.encode()) % len(self._queues)
+
+    def sku_of_batch(self, batchref: str) -> Optional[str]:
+        sku = self.batchref_skus.get(batchref)
+        if sku is not None:
+            return sku
+        try:
+            with self.session_factory() as session:
+                skus = repository.SqlAlchemyRepository(session).skus_for_batchrefs(
+                    [batchref]
+                )
+        except Exception:
+            logger.exception("Exception looking up the sku of batch %s", batchref)
+            return None
+        sku = skus.get(batchref)
+        if sku is not None:
+            self.batchref_skus.put(batchref, sku)
+        return sku
+
+    def close(self):
+        """Waits for the workers to finish what they've been given."""
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join()
+        self._results.put(None)
+        self._collector.join()
+        # anything still waiting went to a worker that stopped early
+        for worker, process in enumerate(self._processes):
+            self._fail_worker(
+                worker, WorkerFailed(f"worker {worker} exited with {process.exitcode}")
+            )
+
+    def _collect(self):
+        while True:
+            try:
+                result = self._results.get(timeout=WORKER_CHECK_SECONDS)
+            except Empty:
+                self._check_workers()
+                continue
+            if result is None:
+                return
+            worker, request_id, error = result
+            if request_id is None:
+                self._fail_worker(worker, error)
+                continue
+            with self._lock:
+                future = self._futures[worker].pop(request_id)
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def _check_workers(self):
+        # a worker seen to have exited at the last check had put everything
+        # it ever would on the results queue before this wait on it began,
+        # and that came back empty: whatever it still owes isn't coming
+        for worker in self._exited:
+            self._fail_worker(
+                worker,
+                WorkerFailed(
+                    f"worker {worker} exited with {self._processes[worker].exitcode}"
+                ),
+            )
+        self._exited = {
+            worker
+            for worker, process in enumerate(self._processes)
+            if process.exitcode is not None
+        }
+
+    def _fail_worker(self, worker: int, error: Exception):
+        with self._lock:
+            self._failures.setdefault(worker, error)
+            futures = list(self._futures[worker].values())
+            self._futures[worker].clear()
+        for future in futures:
+            future.set_exception(error)
+
+
+class LeastRecentlyUsed:
+    """A thread-safe mapping that forgets the least recently used keys."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items = OrderedDict()  # type: OrderedDict[str, str]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+def work(bus_factory: Callable, worker: int, queue, results):
+    try:
+        bus = bus_factory()  # type: messagebus.MessageBus
+    except Exception as e:
+        results.put((worker, None, picklable(e)))
+        raise
+    try:
+        while True:
+            batch = [queue.get()]
+            while batch[-1] is not None and len(batch) < WORKER_BATCH_SIZE:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+            stopping = batch[-1] is None
+            requests = batch[:-1] if stopping else batch
+            if requests:
+                errors = bus.handle_many(command for _, command in requests)
+                for (request_id, _), error in zip(requests, errors):
+                    results.put((worker, request_id, picklable(error)))
+            if stopping:
+                return
+    finally:
+        bus.close()
+
+
+def picklable(error: Optional[Exception]) -> Optional[Exception]:
+    # the result goes back through a pipe; an exception that can't make
+    # the trip is replaced with one that says what it was
+    if error is None:
+        return None
+    try:
+        pickle.loads(pickle.dumps(error))
+    except Exception:
+        return RuntimeError(repr(error))
+    return error
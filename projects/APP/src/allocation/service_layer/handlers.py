@@ -1,7 +1,7 @@
 # pylint: disable=unused-argument
 from __future__ import annotations
 
-from dataclasses import asdict
+from collections import defaultdict
 from typing import TYPE_CHECKING, Callable, Dict, List, Type
 
 from allocation.domain import commands, events, model
@@ -17,6 +17,24 @@ class InvalidSku(Exception):
     pass
 
 
+def independent(handler: Callable) -> Callable:
+    """
+    Marks an event handler that doesn't use the unit of work, so the
+    message bus may run it on a thread of its own alongside the others.
+    """
+    handler.independent = True
+    return handler
+
+
+def deferred(handler: Callable) -> Callable:
+    """
+    Marks an event handler for a side effect nothing else waits on, so
+    the message bus may leave it to its background workers and return.
+    """
+    handler.deferred = True
+    return handler
+
+
 def add_batch(
     cmd: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -26,7 +44,7 @@ def add_batch(
         if product is None:
             product = model.Product(cmd.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        product.add_batch(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
         uow.commit()
 
 
@@ -36,50 +54,57 @@ def allocate(
 ):
     line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
     with uow:
-        product = uow.products.get(sku=line.sku)
+        product = uow.products.get(sku=line.sku, in_stock_only=True)
         if product is None:
             raise InvalidSku(f"Invalid sku {line.sku}")
         product.allocate(line)
         uow.commit()
 
 
-def reallocate(
-    event: events.Deallocated,
+def allocate_many(
+    cmd: commands.AllocateMany,
     uow: unit_of_work.AbstractUnitOfWork,
 ):
-    allocate(commands.Allocate(**asdict(event)), uow=uow)
+    lines_by_sku = defaultdict(list)  # type: Dict[str, List[OrderLine]]
+    for line in cmd.lines:
+        lines_by_sku[line.sku].append(OrderLine(line.orderid, line.sku, line.qty))
+    with uow:
+        products = uow.products.get_many(lines_by_sku, in_stock_only=True)
+        invalid = [sku for sku in lines_by_sku if sku not in products]
+        if invalid:
+            raise InvalidSku(f"Invalid sku {', '.join(invalid)}")
+        for sku, lines in lines_by_sku.items():
+            products[sku].allocate_many(lines)
+        uow.commit()
 
 
 def change_batch_quantity(
     cmd: commands.ChangeBatchQuantity,
     uow: unit_of_work.AbstractUnitOfWork,
+    eviction_policy: model.EvictionPolicy = None,
 ):
     with uow:
         product = uow.products.get_by_batchref(batchref=cmd.ref)
-        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
+        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty, evict=eviction_policy)
         uow.commit()
 
 
 # pylint: disable=unused-argument
 
 
+@deferred
+@independent
 def send_out_of_stock_notification(
     event: events.OutOfStock,
     notifications: notifications.AbstractNotifications,
 ):
-    notifications.send(
+    # returned so an async bus can await an async adapter's send
+    return notifications.send(
         "stock@made.com",
         f"Out of stock for {event.sku}",
     )
 
 
-def publish_allocated_event(
-    event: events.Allocated,
-    publish: Callable,
-):
-    publish("line_allocated", event)
-
-
 def add_allocation_to_read_model(
     event: events.Allocated,
     uow: unit_of_work.SqlAlchemyUnitOfWork,
@@ -111,13 +136,14 @@ def remove_allocation_from_read_model(
 
 
 EVENT_HANDLERS = {
-    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
-    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.Allocated: [add_allocation_to_read_model],
+    events.Deallocated: [remove_allocation_from_read_model],
     events.OutOfStock: [send_out_of_stock_notification],
 }  # type: Dict[Type[events.Event], List[Callable]]
 
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
@@ -1,18 +1,77 @@
 # pylint: disable=broad-except, attribute-defined-outside-init
 from __future__ import annotations
 
+import atexit
+import inspect
 import logging
-from typing import TYPE_CHECKING, Callable, Dict, List, Type, Union
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
+from allocation.adapters import metrics
 from allocation.domain import commands, events
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    before_sleep_log,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from . import deferred, unit_of_work
 
 if TYPE_CHECKING:
-    from . import unit_of_work
+    from allocation.adapters import query_stats
 
 logger = logging.getLogger(__name__)
 
 Message = Union[commands.Command, events.Event]
 
+MESSAGE_SECONDS = metrics.Histogram(
+    "allocation_message_seconds",
+    "Time to handle a message, retries included, by message type.",
+    ["message"],
+)
+HANDLER_SECONDS = metrics.Histogram(
+    "allocation_handler_seconds",
+    "Time spent in one call to a handler, by message type and handler.",
+    ["message", "handler"],
+)
+HANDLER_EXCEPTIONS = metrics.Counter(
+    "allocation_handler_exceptions_total",
+    "Exceptions raised by handlers, by message type, handler and exception.",
+    ["message", "handler", "exception"],
+)
+QUEUE_LENGTH = metrics.Gauge(
+    "allocation_queue_length",
+    "Messages or handler calls waiting, by queue.",
+    ["queue"],
+)
+DEFERRED_LAG = metrics.Gauge(
+    "allocation_deferred_lag_seconds",
+    "How long the oldest waiting deferred handler call has waited.",
+)
+DEFERRED_CALLS = metrics.Counter(
+    "allocation_deferred_calls_total",
+    "Deferred handler calls, by what became of them.",
+    ["outcome"],
+)
+
 
 class MessageBus:
     def __init__(
@@ -20,27 +79,138 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        conflict_attempts: int = 5,
+        max_group_size: int = 100,
+        handler_threads: int = 4,
+        deferred_handlers: Optional[deferred.DeferredHandlers] = None,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.conflict_attempts = conflict_attempts
+        self.max_group_size = max_group_size
+        # independent event handlers run here, everything else on the
+        # calling thread; with no threads, they all run in turn
+        self.executor = None  # type: Optional[ThreadPoolExecutor]
+        if handler_threads:
+            self.executor = ThreadPoolExecutor(
+                handler_threads, thread_name_prefix="event-handler"
+            )
+        self.running = deque()  # type: Deque[Tuple[events.Event, Future]]
+        self.deferred = deferred_handlers
+        self.queue = deque()  # type: Deque[Message]
 
     def handle(self, message: Message):
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                self.handle_command(message)
-            else:
-                raise Exception(f"{message} was not an Event or Command")
+        if self.uow.query_counter is None:
+            self._handle(message)
+            return
+        with self.uow.query_counter.measure() as stats:
+            self._handle(message)
+        log_query_stats(type(message).__name__, stats)
+
+    def handle_many(self, messages: Iterable[Message]) -> List[Optional[Exception]]:
+        """
+        Handles `messages` in order, running each run of consecutive
+        commands for the same sku (up to max_group_size of them) in one
+        shared unit of work: one session, one transaction, one commit. If
+        any command in a run fails, the run is rolled back and its commands
+        handled again one at a time, so a bad command only fails itself.
+        Once a run has committed, each command's events are handled in
+        turn, as handle() would, and an exception there is that command's
+        result: the run isn't handled again.
+        Returns, in order, None for each message handled and the exception
+        for each one that failed; nothing is raised.
+        """
+        messages = list(messages)
+        batchref_skus = self._batchref_skus(batchrefs(messages))
+        results = []  # type: List[Optional[Exception]]
+        for group in runs_by_sku(messages, self.max_group_size, batchref_skus):
+            if len(group) > 1:
+                try:
+                    events_by_command = self._handle_group(group)
+                except Exception:
+                    logger.info(
+                        "handling a run of %d commands one at a time", len(group)
+                    )
+                else:
+                    for command_events in events_by_command:
+                        try:
+                            self.queue = deque(command_events)
+                            self._drain()
+                        except Exception as e:
+                            results.append(e)
+                        else:
+                            results.append(None)
+                    continue
+            for message in group:
+                try:
+                    self.handle(message)
+                except Exception as e:
+                    results.append(e)
+                else:
+                    results.append(None)
+        return results
+
+    def _batchref_skus(self, refs: Set[str]) -> Dict[str, str]:
+        # a command that only names its batch can join the run for that
+        # batch's sku once it's known; if it can't be looked up, it runs alone
+        if not refs:
+            return {}
+        try:
+            with self.uow:
+                return self.uow.products.skus_for_batchrefs(refs)
+        except Exception:
+            logger.exception("Exception looking up the skus of %d batches", len(refs))
+            return {}
+
+    def _handle_group(self, group: List[commands.Command]) -> List[List[Message]]:
+        """Runs and commits `group`, returning the events each command raised."""
+        ends = []
+        with self.uow.shared():
+            for command in group:
+                logger.debug("handling command %s", command)
+                self._run(self.command_handlers[type(command)], command)
+                ends.append(len(self.uow.products.new_events))
+        # only once the run has committed do its events go out
+        return split_at(list(self.uow.collect_new_events()), ends)
+
+    def _handle(self, message: Message):
+        self.queue = deque([message])
+        self._drain()
+
+    def _drain(self):
+        try:
+            while self.queue:
+                message = self.queue.popleft()
+                started = time.perf_counter()
+                try:
+                    if isinstance(message, events.Event):
+                        self.handle_event(message)
+                    elif isinstance(message, commands.Command):
+                        self.handle_command(message)
+                    else:
+                        raise Exception(f"{message} was not an Event or Command")
+                finally:
+                    MESSAGE_SECONDS.observe(
+                        (type(message).__name__,), time.perf_counter() - started
+                    )
+        finally:
+            self._wait_for_independent_handlers()
 
     def handle_event(self, event: events.Event):
         for handler in self.event_handlers[type(event)]:
+            if self.deferred is not None and getattr(handler, "deferred", False):
+                self.deferred.submit(handler, event)
+                continue
+            if self.executor is not None and getattr(handler, "independent", False):
+                # it can't touch the unit of work, so it can't raise new
+                # events: the queue's order stays the same however it runs
+                future = self.executor.submit(timed, handler, event)
+                self.running.append((event, future))
+                continue
             try:
                 logger.debug("handling event %s with handler %s", event, handler)
-                handler(event)
+                self._run(handler, event)
                 self.queue.extend(self.uow.collect_new_events())
             except Exception:
                 logger.exception("Exception handling event %s", event)
@@ -50,8 +220,243 @@ class MessageBus:
         logger.debug("handling command %s", command)
         try:
             handler = self.command_handlers[type(command)]
-            handler(command)
+            # a conflicting commit rolled back everything the handler did,
+            # so running it again against fresh state is safe
+            for attempt in Retrying(
+                retry=retry_if_exception_type(unit_of_work.ConcurrencyConflict),
+                stop=stop_after_attempt(self.conflict_attempts),
+                wait=wait_random_exponential(multiplier=0.005, max=0.5),
+                before_sleep=before_sleep_log(logger, logging.INFO),
+                reraise=True,
+            ):
+                with attempt:
+                    self._run(handler, command)
             self.queue.extend(self.uow.collect_new_events())
         except Exception:
             logger.exception("Exception handling command %s", command)
             raise
+
+    def close(self):
+        """Finishes any deferred handlers still waiting, then stops the threads."""
+        atexit.unregister(self.close)  # bootstrap() registers it for exit
+        if self.deferred is not None:
+            self.deferred.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def _wait_for_independent_handlers(self):
+        while self.running:
+            event, future = self.running.popleft()
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Exception handling event %s", event)
+
+    def _run(self, handler: Callable, message: Message):
+        if self.uow.query_counter is None:
+            timed(handler, message)
+            return
+        with self.uow.query_counter.measure() as stats:
+            timed(handler, message)
+        log_query_stats(type(message).__name__, stats, handler=handler)
+
+
+class AsyncMessageBus(MessageBus):
+    """
+    MessageBus for an AsyncSqlAlchemyUnitOfWork, running the same handlers
+    through its run_sync(). A handler that returns an awaitable, such as
+    one calling an async notifications adapter, has it awaited. Each
+    handle() keeps its own queue, so many can run at once.
+    """
+
+    uow: unit_of_work.AsyncSqlAlchemyUnitOfWork
+
+    async def handle(self, message: Message):
+        await self._drain(deque([message]))
+
+    async def handle_many(
+        self, messages: Iterable[Message]
+    ) -> List[Optional[Exception]]:
+        """MessageBus.handle_many(), awaited."""
+        messages = list(messages)
+        refs = batchrefs(messages)
+        batchref_skus = (
+            await self.uow.run_sync(self._batchref_skus, refs) if refs else {}
+        )
+        results = []  # type: List[Optional[Exception]]
+        for group in runs_by_sku(messages, self.max_group_size, batchref_skus):
+            if len(group) > 1:
+                try:
+                    handled = await self.uow.run_sync(self._run_group, group)
+                except Exception:
+                    logger.info(
+                        "handling a run of %d commands one at a time", len(group)
+                    )
+                else:
+                    for awaitable, command_events in handled:
+                        try:
+                            if awaitable is not None:
+                                await awaitable
+                            await self._drain(deque(command_events))
+                        except Exception as e:
+                            results.append(e)
+                        else:
+                            results.append(None)
+                    continue
+            for message in group:
+                try:
+                    await self.handle(message)
+                except Exception as e:
+                    results.append(e)
+                else:
+                    results.append(None)
+        return results
+
+    def _run_group(self, group: List[commands.Command]):
+        # for each command, what its handler left to await and its events
+        awaitables, ends = [], []
+        with self.uow.shared():
+            for command in group:
+                logger.debug("handling command %s", command)
+                result = timed(self.command_handlers[type(command)], command)
+                awaitables.append(result if inspect.isawaitable(result) else None)
+                ends.append(len(self.uow.products.new_events))
+        new_events = split_at(list(self.uow.collect_new_events()), ends)
+        return list(zip(awaitables, new_events))
+
+    async def _drain(self, queue: Deque[Message]):
+        while queue:
+            message = queue.popleft()
+            if isinstance(message, events.Event):
+                await self.handle_event(message, queue)
+            elif isinstance(message, commands.Command):
+                await self.handle_command(message, queue)
+            else:
+                raise Exception(f"{message} was not an Event or Command")
+
+    async def handle_event(self, event: events.Event, queue: Deque[Message]):
+        for handler in self.event_handlers[type(event)]:
+            try:
+                logger.debug("handling event %s with handler %s", event, handler)
+                queue.extend(await self._run_async(handler, event))
+            except Exception:
+                logger.exception("Exception handling event %s", event)
+                continue
+
+    async def handle_command(self, command: commands.Command, queue: Deque[Message]):
+        logger.debug("handling command %s", command)
+        try:
+            handler = self.command_handlers[type(command)]
+            async for attempt in AsyncRetrying(
+                retry=retry_if_exception_type(unit_of_work.ConcurrencyConflict),
+                stop=stop_after_attempt(self.conflict_attempts),
+                wait=wait_random_exponential(multiplier=0.005, max=0.5),
+                before_sleep=before_sleep_log(logger, logging.INFO),
+                reraise=True,
+            ):
+                with attempt:
+                    new_events = await self._run_async(handler, command)
+            queue.extend(new_events)
+        except Exception:
+            logger.exception("Exception handling command %s", command)
+            raise
+
+    async def _run_async(self, handler: Callable, message: Message) -> List[Message]:
+        result, new_events = await self.uow.run_sync(
+            self._run_and_collect, handler, message
+        )
+        if inspect.isawaitable(result):
+            await result
+        return new_events
+
+    def _run_and_collect(self, handler: Callable, message: Message):
+        # collected inside run_sync, while this message's session is current
+        return timed(handler, message), list(self.uow.collect_new_events())
+
+
+def timed(handler: Callable, message: Message):
+    """Calls handler(message), recording how long it took and what it raised."""
+    name = getattr(handler, "__name__", None) or repr(handler)
+    labels = (type(message).__name__, name)
+    started = time.perf_counter()
+    try:
+        return handler(message)
+    except Exception as e:
+        HANDLER_EXCEPTIONS.inc(labels + (type(e).__name__,))
+        raise
+    finally:
+        HANDLER_SECONDS.observe(labels, time.perf_counter() - started)
+
+
+def export_queue_metrics(bus: MessageBus):
+    """Has the queue metrics report on `bus` when they're scraped."""
+    QUEUE_LENGTH.set_function(lambda: len(bus.queue), ("messages",))
+    QUEUE_LENGTH.set_function(lambda: len(bus.running), ("independent_handlers",))
+    if bus.deferred is None:
+        return
+    QUEUE_LENGTH.set_function(
+        lambda: bus.deferred.metrics().depth, ("deferred_handlers",)
+    )
+    DEFERRED_LAG.set_function(lambda: bus.deferred.metrics().lag)
+
+    def deferred_calls(outcome):
+        return lambda: getattr(bus.deferred.metrics(), outcome)
+
+    for outcome in ("handled", "failed", "dropped", "spilled"):
+        DEFERRED_CALLS.set_function(deferred_calls(outcome), (outcome,))
+
+
+def split_at(items: List, ends: List[int]) -> List[List]:
+    """Cuts `items` into consecutive slices, each ending at the next of `ends`."""
+    return [items[start:end] for start, end in zip([0] + ends, ends)]
+
+
+def batchrefs(messages: Iterable[Message]) -> Set[str]:
+    """The batches named by commands that don't say which sku they're for."""
+    return {m.ref for m in messages if isinstance(m, commands.ChangeBatchQuantity)}
+
+
+def runs_by_sku(
+    messages: Iterable[Message],
+    max_size: int,
+    batchref_skus: Optional[Dict[str, str]] = None,
+) -> Iterator[List[Message]]:
+    """
+    Splits `messages` into runs of consecutive commands for the same sku,
+    taking the sku of a ChangeBatchQuantity from `batchref_skus`. Events,
+    and commands without a known sku, come out in runs of their own.
+    """
+    batchref_skus = batchref_skus or {}
+    run, run_sku = [], None  # type: List[Message], Optional[str]
+    for message in messages:
+        sku = None
+        if isinstance(message, commands.ChangeBatchQuantity):
+            sku = batchref_skus.get(message.ref)
+        elif isinstance(message, commands.Command):
+            sku = getattr(message, "sku", None)
+        if run and (sku is None or sku != run_sku or len(run) >= max_size):
+            yield run
+            run = []
+        run.append(message)
+        run_sku = sku
+    if run:
+        yield run
+
+
+def log_query_stats(message_type: str, stats: query_stats.QueryStats, handler=None):
+    handler_name = getattr(handler, "__name__", None)
+    logger.info(
+        "queries for %s%s: %d statements, %d rows, %.2fms",
+        message_type,
+        f" in {handler_name}" if handler_name else "",
+        stats.statements,
+        stats.rows,
+        stats.db_time * 1000,
+        extra={
+            "message_type": message_type,
+            "handler": handler_name,
+            "statements": stats.statements,
+            "rows": stats.rows,
+            "db_time": stats.db_time,
+        },
+    )
@@ -2,30 +2,59 @@
 from __future__ import annotations
 
 import abc
-
-from allocation import config
-from allocation.adapters import repository
-from sqlalchemy import create_engine
+import itertools
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict
+from typing import Callable, Dict, Optional, Type
+
+from allocation.adapters import engines, orm, query_stats, repository
+from allocation.domain import events
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm.session import Session
 
 
+class ConcurrencyConflict(Exception):
+    """Another unit of work committed a change to the same product first."""
+
+
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
+    query_counter = None  # type: Optional[query_stats.QueryCounter]
+    _sharing = False
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
 
     def __exit__(self, *args):
-        self.rollback()
+        if not self._sharing:
+            self.rollback()
 
     def commit(self):
-        self._commit()
+        if not self._sharing:
+            self._commit()
+
+    @contextmanager
+    def shared(self):
+        """
+        Makes every `with uow:` block inside part of one unit of work: they
+        all see the same products, their commits do nothing, and the whole
+        lot is committed once at the end, or rolled back if anything raised.
+        """
+        with self:
+            self._sharing = True
+            try:
+                yield self
+            finally:
+                self._sharing = False
+            self.commit()
 
     def collect_new_events(self):
-        for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+        new_events = self.products.new_events
+        while new_events:
+            yield new_events.popleft()
 
     @abc.abstractmethod
     def _commit(self):
@@ -36,32 +65,143 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        # substituting POSTGRES with the in-memory sqlite
-        # config.get_postgres_uri(),
-        "sqlite+pysqlite:///:memory:",
-        echo=True,
-        isolation_level="REPEATABLE READ",
-    )
-)
+# events other services hear about, and the channel each goes out on
+OUTBOX_CHANNELS = {
+    events.Allocated: "line_allocated",
+}  # type: Dict[Type[events.Event], str]
+
+
+DEFAULT_SESSION_FACTORY = sessionmaker(bind=engines.create_engine())
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    # how many of the events at the front of products.new_events are
+    # already in the outbox
+    _in_outbox = 0
+
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        count_queries=False,
+        bulk_flush=True,
+    ):
         self.session_factory = session_factory
+        self.bulk_flush = bulk_flush
+        self.batchref_skus = {}  # type: Dict[str, str]
+        if count_queries:
+            self.query_counter = query_stats.QueryCounter(session_factory.kw["bind"])
 
     def __enter__(self):
-        self.session = self.session_factory()  # type: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        if self._sharing:
+            return self
+        self.session = self._open_session()  # type: Session
+        self._in_outbox = 0
+        self.products = repository.SqlAlchemyRepository(
+            self.session, batchref_skus=self.batchref_skus
+        )
         return super().__enter__()
 
     def __exit__(self, *args):
+        if self._sharing:
+            return  # shared() closes the session
         super().__exit__(*args)
+        self._close_session()
+
+    def collect_new_events(self):
+        for event in super().collect_new_events():
+            if self._in_outbox:
+                self._in_outbox -= 1
+            yield event
+
+    def _open_session(self) -> Session:
+        return self.session_factory()
+
+    def _close_session(self):
         self.session.close()
 
     def _commit(self):
-        self.session.commit()
+        try:
+            if self.bulk_flush:
+                orm.flush_allocations_in_bulk(self.session, self.products.seen)
+            self._write_outbox()
+            self.session.commit()
+        except StaleDataError as e:
+            raise ConcurrencyConflict(str(e)) from e
+
+    def _write_outbox(self):
+        # events stay queued for the message bus; only the ones after those
+        # already written go in, so a second commit in the same unit of
+        # work doesn't repeat them
+        new_events = self.products.new_events
+        rows = []
+        for event in itertools.islice(new_events, self._in_outbox, None):
+            channel = OUTBOX_CHANNELS.get(type(event))
+            if channel is not None:
+                rows.append(
+                    dict(
+                        channel=channel,
+                        sku=getattr(event, "sku", None),
+                        payload=json.dumps(asdict(event)),
+                    )
+                )
+        self._in_outbox = len(new_events)
+        if rows:
+            self.session.execute(orm.outbox.insert(), rows)
 
     def rollback(self):
         self.session.rollback()
+
+
+class AsyncSqlAlchemyUnitOfWork(SqlAlchemyUnitOfWork):
+    """
+    SqlAlchemyUnitOfWork on an AsyncSession, for the AsyncMessageBus.
+    Handlers stay the same synchronous functions: run_sync() calls them in
+    SQLAlchemy's greenlet, where each database round trip is awaited on
+    the event loop, so other messages make progress in the meantime.
+    Everything a `with uow:` block opens, and whether it's shared(), lives
+    in a context variable, so messages handled concurrently each see their
+    own session.
+    """
+
+    def __init__(self, session_factory, bulk_flush=True):
+        super().__init__(session_factory, bulk_flush=bulk_flush)
+        self._state = ContextVar(f"uow-{id(self)}")  # type: ContextVar[dict]
+
+    async def run_sync(self, fn: Callable, *args):
+        async with self.session_factory() as async_session:
+            return await async_session.run_sync(self._call, fn, args)
+
+    def _call(self, sync_session: Session, fn: Callable, args: tuple):
+        token = self._state.set(dict(sync_session=sync_session))
+        try:
+            return fn(*args)
+        finally:
+            self._state.reset(token)
+
+    def collect_new_events(self):
+        if "products" not in self._state.get():
+            return iter(())  # the handler never opened the unit of work
+        return super().collect_new_events()
+
+    def _open_session(self) -> Session:
+        return self._state.get()["sync_session"]
+
+    def _close_session(self):
+        pass  # run_sync's AsyncSession closes it
+
+    session = property(
+        lambda self: self._state.get()["session"],
+        lambda self, value: self._state.get().update(session=value),
+    )
+    products = property(
+        lambda self: self._state.get()["products"],
+        lambda self, value: self._state.get().update(products=value),
+    )
+    _in_outbox = property(
+        lambda self: self._state.get()["in_outbox"],
+        lambda self, value: self._state.get().update(in_outbox=value),
+    )
+    _sharing = property(
+        lambda self: self._state.get().get("sharing", False),
+        lambda self, value: self._state.get().update(sharing=value),
+    )
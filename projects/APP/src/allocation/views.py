@@ -1,12 +1,41 @@
+from typing import List
+
+from allocation import config
+from allocation.adapters import engines
 from allocation.service_layer import unit_of_work
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+ALLOCATIONS = text("""
+    SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid
+    """)
 
 
 def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
     with uow:
-        results = uow.session.execute(
-            """
-            SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid
-            """,
-            dict(orderid=orderid),
-        )
-    return [dict(r) for r in results]
+        results = uow.session.execute(ALLOCATIONS, dict(orderid=orderid))
+        # read them before the connection goes back to the pool
+        return [dict(r) for r in results]
+
+
+class ReadOnlyQueries:
+    """
+    The views, run straight on a connection from a read engine: no
+    session, no unit of work, and nothing to commit or roll back.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    def allocations(self, orderid: str) -> List[dict]:
+        with self.engine.connect() as connection:
+            results = connection.execute(ALLOCATIONS, dict(orderid=orderid))
+            return [dict(r._mapping) for r in results]
+
+
+def read_only_queries(uow: unit_of_work.SqlAlchemyUnitOfWork) -> ReadOnlyQueries:
+    if config.get_read_database_uri() is None:
+        # nothing separate to read from (an in-memory database can't be
+        # opened twice), so borrow the write engine's pool
+        return ReadOnlyQueries(uow.session_factory.kw["bind"])
+    return ReadOnlyQueries(engines.create_read_engine())
@@ -9,6 +9,7 @@ import redis
 import requests
 from allocation import config
 from allocation.adapters.orm import metadata, start_mappers
+from allocation.adapters.query_stats import QueryCounter
 from sqlalchemy import create_engine
 from sqlalchemy.orm import clear_mappers, sessionmaker
 from tenacity import retry, stop_after_delay
@@ -16,6 +17,36 @@ from tenacity import retry, stop_after_delay
 pytest.register_assert_rewrite("tests.e2e.api_client")
 
 
+def pytest_addoption(parser):
+    group = parser.getgroup("perf", "benchmarks in tests/perf")
+    group.addoption("--perf", action="store_true", help="run the benchmarks")
+    group.addoption(
+        "--perf-save", metavar="PATH", help="write benchmark timings to a JSON file"
+    )
+    group.addoption(
+        "--perf-baseline",
+        metavar="PATH",
+        help="fail benchmarks that are slower than in this JSON file",
+    )
+    group.addoption(
+        "--perf-threshold",
+        type=float,
+        default=0.25,
+        help="slowdown against the baseline that counts as a regression",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if any(
+        config.getoption(name) for name in ("--perf", "--perf-save", "--perf-baseline")
+    ):
+        return
+    skip_perf = pytest.mark.skip(reason="benchmark, run with --perf")
+    for item in items:
+        if "perf" in item.keywords:
+            item.add_marker(skip_perf)
+
+
 @pytest.fixture
 def in_memory_sqlite_db():
     engine = create_engine("sqlite:///:memory:")
@@ -28,6 +59,13 @@ def sqlite_session_factory(in_memory_sqlite_db):
     yield sessionmaker(bind=in_memory_sqlite_db)
 
 
+@pytest.fixture
+def query_counter(in_memory_sqlite_db):
+    counter = QueryCounter(in_memory_sqlite_db)
+    yield counter
+    counter.remove()
+
+
 @pytest.fixture
 def mappers():
     start_mappers()
@@ -40,3 +40,51 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("in_memory_sqlite_db")
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_allocate_returns_202_and_lines_are_allocated():
+    order1, order2 = random_orderid(1), random_orderid(2)
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_add_batch(otherbatch, othersku, 100, None)
+
+    r = api_client.post_to_allocate_many(
+        [
+            {"orderid": order1, "sku": sku, "qty": 3},
+            {"orderid": order1, "sku": othersku, "qty": 3},
+            {"orderid": order2, "sku": sku, "qty": 3},
+        ]
+    )
+    assert r.status_code == 202
+
+    r = api_client.get_allocation(order1)
+    assert r.ok
+    assert r.json() == [
+        {"sku": sku, "batchref": batch},
+        {"sku": othersku, "batchref": otherbatch},
+    ]
+
+
+@pytest.mark.usefixtures("in_memory_sqlite_db")
+@pytest.mark.usefixtures("restart_api")
+def test_metrics_report_handler_latency_and_errors():
+    sku, orderid = random_sku(), random_orderid()
+    api_client.post_to_add_batch(random_batchref(), sku, 100, None)
+    api_client.post_to_allocate(orderid, sku, qty=3)
+    api_client.post_to_allocate(orderid, random_sku(), qty=3, expect_success=False)
+
+    r = api_client.get_metrics()
+    assert r.ok
+    assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert (
+        'allocation_handler_seconds_count{message="Allocate",handler="allocate"}'
+        in r.text
+    )
+    assert (
+        "allocation_handler_exceptions_total"
+        '{message="Allocate",handler="allocate",exception="InvalidSku"}' in r.text
+    )
+    assert 'allocation_queue_length{queue="messages"} 0' in r.text
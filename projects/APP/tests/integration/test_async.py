@@ -0,0 +1,200 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import time
+from collections import defaultdict
+from datetime import date
+
+import pytest
+from allocation import bootstrap, views
+from allocation.adapters import engines, notifications
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, messagebus, unit_of_work
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+
+class SlowAsyncNotifications(notifications.AbstractNotifications):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.sent = defaultdict(list)
+
+    async def send(self, destination, message):
+        await asyncio.sleep(self.delay)
+        self.sent[destination].append(message)
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    path = tmp_path / "allocation.db"
+    engine = create_engine(f"sqlite:///{path}")
+    metadata.create_all(engine)
+    engine.dispose()
+    return path
+
+
+def make_bus(database_path, notifications_adapter=None):
+    engine = engines.create_async_engine(f"sqlite+aiosqlite:///{database_path}")
+    return bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.AsyncSqlAlchemyUnitOfWork(
+            sessionmaker(bind=engine, class_=AsyncSession)
+        ),
+        notifications=notifications_adapter or SlowAsyncNotifications(),
+    )
+
+
+@pytest.fixture
+def async_bus(database_path):
+    bus = make_bus(database_path)
+    yield bus
+    bus.close()
+    clear_mappers()
+
+
+def read_view(database_path, orderid):
+    engine = create_engine(f"sqlite:///{database_path}")
+    try:
+        return views.ReadOnlyQueries(engine).allocations(orderid)
+    finally:
+        engine.dispose()
+
+
+def test_bootstrap_gives_an_async_bus(async_bus):
+    assert isinstance(async_bus, messagebus.AsyncMessageBus)
+    assert async_bus.executor is None
+
+
+def test_allocates_and_updates_the_view(async_bus, database_path):
+    async def scenario():
+        await async_bus.handle(commands.CreateBatch("now", "ASYNC-LAMP", 20, None))
+        await async_bus.handle(
+            commands.CreateBatch("later", "ASYNC-LAMP", 20, date.today())
+        )
+        await async_bus.handle(commands.Allocate("o1", "ASYNC-LAMP", 15))
+        await async_bus.handle(commands.ChangeBatchQuantity("now", 5))
+
+    asyncio.run(scenario())
+
+    assert read_view(database_path, "o1") == [
+        {"sku": "ASYNC-LAMP", "batchref": "later"}
+    ]
+
+
+def test_errors_for_invalid_sku(async_bus):
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku NOPE"):
+        asyncio.run(async_bus.handle(commands.Allocate("o1", "NOPE", 10)))
+
+
+def test_awaits_async_notifications(database_path):
+    fake_notifs = SlowAsyncNotifications()
+    bus = make_bus(database_path, fake_notifs)
+    try:
+
+        async def scenario():
+            await bus.handle(commands.CreateBatch("b1", "RARE-RUG", 9, None))
+            await bus.handle(commands.Allocate("o1", "RARE-RUG", 10))
+
+        asyncio.run(scenario())
+    finally:
+        bus.close()
+        clear_mappers()
+
+    assert fake_notifs.sent["stock@made.com"] == ["Out of stock for RARE-RUG"]
+
+
+def test_handles_messages_concurrently(database_path):
+    fake_notifs = SlowAsyncNotifications(delay=0.2)
+    bus = make_bus(database_path, fake_notifs)
+    try:
+
+        async def scenario():
+            await bus.handle(commands.CreateBatch("b1", "SOLD-OUT-SOFA", 1, None))
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(
+                    bus.handle(commands.Allocate(f"o{i}", "SOLD-OUT-SOFA", 10))
+                    for i in range(10)
+                )
+            )
+            return time.perf_counter() - started
+
+        elapsed = asyncio.run(scenario())
+    finally:
+        bus.close()
+        clear_mappers()
+
+    assert len(fake_notifs.sent["stock@made.com"]) == 10
+    assert elapsed < 10 * 0.2 / 2  # one at a time would take 2s
+
+
+def test_handle_many_runs_the_commands_and_reports_each_one(async_bus, database_path):
+    async def scenario():
+        await async_bus.handle(commands.CreateBatch("b1", "ASYNC-DESK", 100, None))
+        return await async_bus.handle_many(
+            [
+                commands.Allocate("o1", "ASYNC-DESK", 10),
+                commands.Allocate("o2", "ASYNC-DESK", 10),
+                commands.Allocate("o3", "NO-SUCH-DESK", 10),
+                commands.Allocate("o4", "ASYNC-DESK", 10),
+                commands.Allocate("o5", "ASYNC-DESK", 10),
+            ]
+        )
+
+    results = asyncio.run(scenario())
+
+    assert results[:2] == [None, None] and results[3:] == [None, None]
+    assert isinstance(results[2], handlers.InvalidSku)
+    for orderid in ("o1", "o2", "o4", "o5"):
+        assert read_view(database_path, orderid) == [
+            {"sku": "ASYNC-DESK", "batchref": "b1"}
+        ]
+
+
+def test_a_command_that_fails_in_a_run_fails_alone(async_bus, database_path):
+    allocate = async_bus.command_handlers[commands.Allocate]
+
+    def allocate_unless_bad(cmd):
+        if cmd.orderid == "bad":
+            raise ValueError("bad order")
+        allocate(cmd)
+
+    async_bus.command_handlers[commands.Allocate] = allocate_unless_bad
+
+    async def scenario():
+        await async_bus.handle(commands.CreateBatch("b1", "ASYNC-SHELF", 100, None))
+        return await async_bus.handle_many(
+            [
+                commands.Allocate("o1", "ASYNC-SHELF", 10),
+                commands.Allocate("bad", "ASYNC-SHELF", 10),
+                commands.Allocate("o3", "ASYNC-SHELF", 10),
+            ]
+        )
+
+    results = asyncio.run(scenario())
+
+    assert [type(result) for result in results] == [type(None), ValueError, type(None)]
+    assert read_view(database_path, "o1") == [{"sku": "ASYNC-SHELF", "batchref": "b1"}]
+    assert read_view(database_path, "o3") == [{"sku": "ASYNC-SHELF", "batchref": "b1"}]
+
+
+def test_an_error_handling_a_committed_runs_events_isnt_a_rerun(
+    async_bus, database_path
+):
+    del async_bus.event_handlers[events.OutOfStock]  # handling one raises KeyError
+
+    async def scenario():
+        await async_bus.handle(commands.CreateBatch("b1", "ASYNC-STOOL", 100, None))
+        return await async_bus.handle_many(
+            [
+                commands.Allocate("o1", "ASYNC-STOOL", 10),
+                commands.Allocate("o2", "ASYNC-STOOL", 1_000),
+            ]
+        )
+
+    ok, error = asyncio.run(scenario())
+
+    assert ok is None
+    assert isinstance(error, KeyError)
+    assert read_view(database_path, "o1") == [{"sku": "ASYNC-STOOL", "batchref": "b1"}]
@@ -0,0 +1,139 @@
+# pylint: disable=redefined-outer-name
+import functools
+import os
+from unittest import mock
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import engines, orm
+from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+from allocation.service_layer.dispatcher import (
+    Dispatcher,
+    LeastRecentlyUsed,
+    WorkerFailed,
+)
+from sqlalchemy.orm import sessionmaker
+
+
+def make_bus(uri):
+    # runs in the worker process, which starts with nothing mapped
+    return bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(
+            sessionmaker(bind=engines.create_engine(uri))
+        ),
+        notifications=mock.Mock(),
+    )
+
+
+def fail_to_make_a_bus():
+    raise RuntimeError("no database today")
+
+
+class DyingBus:
+    def handle_many(self, messages):
+        os._exit(3)  # pylint: disable=protected-access
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def database(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'allocation.db'}"
+    engine = engines.create_engine(uri)
+    orm.metadata.create_all(engine)
+    yield uri, engine
+    engine.dispose()
+
+
+@pytest.fixture
+def dispatcher(database):
+    uri, engine = database
+    with Dispatcher(
+        2, functools.partial(make_bus, uri), sessionmaker(bind=engine)
+    ) as dispatcher:
+        yield dispatcher
+
+
+def test_handles_commands_in_the_workers(database, dispatcher):
+    _, engine = database
+    for sku in ("RED-CHAIR", "BLUE-CHAIR"):
+        dispatcher.handle(commands.CreateBatch(f"batch-{sku}", sku, 100))
+    futures = [
+        dispatcher.dispatch(commands.Allocate(f"o{i}", sku, 10))
+        for i, sku in enumerate(["RED-CHAIR", "BLUE-CHAIR"] * 3)
+    ]
+
+    assert [future.result(timeout=30) for future in futures] == [None] * 6
+    with engine.connect() as connection:
+        rows = connection.execute(
+            "SELECT sku, version_number FROM products ORDER BY sku"
+        ).fetchall()
+    assert rows == [("BLUE-CHAIR", 3), ("RED-CHAIR", 3)]
+
+
+def test_sends_errors_back_to_the_caller(dispatcher):
+    with pytest.raises(handlers.InvalidSku, match="Invalid sku NO-SUCH-CHAIR"):
+        dispatcher.handle(commands.Allocate("o1", "NO-SUCH-CHAIR", 10))
+
+
+def test_keeps_a_sku_and_its_batches_on_one_worker(dispatcher):
+    create = commands.CreateBatch("batch-1", "GREEN-CHAIR", 100)
+    workers = {
+        dispatcher.worker_for(create),
+        dispatcher.worker_for(commands.Allocate("o1", "GREEN-CHAIR", 10)),
+        dispatcher.worker_for(commands.ChangeBatchQuantity("batch-1", 50)),
+    }
+    assert len(workers) == 1
+
+
+def test_looks_up_the_sku_of_a_batch_it_didnt_see_created(database, dispatcher):
+    _, engine = database
+    with engine.begin() as connection:
+        connection.execute(
+            orm.products.insert(), [dict(sku="OLD-CHAIR", version_number=0)]
+        )
+        connection.execute(
+            orm.batches.insert(),
+            [dict(reference="old-batch", sku="OLD-CHAIR", _purchased_quantity=10)],
+        )
+
+    assert dispatcher.worker_for(
+        commands.ChangeBatchQuantity("old-batch", 5)
+    ) == dispatcher.worker_for(commands.Allocate("o1", "OLD-CHAIR", 1))
+    assert dispatcher.batchref_skus.get("old-batch") == "OLD-CHAIR"
+    assert dispatcher.sku_of_batch("no-such-batch") is None
+
+
+def test_remembers_only_the_most_recently_used_batches():
+    skus = LeastRecentlyUsed(2)
+    skus.put("b1", "sku1")
+    skus.put("b2", "sku2")
+    assert skus.get("b1") == "sku1"
+    skus.put("b3", "sku3")
+
+    assert len(skus) == 2
+    assert skus.get("b2") is None
+    assert skus.get("b1") == "sku1" and skus.get("b3") == "sku3"
+
+
+def test_fails_the_commands_of_a_worker_that_cant_make_its_bus():
+    with Dispatcher(1, fail_to_make_a_bus) as dispatcher:
+        future = dispatcher.dispatch(commands.Allocate("o1", "RED-CHAIR", 10))
+        with pytest.raises(RuntimeError, match="no database today"):
+            future.result(timeout=30)
+        with pytest.raises(RuntimeError, match="no database today"):
+            dispatcher.handle(commands.Allocate("o2", "RED-CHAIR", 10))
+
+
+def test_fails_the_commands_of_a_worker_that_dies():
+    with Dispatcher(1, DyingBus) as dispatcher:
+        futures = [
+            dispatcher.dispatch(commands.Allocate(f"o{i}", "RED-CHAIR", 10))
+            for i in range(3)
+        ]
+        for future in futures:
+            with pytest.raises(WorkerFailed, match="exited with 3"):
+                future.result(timeout=30)
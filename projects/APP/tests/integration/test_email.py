@@ -17,7 +17,6 @@
 #         start_orm=True,
 #         uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
 #         notifications=notifications.EmailNotifications(),
-#         publish=lambda *args: None,
 #     )
 #     yield bus
 #     clear_mappers()
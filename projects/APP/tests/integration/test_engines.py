@@ -0,0 +1,42 @@
+from allocation import config
+from allocation.adapters import engines
+from sqlalchemy.pool import QueuePool
+
+
+def pragma(engine, name):
+    with engine.connect() as connection:
+        return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+
+def test_file_sqlite_gets_a_pool_and_the_pragmas(tmp_path):
+    engine = engines.create_engine(
+        f"sqlite:///{tmp_path / 'allocation.db'}", config.ENGINE_PROFILES["prod"]
+    )
+
+    assert isinstance(engine.pool, QueuePool)
+    assert engine.pool.size() == 20
+    assert pragma(engine, "journal_mode") == "wal"
+    assert pragma(engine, "synchronous") == 1  # NORMAL
+    assert pragma(engine, "cache_size") == config.SQLITE_PRAGMAS["cache_size"]
+
+
+def test_in_memory_sqlite_ignores_the_pool_settings():
+    engine = engines.create_engine("sqlite://", config.ENGINE_PROFILES["prod"])
+
+    assert pragma(engine, "cache_size") == config.SQLITE_PRAGMAS["cache_size"]
+
+
+def test_profile_and_echo_come_from_the_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv("DB_PROFILE", "test")
+    monkeypatch.setenv("DB_ECHO", "1")
+
+    engine = engines.create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+
+    assert engine.echo
+    assert engine.pool.size() == 1
+
+
+def test_echo_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("DB_ECHO", raising=False)
+
+    assert not engines.create_engine("sqlite://").echo
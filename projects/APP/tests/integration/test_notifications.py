@@ -0,0 +1,85 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import socketserver
+import threading
+import time
+
+import pytest
+from allocation.adapters import notifications
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib.sendmail(), taking `delay` over each DATA."""
+
+    def handle(self):
+        self.reply("220 fake smtp")
+        while True:
+            line = self.rfile.readline().decode().strip()
+            verb = line.split(" ", 1)[0].upper()
+            if not line or verb == "QUIT":
+                self.reply("221 bye")
+                return
+            if verb == "DATA":
+                self.reply("354 go ahead")
+                body = []
+                for data in iter(self.rfile.readline, b".\r\n"):
+                    body.append(data.decode())
+                time.sleep(self.server.delay)
+                with self.server.lock:
+                    self.server.messages.append("".join(body))
+            self.reply("250 ok")
+
+    def reply(self, text):
+        self.wfile.write(f"{text}\r\n".encode())
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, delay=0.0):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.messages = []
+
+
+@pytest.fixture
+def smtp_server():
+    server = FakeSMTPServer(delay=0.2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_email_notifications_send(smtp_server):
+    email = notifications.EmailNotifications("127.0.0.1", smtp_server.server_address[1])
+
+    email.send("stock@made.com", "Out of stock for LONELY-LAMP")
+
+    [message] = smtp_server.messages
+    assert "Out of stock for LONELY-LAMP" in message
+
+
+def test_async_email_notifications_send_at_the_same_time(smtp_server):
+    email = notifications.AsyncEmailNotifications(
+        "127.0.0.1", smtp_server.server_address[1]
+    )
+
+    async def scenario():
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(
+                email.send("stock@made.com", f"Out of stock for SKU-{i}")
+                for i in range(5)
+            )
+        )
+        return time.perf_counter() - started
+
+    elapsed = asyncio.run(scenario())
+
+    assert sorted(m.strip().rsplit(" ", 1)[-1] for m in smtp_server.messages) == [
+        f"SKU-{i}" for i in range(5)
+    ]
+    assert elapsed < 5 * 0.2 / 2  # one at a time would take a second
@@ -0,0 +1,147 @@
+# pylint: disable=redefined-outer-name
+import json
+from unittest import mock
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import commands, model
+from allocation.entrypoints import outbox_relay
+from allocation.service_layer import unit_of_work
+from sqlalchemy.orm import clear_mappers
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.queued = []
+
+    def publish(self, channel, message):
+        self.queued.append((channel, message))
+
+    def execute(self):
+        if self.redis.fail:
+            raise ConnectionError("redis went away")
+        self.redis.published.extend(self.queued)
+        self.redis.round_trips += 1
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+        self.round_trips = 0
+        self.fail = False
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return FakePipeline(self)
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+    )
+    yield bus
+    bus.close()
+    clear_mappers()
+
+
+def outbox_rows(engine):
+    with engine.connect() as connection:
+        return connection.execute(
+            orm.outbox.select().order_by(orm.outbox.c.id)
+        ).fetchall()
+
+
+def test_allocation_writes_to_the_outbox(sqlite_bus, in_memory_sqlite_db):
+    sqlite_bus.handle(commands.CreateBatch("b1", "RED-CHAIR", 100, None))
+    sqlite_bus.handle(commands.Allocate("o1", "RED-CHAIR", 10))
+
+    [row] = outbox_rows(in_memory_sqlite_db)
+    assert row.channel == "line_allocated"
+    assert row.sku == "RED-CHAIR"
+    assert not row.sent
+    assert json.loads(row.payload) == dict(
+        orderid="o1", sku="RED-CHAIR", qty=10, batchref="b1"
+    )
+
+
+def test_outbox_rows_are_rolled_back_with_the_allocation(
+    sqlite_bus, in_memory_sqlite_db
+):
+    sqlite_bus.handle(commands.CreateBatch("b1", "BLUE-CHAIR", 100, None))
+    uow = sqlite_bus.uow
+
+    with pytest.raises(RuntimeError):
+        with uow:
+            uow.products.get("BLUE-CHAIR").allocate(
+                model.OrderLine("o1", "BLUE-CHAIR", 10)
+            )
+            uow.session.commit = mock.Mock(side_effect=RuntimeError)
+            uow.commit()
+
+    assert outbox_rows(in_memory_sqlite_db) == []
+
+
+def test_each_event_is_written_once_however_often_the_uow_commits(
+    sqlite_bus, in_memory_sqlite_db
+):
+    sqlite_bus.handle(commands.CreateBatch("b1", "GREY-CHAIR", 100, None))
+    uow = sqlite_bus.uow
+
+    with uow:
+        product = uow.products.get("GREY-CHAIR")
+        for n in range(20):
+            product.allocate(model.OrderLine(f"o{n}", "GREY-CHAIR", 1))
+            uow.commit()
+            # the bus may take events off the queue between commits, and
+            # then a new event can be given a collected one's id()
+            if n % 2:
+                list(uow.collect_new_events())
+        uow.commit()
+
+    rows = outbox_rows(in_memory_sqlite_db)
+    assert [json.loads(row.payload)["orderid"] for row in rows] == [
+        f"o{n}" for n in range(20)
+    ]
+
+
+def test_relay_publishes_in_order_and_marks_sent(sqlite_bus, in_memory_sqlite_db):
+    sqlite_bus.handle(commands.CreateBatch("b1", "GREEN-CHAIR", 100, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "PINK-CHAIR", 100, None))
+    for i in range(5):
+        sqlite_bus.handle(commands.Allocate(f"o{i}", "GREEN-CHAIR", 1))
+        sqlite_bus.handle(commands.Allocate(f"o{i}", "PINK-CHAIR", 1))
+    redis = FakeRedis()
+
+    assert outbox_relay.relay_batch(in_memory_sqlite_db, redis, batch_size=4) == 4
+    assert outbox_relay.relay_batch(in_memory_sqlite_db, redis, batch_size=4) == 4
+    assert outbox_relay.relay_batch(in_memory_sqlite_db, redis, batch_size=4) == 2
+    assert outbox_relay.relay_batch(in_memory_sqlite_db, redis, batch_size=4) == 0
+
+    assert redis.round_trips == 3
+    green_orders = [
+        json.loads(payload)["orderid"]
+        for _, payload in redis.published
+        if json.loads(payload)["sku"] == "GREEN-CHAIR"
+    ]
+    assert green_orders == ["o0", "o1", "o2", "o3", "o4"]
+    assert all(row.sent for row in outbox_rows(in_memory_sqlite_db))
+
+
+def test_relay_leaves_rows_pending_if_publishing_fails(sqlite_bus, in_memory_sqlite_db):
+    sqlite_bus.handle(commands.CreateBatch("b1", "GREY-CHAIR", 100, None))
+    sqlite_bus.handle(commands.Allocate("o1", "GREY-CHAIR", 1))
+    redis = FakeRedis()
+    redis.fail = True
+
+    with pytest.raises(ConnectionError):
+        outbox_relay.relay_batch(in_memory_sqlite_db, redis)
+
+    [row] = outbox_rows(in_memory_sqlite_db)
+    assert not row.sent
+    redis.fail = False
+    assert outbox_relay.relay_batch(in_memory_sqlite_db, redis) == 1
+    assert [channel for channel, _ in redis.published] == ["line_allocated"]
@@ -0,0 +1,85 @@
+# pylint: disable=redefined-outer-name
+import logging
+from unittest import mock
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters.query_stats import QueryBudgetExceeded
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy import exc
+from sqlalchemy.orm import clear_mappers
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+    )
+    yield bus
+    bus.close()
+    clear_mappers()
+
+
+def test_allocate_stays_within_its_query_budget(sqlite_bus, query_counter):
+    sqlite_bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "LAMP", 100, None))
+
+    with query_counter.budget(statements=8) as stats:
+        sqlite_bus.handle(commands.Allocate("o1", "LAMP", 10))
+
+    assert 0 < stats.statements <= 8
+    assert stats.rows > 0
+    assert stats.db_time > 0
+
+
+def test_exceeding_the_budget_fails(sqlite_bus, query_counter):
+    sqlite_bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+
+    with pytest.raises(QueryBudgetExceeded, match="budget was 1"):
+        with query_counter.budget(statements=1):
+            sqlite_bus.handle(commands.Allocate("o1", "LAMP", 10))
+
+
+def test_measurements_nest(sqlite_bus, query_counter):
+    with query_counter.measure() as outer:
+        sqlite_bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+        with query_counter.measure() as inner:
+            sqlite_bus.handle(commands.Allocate("o1", "LAMP", 10))
+
+    assert 0 < inner.statements < outer.statements
+
+
+def test_a_failing_statement_leaves_nothing_behind(in_memory_sqlite_db, query_counter):
+    with in_memory_sqlite_db.connect() as connection:
+        with query_counter.measure() as stats:
+            with pytest.raises(exc.OperationalError):
+                connection.execute("SELECT * FROM no_such_table")
+            connection.execute("SELECT 1")
+        assert not connection.info[query_counter._started_key]
+    assert stats.statements == 2
+
+
+def test_bus_logs_query_stats_when_counting(sqlite_session_factory, caplog):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(
+            sqlite_session_factory, count_queries=True
+        ),
+        notifications=mock.Mock(),
+    )
+    try:
+        with caplog.at_level(logging.INFO, logger="allocation.service_layer"):
+            bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    finally:
+        bus.uow.query_counter.remove()
+        bus.close()
+        clear_mappers()
+
+    [per_handler, per_message] = [r for r in caplog.records if hasattr(r, "statements")]
+    assert per_handler.handler == "add_batch"
+    assert per_message.handler is None
+    assert per_message.message_type == "CreateBatch"
+    assert per_message.statements >= per_handler.statements > 0
@@ -17,3 +17,150 @@ def test_get_by_batchref(sqlite_session_factory):
     repo.add(p2)
     assert repo.get_by_batchref("b2") == p1
     assert repo.get_by_batchref("b3") == p2
+
+
+def test_get_by_batchref_remembers_the_sku_of_a_batch(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    batch = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
+    repo.add(model.Product(sku="sku1", batches=[batch]))
+    session.commit()
+
+    batchref_skus = {}
+    repository.SqlAlchemyRepository(session, batchref_skus).get_by_batchref("b1")
+    assert batchref_skus == {"b1": "sku1"}
+
+    product = repository.SqlAlchemyRepository(
+        sqlite_session_factory(), batchref_skus
+    ).get_by_batchref("b1")
+    assert product.sku == "sku1"
+
+
+def test_get_by_batchref_ignores_a_stale_sku(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session, {"b1": "sku2"})
+    b1 = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
+    b2 = model.Batch(ref="b2", sku="sku2", qty=100, eta=None)
+    p1 = model.Product(sku="sku1", batches=[b1])
+    repo.add(p1)
+    repo.add(model.Product(sku="sku2", batches=[b2]))
+    assert repo.get_by_batchref("b1") == p1
+    assert repo.batchref_skus == {"b1": "sku1"}
+
+
+def test_skus_for_batchrefs_reads_the_batches_table_once(
+    sqlite_session_factory, query_counter
+):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    repo.add(model.Product("sku1", [model.Batch("b1", "sku1", 100, None)]))
+    repo.add(model.Product("sku2", [model.Batch("b2", "sku2", 100, None)]))
+    session.commit()
+
+    batchref_skus = {"b2": "sku2"}
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory(), batchref_skus)
+    with query_counter.measure() as stats:
+        skus = repo.skus_for_batchrefs(["b1", "b2", "no-such-batch"])
+
+    assert skus == {"b1": "sku1", "b2": "sku2"}
+    assert stats.statements == 1
+    assert batchref_skus == {"b1": "sku1", "b2": "sku2"}
+
+
+def test_get_many_loads_the_products_that_exist(sqlite_session_factory):
+    session = sqlite_session_factory()
+    for sku in ("sku1", "sku2"):
+        batch = model.Batch(ref=f"{sku}-batch", sku=sku, qty=100, eta=None)
+        batch.allocate(model.OrderLine("order1", sku, 10))
+        session.add(model.Product(sku=sku, batches=[batch]))
+    session.commit()
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    products = repo.get_many(["sku1", "sku2", "nonexistent"])
+
+    assert set(products) == {"sku1", "sku2"}
+    assert products["sku2"].batches[0].available_quantity == 90
+    assert repo.seen == set(products.values())
+
+
+def test_get_many_reuses_products_already_seen(sqlite_session_factory):
+    session = sqlite_session_factory()
+    session.add(model.Product(sku="sku1", batches=[]))
+    session.add(model.Product(sku="sku2", batches=[]))
+    session.commit()
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    sku1 = repo.get("sku1")
+    products = repo.get_many(["sku1", "sku2"])
+
+    assert products["sku1"] is sku1
+
+
+def test_get_many_runs_the_same_queries_however_many_skus(
+    sqlite_session_factory, query_counter
+):
+    session = sqlite_session_factory()
+    for i in range(50):
+        sku = f"sku{i}"
+        batches = [model.Batch(f"{sku}-{n}", sku, 100, None) for n in range(3)]
+        batches[0].allocate(model.OrderLine("order1", sku, 10))
+        session.add(model.Product(sku=sku, batches=batches))
+    session.commit()
+
+    def statements_to_get(skus):
+        repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+        with query_counter.measure() as stats:
+            products = repo.get_many(skus)
+            for product in products.values():
+                for batch in product.batches:
+                    batch.available_quantity  # pylint: disable=pointless-statement
+        return stats.statements
+
+    assert statements_to_get(["sku0"]) == statements_to_get(
+        [f"sku{i}" for i in range(50)]
+    )
+
+
+def add_a_used_up_and_an_in_stock_batch(session):
+    used_up = model.Batch("used-up", "sku1", 10, None)
+    used_up.allocate(model.OrderLine("order1", "sku1", 10))
+    in_stock = model.Batch("in-stock", "sku1", 10, None)
+    session.add(model.Product(sku="sku1", batches=[used_up, in_stock]))
+    session.commit()
+
+
+@pytest.mark.parametrize(
+    "get_in_full",
+    [
+        lambda repo: repo.get("sku1"),
+        lambda repo: repo.get_many(["sku1"])["sku1"],
+        lambda repo: repo.get_by_batchref("used-up"),
+    ],
+    ids=["get", "get_many", "get_by_batchref"],
+)
+def test_a_later_get_loads_the_batches_an_in_stock_only_get_left_out(
+    sqlite_session_factory, get_in_full
+):
+    add_a_used_up_and_an_in_stock_batch(sqlite_session_factory())
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+
+    product = repo.get("sku1", in_stock_only=True)
+    assert [b.reference for b in product.batches] == ["in-stock"]
+    product.allocate(model.OrderLine("order2", "sku1", 3))
+
+    assert get_in_full(repo) is product
+    assert {b.reference: b.available_quantity for b in product.batches} == {
+        "used-up": 0,
+        "in-stock": 7,
+    }
+    assert repo.get("sku1", in_stock_only=True) is product
+    assert len(product.batches) == 2
+
+
+def test_loads_an_order_line_without_a_sku(sqlite_session_factory):
+    session = sqlite_session_factory()
+    session.execute(
+        "INSERT INTO order_lines (orderid, sku, qty) VALUES ('o1', NULL, 10)"
+    )
+    [line] = session.query(model.OrderLine).all()
+    assert line.sku is None
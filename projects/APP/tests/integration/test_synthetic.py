@@ -0,0 +1,70 @@
+import itertools
+from collections import Counter
+
+from allocation.domain import commands
+
+from ..synthetic import (
+    SyntheticWorkload,
+    WorkloadSpec,
+    load_batches,
+    read_jsonl,
+    write_jsonl,
+)
+
+
+def first(messages, count):
+    return list(itertools.islice(messages, count))
+
+
+def test_same_seed_gives_same_workload():
+    spec = WorkloadSpec(skus=1_000, lines=500, seed=7)
+    assert list(SyntheticWorkload(spec).messages()) == list(
+        SyntheticWorkload(spec).messages()
+    )
+    other = WorkloadSpec(skus=1_000, lines=500, seed=8)
+    assert first(SyntheticWorkload(spec).order_stream(), 50) != first(
+        SyntheticWorkload(other).order_stream(), 50
+    )
+
+
+def test_order_stream_is_generated_lazily():
+    workload = SyntheticWorkload(WorkloadSpec(skus=100, lines=50_000_000))
+    assert len(first(workload.order_stream(), 10)) == 10
+
+
+def test_sku_popularity_is_skewed():
+    workload = SyntheticWorkload(WorkloadSpec(skus=1_000, lines=20_000, change_ratio=0))
+    counts = Counter(m.sku for m in workload.order_stream())
+    [(_, top)] = counts.most_common(1)
+    assert top > 20 * (20_000 / 1_000)
+
+
+def test_changes_refer_to_existing_batches():
+    workload = SyntheticWorkload(WorkloadSpec(skus=50, lines=5_000, change_ratio=0.1))
+    batchrefs = {b.ref for b in workload.create_batches()}
+    changes = [
+        m
+        for m in workload.order_stream()
+        if isinstance(m, commands.ChangeBatchQuantity)
+    ]
+    assert changes
+    assert {c.ref for c in changes} <= batchrefs
+
+
+def test_round_trips_through_jsonl(tmp_path):
+    workload = SyntheticWorkload(WorkloadSpec(skus=20, lines=200, change_ratio=0.1))
+    path = tmp_path / "workload.jsonl"
+    count = write_jsonl(workload.messages(), path)
+    assert list(read_jsonl(path)) == list(workload.messages())
+    assert count == len(list(workload.messages()))
+
+
+def test_bulk_loads_products_and_batches(in_memory_sqlite_db):
+    workload = SyntheticWorkload(WorkloadSpec(skus=300, lines=0))
+    load_batches(in_memory_sqlite_db, workload, chunk_size=100)
+
+    with in_memory_sqlite_db.connect() as connection:
+        [[products]] = connection.execute("SELECT count(*) FROM products")
+        [[batches]] = connection.execute("SELECT count(*) FROM batches")
+    assert products == 300
+    assert batches == len(list(workload.create_batches()))
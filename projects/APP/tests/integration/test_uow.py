@@ -2,12 +2,17 @@
 import threading
 import time
 import traceback
+from datetime import date
 from typing import List
 from unittest.mock import Mock
 
 import pytest
-from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from allocation import bootstrap
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
 
 from ..random_refs import random_batchref, random_orderid, random_sku
 
@@ -55,6 +60,163 @@ def test_uow_can_retrieve_a_batch_and_allocate_to_it(sqlite_session_factory):
     assert batchref == "batch1"
 
 
+def test_allocated_quantity_is_recounted_after_loading(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "TALL-BOOKCASE", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="TALL-BOOKCASE")
+        product.allocate(model.OrderLine("o1", "TALL-BOOKCASE", 10))
+        product.allocate(model.OrderLine("o2", "TALL-BOOKCASE", 15))
+        uow.commit()
+
+    with uow:
+        [batch] = uow.products.get(sku="TALL-BOOKCASE").batches
+        assert batch.allocated_quantity == 25
+        assert batch.allocated_quantity_is_consistent()
+
+
+def insert_allocated_batches(session_factory, sku, batch_count):
+    session = session_factory()
+    insert_batch(session, f"{sku}-batch-0", sku, 100, None)
+    for i in range(1, batch_count):
+        session.execute(
+            "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+            " VALUES (:ref, :sku, 100, NULL)",
+            dict(ref=f"{sku}-batch-{i}", sku=sku),
+        )
+    session.commit()
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get(sku=sku)
+        for i in range(batch_count):
+            product.allocate(model.OrderLine(f"existing-{i}", sku, 50))
+        uow.commit()
+
+
+def statements_to_allocate(engine, session_factory, sku):
+    statements = []
+
+    def record(conn, cursor, statement, *_):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        handlers.allocate(
+            commands.Allocate("o1", sku, 10),
+            unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        )
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return statements
+
+
+def test_allocate_runs_the_same_queries_however_many_batches(
+    in_memory_sqlite_db, sqlite_session_factory
+):
+    insert_allocated_batches(sqlite_session_factory, "FEW-BATCHES", 2)
+    insert_allocated_batches(sqlite_session_factory, "MANY-BATCHES", 30)
+
+    few = statements_to_allocate(
+        in_memory_sqlite_db, sqlite_session_factory, "FEW-BATCHES"
+    )
+    many = statements_to_allocate(
+        in_memory_sqlite_db, sqlite_session_factory, "MANY-BATCHES"
+    )
+
+    assert len(few) == len(many)
+
+
+def test_can_load_only_the_batches_in_stock(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "used-up", "DUSTY-RUG", 10, None)
+    session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+        " VALUES ('in-stock', 'DUSTY-RUG', 10, NULL)"
+    )
+    session.commit()
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        uow.products.get(sku="DUSTY-RUG").allocate(
+            model.OrderLine("o1", "DUSTY-RUG", 10)
+        )
+        uow.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        product = uow.products.get(sku="DUSTY-RUG", in_stock_only=True)
+        assert [b.reference for b in product.batches] == ["in-stock"]
+        assert product.allocate(model.OrderLine("o2", "DUSTY-RUG", 5)) == "in-stock"
+        uow.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        product = uow.products.get(sku="DUSTY-RUG")
+        assert {b.reference: b.available_quantity for b in product.batches} == {
+            "used-up": 0,
+            "in-stock": 5,
+        }
+
+
+def allocate_lines(session_factory, sku, count, bulk_flush=True):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, bulk_flush=bulk_flush)
+    with uow:
+        product = uow.products.get(sku=sku)
+        product.allocate_many(
+            [model.OrderLine(f"order{i}", sku, 1) for i in range(count)]
+        )
+        uow.commit()
+
+
+def test_bulk_flush_writes_lines_and_allocations(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "TEAK-SIDEBOARD", 100, None)
+    session.commit()
+
+    allocate_lines(sqlite_session_factory, "TEAK-SIDEBOARD", 3)
+
+    for orderid in ("order0", "order1", "order2"):
+        assert get_allocated_batch_ref(session, orderid, "TEAK-SIDEBOARD") == "batch1"
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        [batch] = uow.products.get(sku="TEAK-SIDEBOARD").batches
+        assert batch.available_quantity == 97
+
+
+def test_bulk_flush_runs_the_same_statements_however_many_lines(
+    sqlite_session_factory, query_counter
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "few-batch", "FEW-LINES", 1000, None)
+    insert_batch(session, "many-batch", "MANY-LINES", 1000, None)
+    session.commit()
+
+    with query_counter.measure() as few:
+        allocate_lines(sqlite_session_factory, "FEW-LINES", 2)
+    with query_counter.measure() as many:
+        allocate_lines(sqlite_session_factory, "MANY-LINES", 200)
+
+    assert few.statements == many.statements
+
+
+def test_bulk_flush_moves_reallocated_lines(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "now", "OAK-DESK", 10, None)
+    session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+        " VALUES ('later', 'OAK-DESK', 10, :eta)",
+        dict(eta=date.today()),
+    )
+    session.commit()
+    allocate_lines(sqlite_session_factory, "OAK-DESK", 5)
+
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        uow.products.get(sku="OAK-DESK").change_batch_quantity("now", 3)
+        uow.commit()
+
+    refs = [get_allocated_batch_ref(session, f"order{i}", "OAK-DESK") for i in range(5)]
+    assert sorted(refs) == ["later", "later", "now", "now", "now"]
+    [[count]] = session.execute("SELECT count(*) FROM allocations")
+    assert count == 5
+
+
 def test_rolls_back_uncommitted_work_by_default(sqlite_session_factory):
     uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
     with uow:
@@ -93,6 +255,112 @@ def try_to_allocate(orderid, sku, exceptions, session_factory):
         exceptions.append(e)
 
 
+@pytest.fixture
+def file_sqlite_session_factory(tmp_path):
+    # separate connections, unlike the in-memory database's single one
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+def test_concurrent_updates_to_a_product_conflict(file_sqlite_session_factory):
+    session = file_sqlite_session_factory()
+    insert_batch(session, "batch1", "WOBBLY-STOOL", 100, None, product_version=1)
+    session.commit()
+
+    uow1 = unit_of_work.SqlAlchemyUnitOfWork(file_sqlite_session_factory)
+    uow2 = unit_of_work.SqlAlchemyUnitOfWork(file_sqlite_session_factory)
+    with uow1, uow2:
+        product1 = uow1.products.get(sku="WOBBLY-STOOL")
+        product2 = uow2.products.get(sku="WOBBLY-STOOL")
+        product1.allocate(model.OrderLine("o1", "WOBBLY-STOOL", 10))
+        product2.allocate(model.OrderLine("o2", "WOBBLY-STOOL", 10))
+        uow1.commit()
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            uow2.commit()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='WOBBLY-STOOL'"
+    )
+    assert version == 2
+    orders = session.execute("SELECT orderid FROM order_lines").fetchall()
+    assert orders == [("o1",)]
+
+
+def test_a_conflicting_allocation_is_retried(file_sqlite_session_factory):
+    session = file_sqlite_session_factory()
+    insert_batch(session, "batch1", "SHAKY-TABLE", 100, None, product_version=1)
+    session.commit()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(file_sqlite_session_factory),
+        notifications=Mock(),
+    )
+
+    sneaked_in = []
+
+    def allocate_elsewhere_first(*_):
+        # sneak in a commit between the bus's read and its write, once
+        if sneaked_in:
+            return
+        sneaked_in.append(True)
+        with unit_of_work.SqlAlchemyUnitOfWork(file_sqlite_session_factory) as uow:
+            product = uow.products.get(sku="SHAKY-TABLE")
+            product.allocate(model.OrderLine("o1", "SHAKY-TABLE", 10))
+            uow.commit()
+
+    event.listen(Session, "before_flush", allocate_elsewhere_first)
+    try:
+        bus.handle(commands.Allocate("o2", "SHAKY-TABLE", 10))
+    finally:
+        event.remove(Session, "before_flush", allocate_elsewhere_first)
+        bus.close()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='SHAKY-TABLE'"
+    )
+    assert version == 3
+    assert get_allocated_batch_ref(session, "o1", "SHAKY-TABLE") == "batch1"
+    assert get_allocated_batch_ref(session, "o2", "SHAKY-TABLE") == "batch1"
+
+
+def test_a_command_that_fails_in_a_shared_run_fails_alone(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "SWIVEL-CHAIR", 100, None)
+    session.commit()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=Mock(),
+    )
+    allocate = bus.command_handlers[commands.Allocate]
+
+    def allocate_unless_bad(cmd):
+        if cmd.orderid == "bad":
+            raise ValueError("bad order")
+        allocate(cmd)
+
+    bus.command_handlers[commands.Allocate] = allocate_unless_bad
+
+    try:
+        results = bus.handle_many(
+            [
+                commands.Allocate("o1", "SWIVEL-CHAIR", 10),
+                commands.Allocate("bad", "SWIVEL-CHAIR", 10),
+                commands.Allocate("o3", "SWIVEL-CHAIR", 10),
+            ]
+        )
+    finally:
+        bus.close()
+
+    assert [type(result) for result in results] == [type(None), ValueError, type(None)]
+    orders = session.execute("SELECT orderid FROM order_lines ORDER BY orderid")
+    assert orders.fetchall() == [("o1",), ("o3",)]
+    views = session.execute("SELECT orderid FROM allocations_view ORDER BY orderid")
+    assert views.fetchall() == [("o1",), ("o3",)]
+
+
 # we won't bother with any postgres tests
 """
 def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory):
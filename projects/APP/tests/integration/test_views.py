@@ -4,9 +4,13 @@ from unittest import mock
 
 import pytest
 from allocation import bootstrap, views
+from allocation.adapters import engines
+from allocation.adapters.orm import metadata
 from allocation.domain import commands
 from allocation.service_layer import unit_of_work
-from sqlalchemy.orm import clear_mappers
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import clear_mappers, sessionmaker
 
 today = date.today()
 
@@ -17,9 +21,9 @@ def sqlite_bus(sqlite_session_factory):
         start_orm=True,
         uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
         notifications=mock.Mock(),
-        publish=lambda *args: None,
     )
     yield bus
+    bus.close()
     clear_mappers()
 
 
@@ -48,3 +52,62 @@ def test_deallocation(sqlite_bus):
     assert views.allocations("o1", sqlite_bus.uow) == [
         {"sku": "sku1", "batchref": "b2"},
     ]
+
+
+def test_read_only_queries_share_the_write_engine_by_default(sqlite_bus, monkeypatch):
+    monkeypatch.delenv("READ_DATABASE_URI", raising=False)
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.Allocate("o1", "sku1", 10))
+
+    queries = views.read_only_queries(sqlite_bus.uow)
+
+    assert queries.allocations("o1") == [{"sku": "sku1", "batchref": "b1"}]
+
+
+def test_read_only_queries_use_their_own_read_engine(tmp_path, monkeypatch):
+    uri = f"sqlite:///{tmp_path / 'allocation.db'}"
+    write_engine = engines.create_engine(uri)
+    metadata.create_all(write_engine)
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=write_engine)),
+        notifications=mock.Mock(),
+    )
+    monkeypatch.setenv("READ_DATABASE_URI", uri)
+    try:
+        queries = views.read_only_queries(bus.uow)
+        bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+        bus.handle(commands.Allocate("o1", "sku1", 10))
+
+        assert queries.engine is not write_engine
+        assert queries.allocations("o1") == [{"sku": "sku1", "batchref": "b1"}]
+        with pytest.raises(OperationalError, match="readonly"):
+            with queries.engine.begin() as connection:
+                connection.execute(text("DELETE FROM allocations_view"))
+    finally:
+        bus.close()
+        clear_mappers()
+
+
+def test_a_view_can_be_read_while_a_unit_of_work_is_open(tmp_path, monkeypatch):
+    monkeypatch.setenv("DB_PROFILE", "test")
+    monkeypatch.delenv("READ_DATABASE_URI", raising=False)
+    engine = engines.create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    engine.pool._timeout = 1  # fail fast rather than wait out the pool
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=mock.Mock(),
+    )
+    try:
+        bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+        bus.handle(commands.Allocate("o1", "sku1", 10))
+        queries = views.read_only_queries(bus.uow)
+
+        with bus.uow:
+            bus.uow.products.get("sku1")  # the session now holds a connection
+            assert queries.allocations("o1") == [{"sku": "sku1", "batchref": "b1"}]
+    finally:
+        bus.close()
+        clear_mappers()
@@ -0,0 +1,74 @@
+"""
+Benchmarks for the allocation service. They are skipped unless pytest is
+given --perf; timings can be saved as a JSON baseline and later runs
+compared against it:
+
+    pytest tests/perf --perf-save=baseline.json
+    pytest tests/perf --perf-baseline=baseline.json --perf-threshold=0.25
+"""
+
+# pylint: disable=redefined-outer-name
+import json
+import statistics
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import pytest
+
+
+@dataclass
+class Timing:
+    rounds: int
+    best: float
+    median: float
+
+
+@pytest.fixture(scope="session")
+def perf_results(request):
+    results = {}
+    yield results
+    save_to = request.config.getoption("--perf-save")
+    if save_to and results:
+        timings = {name: asdict(timing) for name, timing in sorted(results.items())}
+        Path(save_to).write_text(json.dumps(timings, indent=2) + "\n")
+
+
+@pytest.fixture(scope="session")
+def perf_baseline(request):
+    baseline = request.config.getoption("--perf-baseline")
+    if not baseline:
+        return {}
+    return {
+        name: Timing(**timing)
+        for name, timing in json.loads(Path(baseline).read_text()).items()
+    }
+
+
+@pytest.fixture
+def benchmark(request, perf_results, perf_baseline):
+    """
+    Times fn(*setup()) over a few rounds, with setup left out of the
+    timing, and records the result under the test's id.
+    """
+    threshold = request.config.getoption("--perf-threshold")
+
+    def run(fn, setup=tuple, rounds=5):
+        times = []
+        for _ in range(rounds):
+            args = setup()
+            started = time.perf_counter()
+            fn(*args)
+            times.append(time.perf_counter() - started)
+        timing = Timing(rounds, min(times), statistics.median(times))
+        name = request.node.nodeid
+        perf_results[name] = timing
+        baseline = perf_baseline.get(name)
+        if baseline and timing.median > baseline.median * (1 + threshold):
+            pytest.fail(
+                f"{name} regressed: median {timing.median * 1000:.2f}ms"
+                f" against a baseline of {baseline.median * 1000:.2f}ms"
+            )
+        return timing
+
+    return run
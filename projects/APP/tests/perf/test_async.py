@@ -0,0 +1,137 @@
+"""
+Messages handled in one process by the sync MessageBus, one at a time,
+against the AsyncMessageBus, up to CONCURRENCY at once, on a file-backed
+SQLite database (aiosqlite for the async side). "allocate" spreads
+Allocate commands over SKU_COUNT skus; "notify" sends lines that are out
+of stock through a notifications adapter that takes NOTIFY_LATENCY to
+answer, standing in for SMTP.
+"""
+
+import asyncio
+import time
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import engines, notifications, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+pytestmark = pytest.mark.perf
+
+MESSAGES = 200
+CONCURRENCY = 16
+SKU_COUNT = 50
+NOTIFY_LATENCY = 0.01
+
+
+class SlowNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        time.sleep(NOTIFY_LATENCY)
+
+
+class SlowAsyncNotifications(notifications.AbstractNotifications):
+    async def send(self, destination, message):
+        await asyncio.sleep(NOTIFY_LATENCY)
+
+
+def workload(scenario):
+    qty = 1 if scenario == "allocate" else 10**10
+    setup = [
+        commands.CreateBatch(f"batch-{i}", f"sku-{i}", 10**9, None)
+        for i in range(SKU_COUNT)
+    ]
+    lines = [
+        commands.Allocate(f"order-{i}", f"sku-{i % SKU_COUNT}", qty)
+        for i in range(MESSAGES)
+    ]
+    return setup, lines
+
+
+@pytest.mark.parametrize("scenario", ["allocate", "notify"])
+def test_sync_bus(benchmark, tmp_path, scenario):
+    opened = []
+
+    def setup():
+        clear_mappers()
+        engine = engines.create_engine(
+            f"sqlite:///{tmp_path / f'allocation-{len(opened)}.db'}"
+        )
+        orm.metadata.create_all(engine)
+        bus = bootstrap.bootstrap(
+            start_orm=True,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+            notifications=SlowNotifications(),
+            deferred_workers=0,  # the notifications are part of the work
+        )
+        opened.append((bus, engine))
+        setup_messages, lines = workload(scenario)
+        for message in setup_messages:
+            bus.handle(message)
+        return bus, lines
+
+    def handle_all(bus, messages):
+        for message in messages:
+            bus.handle(message)
+
+    try:
+        benchmark(handle_all, setup=setup, rounds=3)
+    finally:
+        for bus, engine in opened:
+            bus.close()
+            engine.dispose()
+        clear_mappers()
+
+
+@pytest.mark.parametrize("scenario", ["allocate", "notify"])
+def test_async_bus(benchmark, tmp_path, scenario):
+    opened = []
+
+    async def make_bus():
+        engine = engines.create_async_engine(
+            f"sqlite+aiosqlite:///{tmp_path / f'allocation-{len(opened)}.db'}"
+        )
+        async with engine.begin() as connection:
+            await connection.run_sync(orm.metadata.create_all)
+        bus = bootstrap.bootstrap(
+            start_orm=True,
+            uow=unit_of_work.AsyncSqlAlchemyUnitOfWork(
+                sessionmaker(bind=engine, class_=AsyncSession)
+            ),
+            notifications=SlowAsyncNotifications(),
+        )
+        setup_messages, lines = workload(scenario)
+        for message in setup_messages:
+            await bus.handle(message)
+        return bus, engine, lines
+
+    async def handle_all(bus, messages):
+        limit = asyncio.Semaphore(CONCURRENCY)
+
+        async def handle(message):
+            async with limit:
+                await bus.handle(message)
+
+        await asyncio.gather(*(handle(message) for message in messages))
+
+    def setup():
+        # everything for one round on one event loop: the engine's
+        # connections belong to the loop that opened them
+        clear_mappers()
+        loop = asyncio.new_event_loop()
+        bus, engine, lines = loop.run_until_complete(make_bus())
+        opened.append((bus, engine, loop))
+        return loop, bus, lines
+
+    def run(loop, bus, messages):
+        loop.run_until_complete(handle_all(bus, messages))
+
+    try:
+        benchmark(run, setup=setup, rounds=3)
+    finally:
+        for bus, engine, loop in opened:
+            bus.close()
+            loop.run_until_complete(engine.dispose())
+            loop.close()
+        clear_mappers()
@@ -0,0 +1,95 @@
+"""
+Several worker processes sharing one file-backed SQLite database, each
+sending Allocate commands through its own message bus, with conflicting
+commits retried. "hot" sends every line to one sku, "spread" gives each
+worker a sku of its own. Starting the workers isn't timed.
+"""
+
+import multiprocessing
+from unittest import mock
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+pytestmark = pytest.mark.perf
+
+LINES_PER_WORKER = 20
+
+
+def make_engine(path):
+    # a generous busy timeout: writers queue on SQLite's lock rather than fail
+    return create_engine(f"sqlite:///{path}", connect_args={"timeout": 60})
+
+
+def setup_database(path, sku_count):
+    engine = make_engine(path)
+    orm.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            orm.products.insert(),
+            [dict(sku=f"sku-{i}", version_number=0) for i in range(sku_count)],
+        )
+        connection.execute(
+            orm.batches.insert(),
+            [
+                dict(reference=f"batch-{i}", sku=f"sku-{i}", _purchased_quantity=10**9)
+                for i in range(sku_count)
+            ],
+        )
+    engine.dispose()
+
+
+def allocate_lines(path, worker_number, sku_count, ready):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=make_engine(path))),
+        notifications=mock.Mock(),
+        conflict_attempts=50,
+    )
+    ready.wait()  # everyone starts together, after imports and setup
+    for i in range(LINES_PER_WORKER):
+        sku = f"sku-{(worker_number + i) % sku_count}"
+        bus.handle(commands.Allocate(f"order-{worker_number}-{i}", sku, 1))
+    bus.close()
+
+
+@pytest.mark.parametrize("placement", ["hot", "spread"])
+@pytest.mark.parametrize("workers", [1, 2, 4], ids="workers={}".format)
+def test_allocate_from_several_processes(benchmark, tmp_path, workers, placement):
+    context = multiprocessing.get_context("spawn")
+    sku_count = 1 if placement == "hot" else workers
+
+    def setup():
+        path = tmp_path / f"allocation-{len(perf_runs)}.db"
+        perf_runs.append(path)
+        setup_database(path, sku_count)
+        ready = context.Barrier(workers + 1)
+        processes = [
+            context.Process(
+                target=allocate_lines, args=(path, n, sku_count, ready), daemon=True
+            )
+            for n in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        return ready, processes
+
+    def run(ready, processes):
+        ready.wait()
+        for process in processes:
+            process.join()
+
+    perf_runs = []
+    benchmark(run, setup=setup, rounds=3)
+
+    # every conflict was retried until it went through
+    engine = make_engine(perf_runs[-1])
+    with engine.connect() as connection:
+        allocated = connection.execute("SELECT count(*) FROM allocations").scalar()
+    engine.dispose()
+    assert allocated == workers * LINES_PER_WORKER
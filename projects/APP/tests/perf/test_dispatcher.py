@@ -0,0 +1,73 @@
+"""
+Allocate commands through a Dispatcher's worker processes on one
+file-backed SQLite database, lines spread over SKU_COUNT skus. Starting
+the workers, which spawns them and imports everything in each, isn't
+timed. Scaling needs a core per worker, and SQLite still takes its
+writers one at a time.
+"""
+
+import functools
+from unittest import mock
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import engines, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.dispatcher import Dispatcher
+from sqlalchemy.orm import sessionmaker
+
+pytestmark = pytest.mark.perf
+
+COMMANDS = 500
+SKU_COUNT = 64
+
+
+def make_bus(uri):
+    # runs in the worker process, which starts with nothing mapped
+    return bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(
+            sessionmaker(bind=engines.create_engine(uri))
+        ),
+        notifications=mock.Mock(),
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 2, 4, 8, 16], ids="workers={}".format)
+def test_dispatch_allocate(benchmark, tmp_path, workers):
+    opened = []
+
+    def setup():
+        uri = f"sqlite:///{tmp_path / f'allocation-{len(opened)}.db'}"
+        engine = engines.create_engine(uri)
+        orm.metadata.create_all(engine)
+        dispatcher = Dispatcher(
+            workers, functools.partial(make_bus, uri), sessionmaker(bind=engine)
+        )
+        opened.append((dispatcher, engine))
+        # spread over every worker, so they've all started once these are done
+        batches = [
+            dispatcher.dispatch(commands.CreateBatch(f"batch-{i}", f"sku-{i}", 10**9))
+            for i in range(SKU_COUNT)
+        ]
+        for future in batches:
+            future.result()
+        return (dispatcher,)
+
+    def dispatch_all(dispatcher):
+        futures = [
+            dispatcher.dispatch(
+                commands.Allocate(f"order-{i}", f"sku-{i % SKU_COUNT}", 1)
+            )
+            for i in range(COMMANDS)
+        ]
+        for future in futures:
+            future.result()
+
+    try:
+        benchmark(dispatch_all, setup=setup, rounds=3)
+    finally:
+        for dispatcher, engine in opened:
+            dispatcher.close()
+            engine.dispose()
@@ -0,0 +1,74 @@
+from datetime import date, timedelta
+
+import pytest
+from allocation.domain.model import Batch, OrderLine, Product
+
+pytestmark = pytest.mark.perf
+
+SKU = "PERF-LAMP"
+
+
+def make_product(batch_count, qty=1_000):
+    return Product(
+        SKU,
+        [
+            Batch(f"batch-{i}", SKU, qty, eta=date(2030, 1, 1) + timedelta(i % 365))
+            for i in range(batch_count)
+        ],
+    )
+
+
+def make_lines(line_count, qty=1):
+    return [OrderLine(f"order-{i}", SKU, qty) for i in range(line_count)]
+
+
+@pytest.mark.parametrize("batch_count", [10, 1_000, 10_000], ids="batches={}".format)
+@pytest.mark.parametrize("line_count", [100, 1_000], ids="lines={}".format)
+def test_allocate(benchmark, batch_count, line_count):
+    def allocate_all(product, lines):
+        for line in lines:
+            product.allocate(line)
+
+    benchmark(
+        allocate_all, setup=lambda: (make_product(batch_count), make_lines(line_count))
+    )
+
+
+def sort_and_allocate(product, line):
+    # what Product.allocate used to do for every line
+    batch = next((b for b in sorted(product.batches) if b.can_allocate(line)), None)
+    if batch is None:
+        return None
+    batch.allocate(line)
+    product.version_number += 1
+    return batch.reference
+
+
+@pytest.mark.parametrize(
+    "allocate",
+    [sort_and_allocate, Product.allocate],
+    ids=["sort-every-call", "eta-index"],
+)
+@pytest.mark.parametrize("batch_count", [10, 1_000, 10_000], ids="batches={}".format)
+def test_allocate_against_sorting_every_call(benchmark, batch_count, allocate):
+    def allocate_all(product, lines):
+        for line in lines:
+            allocate(product, line)
+
+    benchmark(
+        allocate_all,
+        setup=lambda: (make_product(batch_count), make_lines(100)),
+        rounds=3,
+    )
+
+
+@pytest.mark.parametrize("batch_count", [10, 1_000], ids="batches={}".format)
+@pytest.mark.parametrize("line_count", [100, 1_000], ids="lines={}".format)
+def test_change_batch_quantity(benchmark, batch_count, line_count):
+    def setup():
+        product = make_product(batch_count, qty=line_count * 5)
+        for line in make_lines(line_count, qty=5):
+            product.allocate(line)
+        return (product,)
+
+    benchmark(lambda product: product.change_batch_quantity("batch-0", 0), setup=setup)
@@ -0,0 +1,71 @@
+"""
+Allocate commands through the message bus on a file-backed SQLite
+database, with an engine from each profile in config, against the engine
+the unit of work used to build: echo on, no pool, no pragmas.
+"""
+
+import logging
+from unittest import mock
+
+import pytest
+import sqlalchemy
+from allocation import bootstrap, config
+from allocation.adapters import engines, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+pytestmark = pytest.mark.perf
+
+COMMANDS = 200
+SKU_COUNT = 10
+
+
+def old_default_engine(uri):
+    # echo would print every statement; measure the logging, not the terminal
+    logging.getLogger("sqlalchemy.engine.Engine").addHandler(logging.NullHandler())
+    return sqlalchemy.create_engine(uri, echo=True)
+
+
+def profile_engine(name):
+    return lambda uri: engines.create_engine(
+        uri, dict(config.ENGINE_PROFILES[name], echo=False)
+    )
+
+
+@pytest.mark.parametrize("profile", ["old-default", *config.ENGINE_PROFILES])
+def test_allocate_with_each_engine_profile(benchmark, tmp_path, profile):
+    make_engine = (
+        old_default_engine if profile == "old-default" else profile_engine(profile)
+    )
+    opened = []
+
+    def setup():
+        clear_mappers()
+        engine = make_engine(f"sqlite:///{tmp_path / f'allocation-{len(opened)}.db'}")
+        orm.metadata.create_all(engine)
+        bus = bootstrap.bootstrap(
+            start_orm=True,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+            notifications=mock.Mock(),
+        )
+        opened.append((bus, engine))
+        for i in range(SKU_COUNT):
+            bus.handle(commands.CreateBatch(f"batch-{i}", f"sku-{i}", 10**9, None))
+        allocations = [
+            commands.Allocate(f"order-{i}", f"sku-{i % SKU_COUNT}", 1)
+            for i in range(COMMANDS)
+        ]
+        return bus, allocations
+
+    def handle_all(bus, messages):
+        for message in messages:
+            bus.handle(message)
+
+    try:
+        benchmark(handle_all, setup=setup, rounds=3)
+    finally:
+        for bus, engine in opened:
+            bus.close()
+            engine.dispose()
+        clear_mappers()
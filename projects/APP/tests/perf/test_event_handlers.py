@@ -0,0 +1,114 @@
+"""
+The message bus handling what the /allocate and /allocate/bulk routes
+send it, on a file-backed SQLite database, with notifications that take
+NOTIFY_LATENCY to send, standing in for SMTP. "bulk" allocates one line
+to each of BULK_SKUS skus, all of them out of stock. The deferred
+handler benchmarks leave the notifications to DeferredHandlers, with each
+overflow policy, and time close() sending what's left.
+"""
+
+import time
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import engines, notifications, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+pytestmark = pytest.mark.perf
+
+REQUESTS = 50
+BULK_SKUS = 8
+NOTIFY_LATENCY = 0.01
+
+
+class SlowNotifications(notifications.AbstractNotifications):
+    def send(self, destination, message):
+        time.sleep(NOTIFY_LATENCY)
+
+
+def requests(scenario):
+    if scenario == "allocate":
+        return [commands.Allocate(f"o{i}", "in-stock", 1) for i in range(REQUESTS)]
+    if scenario == "out-of-stock":
+        return [commands.Allocate(f"o{i}", "sold-out-0", 1) for i in range(REQUESTS)]
+    return [
+        commands.AllocateMany(
+            [commands.Allocate(f"o{i}", f"sold-out-{n}", 1) for n in range(BULK_SKUS)]
+        )
+        for i in range(REQUESTS)
+    ]
+
+
+@pytest.fixture
+def make_bus(tmp_path):
+    """Bootstraps a bus on a new database each call, with a few batches."""
+    opened = []
+
+    def make(**kwargs):
+        clear_mappers()
+        engine = engines.create_engine(
+            f"sqlite:///{tmp_path / f'allocation-{len(opened)}.db'}"
+        )
+        orm.metadata.create_all(engine)
+        bus = bootstrap.bootstrap(
+            start_orm=True,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+            notifications=SlowNotifications(),
+            **kwargs,
+        )
+        opened.append((bus, engine))
+        bus.handle(commands.CreateBatch("batch", "in-stock", 10**9, None))
+        for n in range(BULK_SKUS):
+            bus.handle(commands.CreateBatch(f"empty-{n}", f"sold-out-{n}", 0, None))
+        return bus
+
+    yield make
+    for bus, engine in opened:
+        bus.close()
+        engine.dispose()
+    clear_mappers()
+
+
+def handle_all(bus, messages):
+    for message in messages:
+        bus.handle(message)
+
+
+@pytest.mark.parametrize("scenario", ["allocate", "out-of-stock", "bulk"])
+@pytest.mark.parametrize("handler_threads", [0, 4], ids="threads={}".format)
+def test_independent_handlers(benchmark, make_bus, handler_threads, scenario):
+    def setup():
+        bus = make_bus(
+            handler_threads=handler_threads,
+            deferred_workers=0,  # keep notifications on the request path
+        )
+        return bus, requests(scenario)
+
+    benchmark(handle_all, setup=setup, rounds=3)
+
+
+def deferred_settings(overflow):
+    if overflow == "inline":
+        return dict(deferred_workers=0)
+    # the workers fall behind the notifications and fill the queue
+    return dict(deferred_workers=2, deferred_queue_size=20, deferred_overflow=overflow)
+
+
+@pytest.mark.parametrize("overflow", ["inline", "block", "drop-oldest", "spill"])
+def test_deferred_handlers(benchmark, make_bus, overflow):
+    def setup():
+        return make_bus(**deferred_settings(overflow)), requests("out-of-stock")
+
+    benchmark(handle_all, setup=setup, rounds=3)
+
+
+@pytest.mark.parametrize("overflow", ["block", "drop-oldest", "spill"])
+def test_deferred_handlers_drain_on_close(benchmark, make_bus, overflow):
+    def setup():
+        bus = make_bus(**deferred_settings(overflow))
+        handle_all(bus, requests("out-of-stock"))
+        return (bus,)
+
+    benchmark(lambda bus: bus.close(), setup=setup, rounds=3)
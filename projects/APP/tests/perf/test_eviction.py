@@ -0,0 +1,87 @@
+"""
+Shrinking a fully allocated batch with each eviction policy, over a few
+workloads of line sizes. The benchmarks time TRIALS shrinks; the other
+tests count what the policies leave behind: the Deallocated events, each
+a reallocation transaction, and the quantity evicted beyond the shortfall.
+"""
+
+import random
+
+import pytest
+from allocation.domain import events, model
+
+pytestmark = pytest.mark.perf
+
+TRIALS = 100
+BATCH_QTY = 1_000
+SKU = "PERF-DESK"
+
+POLICIES = {
+    "any": model.evict_any,
+    "fewest-lines": model.evict_fewest_lines,
+    "closest-fit": model.evict_closest_fit,
+}
+
+WORKLOADS = {
+    "uniform": lambda rng: rng.randint(1, 20),
+    "mostly-small": lambda rng: rng.choice([1, 1, 2, 2, 3, 50]),
+    "heavy-tail": lambda rng: int(rng.paretovariate(1.2)),
+}
+
+
+def full_batch(line_qty, seed):
+    """A product whose one batch is fully allocated, and a smaller size for it."""
+    rng = random.Random(seed)
+    batch = model.Batch("batch", SKU, BATCH_QTY, eta=None)
+    product = model.Product(SKU, [batch])
+    i = 0
+    while batch.available_quantity > 0:
+        qty = min(line_qty(rng), batch.available_quantity)
+        product.allocate(model.OrderLine(f"order-{i}", SKU, qty))
+        i += 1
+    product.events.clear()
+    return product, int(BATCH_QTY * rng.uniform(0.5, 0.95))
+
+
+def shrink(product, qty, evict):
+    product.change_batch_quantity("batch", qty, evict)
+    deallocated = [e for e in product.events if isinstance(e, events.Deallocated)]
+    return len(deallocated), product.get_batch("batch").available_quantity
+
+
+@pytest.mark.parametrize("policy", POLICIES)
+@pytest.mark.parametrize("workload", WORKLOADS)
+def test_shrink_a_full_batch(benchmark, workload, policy):
+    def shrink_all(trials):
+        for product, qty in trials:
+            shrink(product, qty, POLICIES[policy])
+
+    def setup():
+        return ([full_batch(WORKLOADS[workload], seed) for seed in range(TRIALS)],)
+
+    benchmark(shrink_all, setup=setup, rounds=3)
+
+
+def totals(workload, policy):
+    results = [
+        shrink(*full_batch(WORKLOADS[workload], seed), POLICIES[policy])
+        for seed in range(TRIALS)
+    ]
+    reallocations = sum(count for count, _ in results)
+    over_evicted = sum(spare for _, spare in results)
+    return reallocations, over_evicted
+
+
+@pytest.mark.parametrize("workload", WORKLOADS)
+def test_fewest_lines_reallocates_less_than_any(workload):
+    fewest, _ = totals(workload, "fewest-lines")
+    anything, _ = totals(workload, "any")
+    assert fewest < anything
+
+
+@pytest.mark.parametrize("workload", WORKLOADS)
+def test_closest_fit_reallocates_as_little_and_over_evicts_less(workload):
+    fewest_reallocations, fewest_over_evicted = totals(workload, "fewest-lines")
+    closest_reallocations, closest_over_evicted = totals(workload, "closest-fit")
+    assert closest_reallocations <= fewest_reallocations
+    assert closest_over_evicted < fewest_over_evicted
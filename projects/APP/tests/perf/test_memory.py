@@ -0,0 +1,125 @@
+"""
+Order lines and the messages built around them, as plain dataclasses with
+a __dict__ and a string per sku, against the slotted messages and interned
+skus they are now. The benchmarks time building COUNT of each; the memory
+tests check the slotted ones take less room per live object, measured with
+tracemalloc.
+"""
+
+import tracemalloc
+from dataclasses import dataclass
+
+import pytest
+from allocation.adapters import orm
+from allocation.domain import commands, events, model
+from allocation.service_layer import unit_of_work
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+pytestmark = pytest.mark.perf
+
+COUNT = 100_000
+SKU_COUNT = 100
+
+
+@dataclass(unsafe_hash=True)
+class PlainOrderLine:
+    orderid: str
+    sku: str
+    qty: int
+
+
+@dataclass
+class PlainAllocated:
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class PlainAllocate:
+    orderid: str
+    sku: str
+    qty: int
+
+
+def sku_for(i):
+    # a fresh string per object, as parsed JSON or database rows give us
+    return f"SKU-{i % SKU_COUNT}"
+
+
+OBJECTS = {
+    "OrderLine": (
+        lambda i: PlainOrderLine(f"order-{i}", sku_for(i), 1),
+        lambda i: model.OrderLine(f"order-{i}", sku_for(i), 1),
+    ),
+    "Allocated": (
+        lambda i: PlainAllocated(f"order-{i}", sku_for(i), 1, "batch"),
+        lambda i: events.Allocated(f"order-{i}", sku_for(i), 1, "batch"),
+    ),
+    "Allocate": (
+        lambda i: PlainAllocate(f"order-{i}", sku_for(i), 1),
+        lambda i: commands.Allocate(f"order-{i}", sku_for(i), 1),
+    ),
+}
+
+
+def build(make):
+    return [make(i) for i in range(COUNT)]
+
+
+def bytes_per_object(make):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = build(make)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    # don't count the list holding them
+    return (after - before) / len(objects) - 8
+
+
+@pytest.mark.parametrize("kind", ["dataclass", "slotted"])
+@pytest.mark.parametrize("name", OBJECTS)
+def test_build(benchmark, name, kind):
+    plain, slotted = OBJECTS[name]
+    benchmark(build, setup=lambda: (slotted if kind == "slotted" else plain,))
+
+
+@pytest.mark.parametrize("name", OBJECTS)
+def test_slotted_objects_take_less_memory(name):
+    plain, slotted = OBJECTS[name]
+    assert bytes_per_object(slotted) < bytes_per_object(plain)
+
+
+def test_load_order_lines(benchmark):
+    engine = create_engine("sqlite://")
+    orm.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            orm.order_lines.insert(),
+            [dict(orderid=f"order-{i}", sku=sku_for(i), qty=1) for i in range(COUNT)],
+        )
+    clear_mappers()
+    orm.start_mappers()
+    uows = []
+
+    def setup():
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+        uow.__enter__()
+        uows.append(uow)
+        return (uow,)
+
+    def load_all(uow):
+        lines = uow.session.query(model.OrderLine).all()
+        assert len(lines) == COUNT
+
+    try:
+        benchmark(load_all, setup=setup, rounds=3)
+    finally:
+        for uow in uows:
+            uow.__exit__(None, None, None)
+        clear_mappers()
+        engine.dispose()
@@ -0,0 +1,72 @@
+import timeit
+
+import pytest
+from allocation.domain import commands, events, model
+from allocation.service_layer import messagebus
+
+from ..unit.test_handlers import (  # pylint: disable=unused-import
+    FakeUnitOfWork,
+    bootstrap_test_app,
+    close_buses,
+)
+
+pytestmark = pytest.mark.perf
+
+
+@pytest.mark.parametrize("sku_count", [1, 100], ids="skus={}".format)
+@pytest.mark.parametrize("batch_count", [10, 100], ids="batches={}".format)
+@pytest.mark.parametrize("line_count", [100, 1_000], ids="lines={}".format)
+def test_handle_allocate(benchmark, sku_count, batch_count, line_count):
+    def setup():
+        bus = bootstrap_test_app()
+        for s in range(sku_count):
+            for b in range(batch_count):
+                bus.handle(commands.CreateBatch(f"batch-{s}-{b}", f"sku-{s}", 1_000))
+        allocations = [
+            commands.Allocate(f"order-{i}", f"sku-{i % sku_count}", 1)
+            for i in range(line_count)
+        ]
+        return bus, allocations
+
+    def handle_all(bus, messages):
+        for message in messages:
+            bus.handle(message)
+
+    benchmark(handle_all, setup=setup)
+
+
+@pytest.mark.parametrize("seen_count", [10, 1_000, 10_000], ids="seen={}".format)
+def test_collect_new_events(benchmark, seen_count):
+    def setup():
+        uow = FakeUnitOfWork()
+        products = [model.Product(f"sku-{i}", []) for i in range(seen_count)]
+        for product in products:
+            uow.products.add(product)
+        return uow, products[:100]
+
+    def raise_and_collect(uow, products):
+        for product in products:
+            product.events.append(events.OutOfStock(product.sku))
+            list(uow.collect_new_events())
+
+    benchmark(raise_and_collect, setup=setup)
+
+
+def test_handler_metrics_cost_under_2us_a_call(benchmark):
+    calls = 100_000
+    event = events.OutOfStock("sku")
+
+    def handler(event):
+        pass
+
+    def call_plain():
+        for _ in range(calls):
+            handler(event)
+
+    def call_timed():
+        for _ in range(calls):
+            messagebus.timed(handler, event)
+
+    plain = min(timeit.repeat(call_plain, number=1, repeat=5))
+    timing = benchmark(call_timed)
+    assert (timing.best - plain) / calls < 2e-6
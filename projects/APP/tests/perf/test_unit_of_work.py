@@ -0,0 +1,156 @@
+# pylint: disable=redefined-outer-name
+from unittest import mock
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+pytestmark = pytest.mark.perf
+
+
+@pytest.fixture
+def file_sqlite_session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def sqlite_bus(file_sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(file_sqlite_session_factory),
+        notifications=mock.Mock(),
+    )
+    yield bus
+    bus.close()
+    clear_mappers()
+
+
+@pytest.mark.parametrize("batch_count", [1, 20], ids="batches={}".format)
+@pytest.mark.parametrize("line_count", [20, 100], ids="lines={}".format)
+def test_allocate(benchmark, sqlite_bus, batch_count, line_count):
+    def setup():
+        sku = f"sku-{batch_count}-{len(perf_runs)}"
+        perf_runs.append(sku)
+        for b in range(batch_count):
+            sqlite_bus.handle(commands.CreateBatch(f"{sku}-batch-{b}", sku, 10_000))
+        return [commands.Allocate(f"order-{i}", sku, 1) for i in range(line_count)]
+
+    def handle_all(messages):
+        for message in messages:
+            sqlite_bus.handle(message)
+
+    perf_runs = []
+    benchmark(handle_all, setup=lambda: (setup(),), rounds=3)
+
+
+@pytest.mark.parametrize("line_count", [20, 100], ids="lines={}".format)
+def test_change_batch_quantity(benchmark, sqlite_bus, line_count):
+    def setup():
+        sku = f"sku-{len(perf_runs)}"
+        perf_runs.append(sku)
+        sqlite_bus.handle(commands.CreateBatch(f"{sku}-early", sku, line_count))
+        sqlite_bus.handle(commands.CreateBatch(f"{sku}-later", sku, line_count))
+        for i in range(line_count):
+            sqlite_bus.handle(commands.Allocate(f"order-{i}", sku, 1))
+        return (commands.ChangeBatchQuantity(f"{sku}-early", 0),)
+
+    perf_runs = []
+    benchmark(sqlite_bus.handle, setup=setup, rounds=3)
+
+
+@pytest.mark.parametrize("message", ["Allocate", "AllocateMany"])
+@pytest.mark.parametrize("line_count", [20, 200], ids="lines={}".format)
+def test_allocate_lines_one_by_one_or_in_bulk(
+    benchmark, sqlite_bus, line_count, message
+):
+    sku_count = 10
+
+    def setup():
+        prefix = f"round-{len(perf_runs)}"
+        perf_runs.append(prefix)
+        for s in range(sku_count):
+            sqlite_bus.handle(
+                commands.CreateBatch(f"{prefix}-batch-{s}", f"{prefix}-sku-{s}", 10**9)
+            )
+        lines = [
+            commands.Allocate(f"order-{i}", f"{prefix}-sku-{i % sku_count}", 1)
+            for i in range(line_count)
+        ]
+        if message == "AllocateMany":
+            return [commands.AllocateMany(lines)]
+        return lines
+
+    def handle_all(messages):
+        for message in messages:
+            sqlite_bus.handle(message)
+
+    perf_runs = []
+    benchmark(handle_all, setup=lambda: (setup(),), rounds=3)
+
+
+@pytest.mark.parametrize("method", ["handle", "handle_many"])
+@pytest.mark.parametrize("run", [1, 10, 100], ids="run={}".format)
+def test_allocate_runs_for_one_sku(benchmark, sqlite_bus, run, method):
+    sku_count = 10
+
+    def setup():
+        prefix = f"round-{len(perf_runs)}"
+        perf_runs.append(prefix)
+        for s in range(sku_count):
+            sqlite_bus.handle(
+                commands.CreateBatch(f"{prefix}-batch-{s}", f"{prefix}-sku-{s}", 10**9)
+            )
+        # `run` consecutive commands go to each sku in turn
+        return [
+            commands.Allocate(f"order-{i}", f"{prefix}-sku-{i // run % sku_count}", 1)
+            for i in range(200)
+        ]
+
+    def handle_one_at_a_time(messages):
+        for message in messages:
+            sqlite_bus.handle(message)
+
+    perf_runs = []
+    fn = handle_one_at_a_time if method == "handle" else sqlite_bus.handle_many
+    benchmark(fn, setup=lambda: (setup(),), rounds=3)
+
+
+@pytest.mark.parametrize("bulk_flush", [False, True], ids="bulk_flush={}".format)
+@pytest.mark.parametrize("line_count", [100, 1_000], ids="lines={}".format)
+def test_commit_new_allocations(benchmark, bulk_flush, line_count):
+    def setup():
+        clear_mappers()
+        engine = create_engine("sqlite://")
+        metadata.create_all(engine)
+        orm.start_mappers()
+        uow = unit_of_work.SqlAlchemyUnitOfWork(
+            sessionmaker(bind=engine), bulk_flush=bulk_flush
+        )
+        with uow:
+            batches = [
+                model.Batch(f"batch-{b}", "sku", line_count, None) for b in range(10)
+            ]
+            uow.products.add(model.Product("sku", batches))
+            uow.commit()
+        # left open for commit() to flush
+        uow.__enter__()
+        lines = [model.OrderLine(f"order-{i}", "sku", 1) for i in range(line_count)]
+        uow.products.get("sku").allocate_many(lines)
+        return (uow,)
+
+    def commit(uow):
+        uow.commit()
+        uow.__exit__(None, None, None)
+
+    try:
+        benchmark(commit, setup=setup)
+    finally:
+        clear_mappers()
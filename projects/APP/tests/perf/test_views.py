@@ -0,0 +1,83 @@
+"""
+Mixed load on one file-backed SQLite database: Allocate commands sent
+through the message bus while reader threads query allocations_view,
+either through a unit of work on the write side's session factory, as
+views.allocations does, or through views.ReadOnlyQueries on a separate
+read engine. What's timed is the writes.
+"""
+
+import threading
+from unittest import mock
+
+import pytest
+from allocation import bootstrap, views
+from allocation.adapters import engines, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+pytestmark = pytest.mark.perf
+
+WRITES = 100
+SKU_COUNT = 10
+
+
+@pytest.mark.parametrize("read_engine", ["shared", "separate"])
+@pytest.mark.parametrize("reader_count", [1, 4], ids="readers={}".format)
+def test_allocate_while_reading_views(benchmark, tmp_path, reader_count, read_engine):
+    opened = []
+
+    def setup():
+        clear_mappers()
+        uri = f"sqlite:///{tmp_path / f'allocation-{len(opened)}.db'}"
+        write_engine = engines.create_engine(uri)
+        orm.metadata.create_all(write_engine)
+        session_factory = sessionmaker(bind=write_engine)
+        bus = bootstrap.bootstrap(
+            start_orm=True,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+            notifications=mock.Mock(),
+        )
+        opened.append((bus, write_engine))
+        for i in range(SKU_COUNT):
+            bus.handle(commands.CreateBatch(f"batch-{i}", f"sku-{i}", 10**9, None))
+        if read_engine == "separate":
+            read = views.ReadOnlyQueries(engines.create_read_engine(uri)).allocations
+        else:
+            # a unit of work per thread: one shared across threads isn't safe
+            local = threading.local()
+
+            def read(orderid):
+                if not hasattr(local, "uow"):
+                    local.uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+                return views.allocations(orderid, local.uow)
+
+        return bus, read
+
+    def write_while_reading(bus, read):
+        stop = threading.Event()
+
+        def reader():
+            reads = 0
+            while not stop.is_set():
+                read(f"order-{reads % 100}")
+                reads += 1
+
+        readers = [threading.Thread(target=reader) for _ in range(reader_count)]
+        for thread in readers:
+            thread.start()
+        try:
+            for i in range(WRITES):
+                bus.handle(commands.Allocate(f"order-{i}", f"sku-{i % SKU_COUNT}", 1))
+        finally:
+            stop.set()
+            for thread in readers:
+                thread.join()
+
+    try:
+        benchmark(write_while_reading, setup=setup, rounds=3)
+    finally:
+        for bus, engine in opened:
+            bus.close()
+            engine.dispose()
+        clear_mappers()
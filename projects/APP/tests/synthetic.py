@@ -0,0 +1,216 @@
+"""
+Seeded synthetic workloads for benchmarking and load-testing allocation:
+CreateBatch commands for every SKU, then a stream of Allocate commands
+with Zipf-distributed SKU popularity interleaved with ChangeBatchQuantity
+commands (a change to 0 stands in for a cancelled batch).
+
+Everything is generated lazily, and what is kept in memory depends on the
+number of SKUs only, so very long order streams can be written out or
+replayed in constant memory:
+
+    python -m tests.synthetic workload.jsonl --skus 100000 --lines 50000000
+    python -m tests.synthetic --database sqlite:///load.db --skus 100000
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import random
+from dataclasses import dataclass, fields
+from datetime import date, timedelta
+from typing import Iterable, Iterator
+
+from allocation.adapters import orm
+from allocation.domain import commands
+from sqlalchemy import create_engine
+
+MESSAGE_TYPES = {
+    cls.__name__: cls
+    for cls in (commands.CreateBatch, commands.Allocate, commands.ChangeBatchQuantity)
+}
+
+
+@dataclass
+class WorkloadSpec:
+    skus: int = 100_000
+    lines: int = 1_000_000
+    seed: int = 0
+    max_batches_per_sku: int = 4
+    zipf_exponent: float = 1.1
+    in_stock_ratio: float = 0.3
+    mean_eta_days: float = 30.0
+    mean_line_qty: float = 3.0
+    max_lines_per_order: int = 5
+    change_ratio: float = 0.01
+    cancel_ratio: float = 0.1
+    start_date: date = date(2030, 1, 1)
+
+
+class SyntheticWorkload:
+    def __init__(self, spec: WorkloadSpec):
+        self.spec = spec
+        rng = random.Random(spec.seed)
+        # popularity rank -> sku index, so the hot skus are spread around
+        self._sku_by_rank = list(range(spec.skus))
+        rng.shuffle(self._sku_by_rank)
+        weights = (1 / rank**spec.zipf_exponent for rank in range(1, spec.skus + 1))
+        self._cumulative_weights = list(itertools.accumulate(weights))
+
+    def sku(self, index: int) -> str:
+        return f"sku-{index:07d}"
+
+    def batchref(self, sku_index: int, batch_number: int) -> str:
+        return f"batch-{sku_index:07d}-{batch_number}"
+
+    def create_batches(self) -> Iterator[commands.CreateBatch]:
+        for sku_index in range(self.spec.skus):
+            rng = self._rng("sku", sku_index)
+            for batch_number in range(self._batch_count(sku_index)):
+                yield commands.CreateBatch(
+                    self.batchref(sku_index, batch_number),
+                    self.sku(sku_index),
+                    self._batch_qty(sku_index, batch_number),
+                    self._eta(rng),
+                )
+
+    def order_stream(self) -> Iterator[commands.Command]:
+        spec = self.spec
+        rng = self._rng("orders")
+        order_number, lines_left_in_order = 0, 0
+        for _ in range(spec.lines):
+            if lines_left_in_order == 0:
+                order_number += 1
+                lines_left_in_order = rng.randint(1, spec.max_lines_per_order)
+            lines_left_in_order -= 1
+            sku_index = self._popular_sku(rng)
+            qty = 1 + int(rng.expovariate(1 / spec.mean_line_qty))
+            yield commands.Allocate(
+                f"order-{order_number:09d}", self.sku(sku_index), qty
+            )
+            if rng.random() < spec.change_ratio:
+                yield self._change(rng)
+
+    def messages(self) -> Iterator[commands.Command]:
+        return itertools.chain(self.create_batches(), self.order_stream())
+
+    def _change(self, rng: random.Random) -> commands.ChangeBatchQuantity:
+        sku_index = self._popular_sku(rng)
+        batch_number = rng.randrange(self._batch_count(sku_index))
+        if rng.random() < self.spec.cancel_ratio:
+            qty = 0
+        else:
+            qty = int(self._batch_qty(sku_index, batch_number) * rng.uniform(0.5, 1.2))
+        return commands.ChangeBatchQuantity(self.batchref(sku_index, batch_number), qty)
+
+    def _popular_sku(self, rng: random.Random) -> int:
+        point = rng.random() * self._cumulative_weights[-1]
+        rank = bisect.bisect_left(self._cumulative_weights, point)
+        return self._sku_by_rank[min(rank, self.spec.skus - 1)]
+
+    def _batch_count(self, sku_index: int) -> int:
+        return self._rng("batches", sku_index).randint(1, self.spec.max_batches_per_sku)
+
+    def _batch_qty(self, sku_index: int, batch_number: int) -> int:
+        # derived rather than remembered, so changes can refer back to it
+        return self._rng("qty", sku_index, batch_number).randint(10, 1_000)
+
+    def _eta(self, rng: random.Random):
+        if rng.random() < self.spec.in_stock_ratio:
+            return None
+        days = int(rng.expovariate(1 / self.spec.mean_eta_days))
+        return self.spec.start_date + timedelta(days=days)
+
+    def _rng(self, *key) -> random.Random:
+        return random.Random(":".join(map(str, (self.spec.seed,) + key)))
+
+
+def to_json(message: commands.Command) -> str:
+    # asdict deep-copies every field, which dominates on long streams
+    data = {f.name: getattr(message, f.name) for f in fields(message)}
+    if isinstance(data.get("eta"), date):
+        data["eta"] = data["eta"].isoformat()
+    return json.dumps({"type": type(message).__name__, "data": data})
+
+
+def from_json(line: str) -> commands.Command:
+    message = json.loads(line)
+    data = message["data"]
+    if data.get("eta") is not None:
+        data["eta"] = date.fromisoformat(data["eta"])
+    return MESSAGE_TYPES[message["type"]](**data)
+
+
+def write_jsonl(messages: Iterable[commands.Command], path) -> int:
+    count = 0
+    with open(path, "w") as f:
+        for message in messages:
+            f.write(to_json(message) + "\n")
+            count += 1
+    return count
+
+
+def read_jsonl(path) -> Iterator[commands.Command]:
+    with open(path) as f:
+        for line in f:
+            yield from_json(line)
+
+
+def load_batches(engine, workload: SyntheticWorkload, chunk_size: int = 10_000):
+    """
+    Bulk-insert the workload's products and batches straight into the
+    orm.metadata tables, a chunk at a time with executemany.
+    """
+    with engine.begin() as connection:
+        for skus in _chunks(range(workload.spec.skus), chunk_size):
+            connection.execute(
+                orm.products.insert(),
+                [dict(sku=workload.sku(i), version_number=0) for i in skus],
+            )
+        for batches in _chunks(workload.create_batches(), chunk_size):
+            connection.execute(
+                orm.batches.insert(),
+                [
+                    dict(
+                        reference=b.ref,
+                        sku=b.sku,
+                        _purchased_quantity=b.qty,
+                        eta=b.eta,
+                    )
+                    for b in batches
+                ],
+            )
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("output", nargs="?", help="JSONL file for the command stream")
+    parser.add_argument("--database", help="URI to bulk-load products and batches into")
+    parser.add_argument("--skus", type=int, default=WorkloadSpec.skus)
+    parser.add_argument("--lines", type=int, default=WorkloadSpec.lines)
+    parser.add_argument("--seed", type=int, default=WorkloadSpec.seed)
+    args = parser.parse_args()
+    workload = SyntheticWorkload(
+        WorkloadSpec(skus=args.skus, lines=args.lines, seed=args.seed)
+    )
+    if args.output:
+        count = write_jsonl(workload.messages(), args.output)
+        print(f"wrote {count} messages to {args.output}")
+    if args.database:
+        engine = create_engine(args.database)
+        orm.metadata.create_all(engine)
+        load_batches(engine, workload)
+        print(f"loaded {args.skus} skus into {args.database}")
+
+
+if __name__ == "__main__":
+    main()
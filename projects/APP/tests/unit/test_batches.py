@@ -45,3 +45,24 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+def test_allocated_quantity_tracks_allocations_and_deallocations():
+    batch, line = make_batch_and_line("SWIVEL-CHAIR", 20, 2)
+    other_line = OrderLine("order-456", "SWIVEL-CHAIR", 5)
+    batch.allocate(line)
+    batch.allocate(other_line)
+    batch.allocate(line)
+    assert batch.allocated_quantity == 7
+    assert batch.allocated_quantity_is_consistent()
+
+    deallocated = batch.deallocate_one()
+
+    assert batch.allocated_quantity == 7 - deallocated.qty
+    assert batch.allocated_quantity_is_consistent()
+
+
+def test_consistency_check_spots_a_stale_counter():
+    batch, line = make_batch_and_line("SWIVEL-CHAIR", 20, 2)
+    batch._allocations.add(line)
+    assert not batch.allocated_quantity_is_consistent()
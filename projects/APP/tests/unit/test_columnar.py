@@ -0,0 +1,73 @@
+import copy
+import random
+from datetime import date, timedelta
+
+import pytest
+from allocation.domain.model import Batch, OrderLine, Product
+
+np = pytest.importorskip("numpy")
+from allocation.domain.columnar import ColumnarAllocator  # isort:skip
+
+today = date.today()
+
+
+def random_products(rng, sku_count, max_batches):
+    products = []
+    for s in range(sku_count):
+        sku = f"SKU-{s}"
+        batches = [
+            Batch(
+                f"{sku}-batch-{b}",
+                sku,
+                rng.randint(0, 60),
+                eta=rng.choice([None, today, today + timedelta(rng.randint(1, 5))]),
+            )
+            for b in range(rng.randint(1, max_batches))
+        ]
+        products.append(Product(sku, batches))
+    return products
+
+
+def random_lines(rng, sku_count, line_count):
+    return [
+        OrderLine(f"order-{i}", f"SKU-{rng.randrange(sku_count)}", rng.randint(1, 25))
+        for i in range(line_count)
+    ]
+
+
+def test_allocates_earliest_batch_that_fits():
+    products = [
+        Product(
+            "LUMPY-CUSHION",
+            [
+                Batch("shipment", "LUMPY-CUSHION", 100, eta=today),
+                Batch("in-stock", "LUMPY-CUSHION", 10, eta=None),
+            ],
+        )
+    ]
+    allocator = ColumnarAllocator.from_products(products)
+
+    result = allocator.allocate(["LUMPY-CUSHION"] * 3 + ["UNKNOWN"], [6, 6, 4, 1])
+
+    assert result.line_batchrefs.tolist() == ["in-stock", "shipment", "in-stock", None]
+    assert result.remaining_by_batchref() == {"shipment": 94, "in-stock": 0}
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_product_allocate(seed):
+    rng = random.Random(seed)
+    products = random_products(rng, sku_count=5, max_batches=8)
+    lines = random_lines(rng, sku_count=6, line_count=300)
+    allocator = ColumnarAllocator.from_products(products)
+
+    result = allocator.allocate_lines(lines)
+
+    by_sku = {p.sku: p for p in copy.deepcopy(products)}
+    expected = [
+        by_sku[line.sku].allocate(line) if line.sku in by_sku else None
+        for line in lines
+    ]
+    assert result.line_batchrefs.tolist() == expected
+    assert result.remaining_by_batchref() == {
+        b.reference: b.available_quantity for p in by_sku.values() for b in p.batches
+    }
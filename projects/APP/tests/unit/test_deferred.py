@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+from allocation.domain import events
+from allocation.service_layer.deferred import DeferredHandlers
+
+
+class Recorder:
+    """Its handle() records events, and can be held up until let go."""
+
+    def __init__(self):
+        self.events = []
+        self.started = threading.Event()
+        self.go = threading.Event()
+
+    def handle(self, event):
+        self.started.set()
+        self.go.wait(timeout=5)
+        self.events.append(event)
+
+
+def out_of_stock(n):
+    return events.OutOfStock(f"sku-{n}")
+
+
+def test_runs_handlers_in_the_background_and_drains_on_close():
+    record = Recorder()
+    deferred = DeferredHandlers(workers=1, max_size=10)
+
+    for n in range(3):
+        deferred.submit(record.handle, out_of_stock(n))
+    assert record.started.wait(timeout=5)
+    assert record.events == []
+
+    record.go.set()
+    deferred.close()
+    assert record.events == [out_of_stock(n) for n in range(3)]
+    assert deferred.metrics().handled == 3
+
+
+def test_block_waits_for_room():
+    record = Recorder()
+    deferred = DeferredHandlers(workers=1, max_size=1, overflow="block")
+    deferred.submit(record.handle, out_of_stock(0))
+    record.started.wait(timeout=5)
+    deferred.submit(record.handle, out_of_stock(1))  # fills the queue
+
+    submitted = threading.Event()
+    thread = threading.Thread(
+        target=lambda: (
+            deferred.submit(record.handle, out_of_stock(2)),
+            submitted.set(),
+        )
+    )
+    thread.start()
+    assert not submitted.wait(timeout=0.1)
+
+    record.go.set()
+    assert submitted.wait(timeout=5)
+    thread.join()
+    deferred.close()
+    assert record.events == [out_of_stock(n) for n in range(3)]
+
+
+def test_drop_oldest_makes_room_for_the_newest():
+    record = Recorder()
+    deferred = DeferredHandlers(workers=1, max_size=2, overflow="drop-oldest")
+    deferred.submit(record.handle, out_of_stock(0))
+    record.started.wait(timeout=5)
+    for n in range(1, 5):
+        deferred.submit(record.handle, out_of_stock(n))
+
+    record.go.set()
+    deferred.close()
+    assert record.events == [out_of_stock(0), out_of_stock(3), out_of_stock(4)]
+    assert deferred.metrics().dropped == 2
+
+
+def test_spill_keeps_everything_in_order():
+    record = Recorder()
+    deferred = DeferredHandlers(workers=1, max_size=2, overflow="spill")
+    deferred.submit(record.handle, out_of_stock(0))
+    record.started.wait(timeout=5)
+    for n in range(1, 10):
+        deferred.submit(record.handle, out_of_stock(n))
+    metrics = deferred.metrics()
+    assert metrics.depth == 9
+    assert metrics.spilled == 7
+
+    record.go.set()
+    deferred.close()
+    assert record.events == [out_of_stock(n) for n in range(10)]
+
+
+def test_reports_how_long_the_oldest_has_waited():
+    record = Recorder()
+    deferred = DeferredHandlers(workers=1, max_size=10)
+    deferred.submit(record.handle, out_of_stock(0))
+    record.started.wait(timeout=5)
+    deferred.submit(record.handle, out_of_stock(1))
+    time.sleep(0.05)
+
+    metrics = deferred.metrics()
+    assert metrics.depth == 1
+    assert metrics.lag >= 0.05
+
+    record.go.set()
+    deferred.close()
+    assert deferred.metrics().lag == 0.0
+
+
+def test_counts_failures_and_carries_on():
+    def fail(event):
+        raise ValueError("no mail today")
+
+    deferred = DeferredHandlers(workers=1)
+    deferred.submit(fail, out_of_stock(0))
+    deferred.submit(fail, out_of_stock(1))
+    deferred.close()
+    assert deferred.metrics().failed == 2
+
+
+def test_refuses_a_different_handler_with_the_same_name():
+    first, second = Recorder(), Recorder()
+    first.go.set()
+    deferred = DeferredHandlers(workers=1)
+    deferred.submit(first.handle, out_of_stock(0))
+    deferred.submit(first.handle, out_of_stock(1))
+
+    with pytest.raises(ValueError, match="Recorder.handle"):
+        deferred.submit(second.handle, out_of_stock(2))
+
+    deferred.close()
+    assert first.events == [out_of_stock(0), out_of_stock(1)]
+
+
+def test_refuses_an_unknown_overflow_policy():
+    with pytest.raises(ValueError, match="overflow must be one of"):
+        DeferredHandlers(overflow="shrug")
@@ -1,6 +1,8 @@
 # pylint: disable=no-self-use
 from __future__ import annotations
 
+import atexit
+import threading
 from collections import defaultdict
 from datetime import date
 from typing import Dict, List
@@ -8,8 +10,8 @@ from typing import Dict, List
 import pytest
 from allocation import bootstrap
 from allocation.adapters import notifications, repository
-from allocation.domain import commands
-from allocation.service_layer import handlers, unit_of_work
+from allocation.domain import commands, events, model
+from allocation.service_layer import handlers, messagebus, unit_of_work
 
 
 class FakeRepository(repository.AbstractRepository):
@@ -20,14 +22,14 @@ class FakeRepository(repository.AbstractRepository):
     def _add(self, product):
         self._products.add(product)
 
-    def _get(self, sku):
+    def _get(self, sku, in_stock_only=False):
         return next((p for p in self._products if p.sku == sku), None)
 
+    def _get_many(self, skus, in_stock_only=False):
+        return [p for p in self._products if p.sku in skus]
+
     def _get_by_batchref(self, batchref):
-        return next(
-            (p for p in self._products for b in p.batches if b.reference == batchref),
-            None,
-        )
+        return next((p for p in self._products if p.get_batch(batchref)), None)
 
 
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
@@ -50,13 +52,43 @@ class FakeNotifications(notifications.AbstractNotifications):
         self.sent[destination].append(message)
 
 
-def bootstrap_test_app():
-    return bootstrap.bootstrap(
+OPEN_BUSES = []  # type: List[messagebus.MessageBus]
+
+
+def bootstrap_test_app(fake_notifs=None):
+    bus = bootstrap.bootstrap(
         start_orm=False,
         uow=FakeUnitOfWork(),
-        notifications=FakeNotifications(),
-        publish=lambda *args: None,
+        notifications=fake_notifs or FakeNotifications(),
     )
+    OPEN_BUSES.append(bus)
+    return bus
+
+
+@pytest.fixture(autouse=True)
+def close_buses():
+    yield
+    while OPEN_BUSES:
+        OPEN_BUSES.pop().close()
+
+
+class TestClosing:
+    def test_bootstrap_closes_the_bus_at_exit(self, monkeypatch):
+        registered = []
+        monkeypatch.setattr(atexit, "register", registered.append)
+        bus = bootstrap_test_app()
+        assert registered == [bus.close]
+
+    def test_close_finishes_deferred_handlers_and_stops_the_threads(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap_test_app(fake_notifs)
+        bus.handle(commands.CreateBatch("b1", "LAST-LAMP", 9, None))
+        bus.handle(commands.Allocate("o1", "LAST-LAMP", 10))
+        bus.close()
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for LAST-LAMP"]
+        assert bus.deferred.closed
+        with pytest.raises(RuntimeError):
+            bus.executor.submit(print)
 
 
 class TestAddBatch:
@@ -96,18 +128,95 @@ class TestAllocate:
 
     def test_sends_email_on_out_of_stock_error(self):
         fake_notifs = FakeNotifications()
-        bus = bootstrap.bootstrap(
-            start_orm=False,
-            uow=FakeUnitOfWork(),
-            notifications=fake_notifs,
-            publish=lambda *args: None,
-        )
+        bus = bootstrap_test_app(fake_notifs)
         bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
         bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+        bus.deferred.join()  # notifications go out in the background
         assert fake_notifs.sent["stock@made.com"] == [
             f"Out of stock for POPULAR-CURTAINS",
         ]
 
+    def test_gives_up_on_a_conflict_after_a_few_attempts(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "CONTESTED-SOFA", 100, None))
+        attempts = []
+
+        def always_conflicts():
+            attempts.append(True)
+            raise unit_of_work.ConcurrencyConflict()
+
+        bus.uow._commit = always_conflicts
+
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            bus.handle(commands.Allocate("o1", "CONTESTED-SOFA", 10))
+        assert len(attempts) == bus.conflict_attempts
+
+
+class TestAllocateMany:
+    def test_allocates_lines_across_skus(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "WOBBLY-SHELF", 100, None))
+        bus.handle(commands.CreateBatch("b2", "FLUFFY-RUG", 100, None))
+        bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "WOBBLY-SHELF", 10),
+                    commands.Allocate("o1", "FLUFFY-RUG", 20),
+                    commands.Allocate("o2", "WOBBLY-SHELF", 30),
+                ]
+            )
+        )
+        [shelf_batch] = bus.uow.products.get("WOBBLY-SHELF").batches
+        [rug_batch] = bus.uow.products.get("FLUFFY-RUG").batches
+        assert shelf_batch.available_quantity == 60
+        assert rug_batch.available_quantity == 80
+        assert bus.uow.committed
+
+    def test_bumps_version_number_once_per_product(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "TIDY-DRAWER", 100, None))
+        bus.handle(
+            commands.AllocateMany(
+                [commands.Allocate(f"o{i}", "TIDY-DRAWER", 1) for i in range(5)]
+            )
+        )
+        assert bus.uow.products.get("TIDY-DRAWER").version_number == 1
+
+    def test_errors_for_invalid_sku_without_allocating_anything(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "AREALSKU", 100, None))
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            bus.handle(
+                commands.AllocateMany(
+                    [
+                        commands.Allocate("o1", "AREALSKU", 10),
+                        commands.Allocate("o1", "NONEXISTENTSKU", 10),
+                    ]
+                )
+            )
+        [batch] = bus.uow.products.get("AREALSKU").batches
+        assert batch.available_quantity == 100
+
+    def test_sends_email_for_each_line_out_of_stock(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap_test_app(fake_notifs)
+        bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "POPULAR-CURTAINS", 5),
+                    commands.Allocate("o2", "POPULAR-CURTAINS", 5),
+                    commands.Allocate("o3", "POPULAR-CURTAINS", 5),
+                ]
+            )
+        )
+        bus.deferred.join()
+        assert fake_notifs.sent["stock@made.com"] == [
+            "Out of stock for POPULAR-CURTAINS",
+            "Out of stock for POPULAR-CURTAINS",
+        ]
+
 
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
@@ -139,3 +248,198 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+
+class TestHandleMany:
+    def test_commits_each_run_of_commands_for_one_sku_once(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "ROUND-TABLE", 100, None))
+        bus.handle(commands.CreateBatch("b2", "SQUARE-TABLE", 100, None))
+        commits = []
+        commit = bus.uow._commit
+
+        def counting_commit():
+            commits.append(True)
+            commit()
+
+        bus.uow._commit = counting_commit
+
+        results = bus.handle_many(
+            [
+                commands.Allocate("o1", "ROUND-TABLE", 10),
+                commands.Allocate("o2", "ROUND-TABLE", 10),
+                commands.Allocate("o3", "SQUARE-TABLE", 10),
+                commands.Allocate("o4", "SQUARE-TABLE", 10),
+                commands.Allocate("o5", "ROUND-TABLE", 10),
+            ]
+        )
+        assert results == [None] * 5
+        assert len(commits) == 3
+        [round_batch] = bus.uow.products.get("ROUND-TABLE").batches
+        assert round_batch.available_quantity == 70
+
+    def test_returns_the_exception_for_each_command_that_failed(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "AREALSKU", 100, None))
+
+        ok1, error, ok2 = bus.handle_many(
+            [
+                commands.Allocate("o1", "AREALSKU", 10),
+                commands.Allocate("o2", "NONEXISTENTSKU", 10),
+                commands.Allocate("o3", "AREALSKU", 10),
+            ]
+        )
+        assert ok1 is None and ok2 is None
+        assert isinstance(error, handlers.InvalidSku)
+        [batch] = bus.uow.products.get("AREALSKU").batches
+        assert batch.available_quantity == 80
+
+    def test_an_error_handling_a_committed_runs_events_fails_only_its_command(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "WOBBLY-TABLE", 100, None))
+        del bus.event_handlers[events.OutOfStock]  # handling one raises KeyError
+        commits = []
+        commit = bus.uow._commit
+
+        def counting_commit():
+            commits.append(True)
+            commit()
+
+        bus.uow._commit = counting_commit
+
+        ok, error = bus.handle_many(
+            [
+                commands.Allocate("o1", "WOBBLY-TABLE", 10),
+                commands.Allocate("o2", "WOBBLY-TABLE", 1_000),
+            ]
+        )
+        assert ok is None
+        assert isinstance(error, KeyError)
+        assert len(commits) == 1  # not handled again one at a time
+        [batch] = bus.uow.products.get("WOBBLY-TABLE").batches
+        assert batch.available_quantity == 90
+
+    def test_sends_email_for_a_run_that_ran_out_of_stock(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap_test_app(fake_notifs)
+        bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        bus.handle_many(
+            [
+                commands.Allocate("o1", "POPULAR-CURTAINS", 5),
+                commands.Allocate("o2", "POPULAR-CURTAINS", 5),
+            ]
+        )
+        bus.deferred.join()
+        assert fake_notifs.sent["stock@made.com"] == [
+            "Out of stock for POPULAR-CURTAINS",
+        ]
+
+    def test_runs_batch_quantity_changes_for_one_sku_together(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "LONG-TABLE", 100, None))
+        bus.handle(commands.CreateBatch("b2", "LONG-TABLE", 100, None))
+        bus.handle(commands.CreateBatch("b3", "SHORT-TABLE", 100, None))
+        commits = []
+        commit = bus.uow._commit
+
+        def counting_commit():
+            commits.append(True)
+            commit()
+
+        bus.uow._commit = counting_commit
+
+        results = bus.handle_many(
+            [
+                commands.ChangeBatchQuantity("b1", 50),
+                commands.ChangeBatchQuantity("b2", 60),
+                commands.Allocate("o1", "LONG-TABLE", 10),
+                commands.ChangeBatchQuantity("b3", 70),
+            ]
+        )
+        assert results == [None] * 4
+        assert len(commits) == 2
+        batches = bus.uow.products.get("LONG-TABLE").batches
+        assert sorted(b.available_quantity for b in batches) == [40, 60]
+
+    def test_splits_messages_into_runs_of_one_sku(self):
+        a1, a2, a3 = (commands.Allocate(f"o{i}", "A", 1) for i in range(3))
+        b1 = commands.Allocate("o4", "B", 1)
+        change = commands.ChangeBatchQuantity("batch-a", 10)
+        event = events.OutOfStock("A")
+
+        runs = messagebus.runs_by_sku([a1, a2, a3, b1, change, event, a1], 2)
+        assert list(runs) == [[a1, a2], [a3], [b1], [change], [event], [a1]]
+
+        runs = messagebus.runs_by_sku([a1, change, b1, change], 10, {"batch-a": "A"})
+        assert list(runs) == [[a1, change], [b1], [change]]
+
+
+class TestIndependentHandlers:
+    def test_run_at_the_same_time_and_finish_before_handle_returns(self):
+        both_started = threading.Barrier(2, timeout=1)
+        done = []
+
+        @handlers.independent
+        def wait_for_the_other(event):
+            both_started.wait()  # breaks unless both are running at once
+            done.append(event)
+
+        bus = messagebus.MessageBus(
+            uow=FakeUnitOfWork(),
+            event_handlers={events.OutOfStock: [wait_for_the_other] * 2},
+            command_handlers={},
+            handler_threads=2,
+        )
+        bus.handle(events.OutOfStock("HEAVY-DOOR"))
+        assert done == [events.OutOfStock("HEAVY-DOOR")] * 2
+
+    def test_run_on_the_calling_thread_without_handler_threads(self):
+        threads = []
+
+        @handlers.independent
+        def note_thread(event):
+            threads.append(threading.current_thread())
+
+        bus = messagebus.MessageBus(
+            uow=FakeUnitOfWork(),
+            event_handlers={events.OutOfStock: [note_thread]},
+            command_handlers={},
+            handler_threads=0,
+        )
+        bus.handle(events.OutOfStock("LIGHT-DOOR"))
+        assert threads == [threading.current_thread()]
+
+    def test_errors_are_logged_not_raised(self, caplog):
+        @handlers.independent
+        def fail(event):
+            raise ValueError("no mail today")
+
+        bus = messagebus.MessageBus(
+            uow=FakeUnitOfWork(),
+            event_handlers={events.OutOfStock: [fail]},
+            command_handlers={},
+        )
+        bus.handle(events.OutOfStock("RUSTY-GATE"))
+        assert "no mail today" in caplog.text
+
+
+class TestCollectingEvents:
+    def test_events_come_out_in_the_order_products_raised_them(self):
+        uow = FakeUnitOfWork()
+        sofa = model.Product("SOFA", [model.Batch("b1", "SOFA", 10, None)])
+        lamp = model.Product("LAMP", [])
+        sofa.events.append(events.OutOfStock("SOFA"))  # raised before it was seen
+        uow.products.add(sofa)
+        uow.products.add(lamp)
+
+        lamp.allocate(model.OrderLine("o1", "LAMP", 1))
+        sofa.allocate(model.OrderLine("o2", "SOFA", 1))
+        lamp.allocate(model.OrderLine("o3", "LAMP", 1))
+
+        assert [type(e).__name__ for e in uow.collect_new_events()] == [
+            "OutOfStock",
+            "OutOfStock",
+            "Allocated",
+            "OutOfStock",
+        ]
+        assert list(uow.collect_new_events()) == []
@@ -0,0 +1,58 @@
+import pytest
+from allocation.adapters import metrics
+from allocation.domain import events
+from allocation.service_layer import messagebus
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = metrics.Registry()
+    histogram = metrics.Histogram(
+        "handler_seconds",
+        "Handler time.",
+        ["handler"],
+        buckets=[0.1, 1],
+        registry=registry,
+    )
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(("allocate",), value)
+
+    assert registry.render().splitlines() == [
+        "# HELP handler_seconds Handler time.",
+        "# TYPE handler_seconds histogram",
+        'handler_seconds_bucket{handler="allocate",le="0.1"} 2',
+        'handler_seconds_bucket{handler="allocate",le="1"} 3',
+        'handler_seconds_bucket{handler="allocate",le="+Inf"} 4',
+        'handler_seconds_sum{handler="allocate"} 2.65',
+        'handler_seconds_count{handler="allocate"} 4',
+    ]
+
+
+def test_counters_and_gauges_render_one_line_per_labels():
+    registry = metrics.Registry()
+    counter = metrics.Counter("errors_total", "Errors.", ["kind"], registry=registry)
+    gauge = metrics.Gauge("queue_length", "Waiting.", ["queue"], registry=registry)
+    counter.inc(("bad",))
+    counter.inc(("bad",))
+    counter.inc(('say "hi"',))
+    gauge.set(3, ("a",))
+    gauge.set_function(lambda: 7, ("b",))
+
+    lines = registry.render().splitlines()
+    assert 'errors_total{kind="bad"} 2' in lines
+    assert 'errors_total{kind="say \\"hi\\""} 1' in lines
+    assert 'queue_length{queue="a"} 3' in lines
+    assert 'queue_length{queue="b"} 7' in lines
+
+
+def test_timed_records_latency_and_exceptions_per_handler():
+    def flaky_handler(event):
+        raise ValueError("no")
+
+    labels = ("OutOfStock", "flaky_handler")
+    before = messagebus.HANDLER_SECONDS.count(labels)
+
+    with pytest.raises(ValueError):
+        messagebus.timed(flaky_handler, events.OutOfStock("sku"))
+
+    assert messagebus.HANDLER_SECONDS.count(labels) == before + 1
+    assert messagebus.HANDLER_EXCEPTIONS.value(labels + ("ValueError",)) >= 1
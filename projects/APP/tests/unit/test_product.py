@@ -1,6 +1,6 @@
 from datetime import date, timedelta
 
-from allocation.domain import events
+from allocation.domain import events, model
 from allocation.domain.model import Batch, OrderLine, Product
 
 today = date.today()
@@ -72,3 +72,154 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_skips_batches_that_are_used_up():
+    used_up = Batch("used-up-batch", "SHINY-KETTLE", 10, eta=None)
+    shipment = Batch("shipment-batch", "SHINY-KETTLE", 100, eta=tomorrow)
+    product = Product(sku="SHINY-KETTLE", batches=[used_up, shipment])
+    product.allocate(OrderLine("order1", "SHINY-KETTLE", 10))
+
+    allocation = product.allocate(OrderLine("order2", "SHINY-KETTLE", 10))
+
+    assert allocation == shipment.reference
+    assert used_up.available_quantity == 0
+
+
+def test_batches_added_later_are_allocated_in_eta_order():
+    later_batch = Batch("later-batch", "DAINTY-STOOL", 100, eta=later)
+    product = Product(sku="DAINTY-STOOL", batches=[later_batch])
+    product.allocate(OrderLine("order1", "DAINTY-STOOL", 10))
+
+    in_stock_batch = Batch("in-stock-batch", "DAINTY-STOOL", 100, eta=None)
+    product.add_batch(in_stock_batch)
+    product.batches.append(Batch("speedy-batch", "DAINTY-STOOL", 100, eta=today))
+
+    assert product.allocate(OrderLine("order2", "DAINTY-STOOL", 10)) == "in-stock-batch"
+    product.change_batch_quantity("in-stock-batch", 10)
+    assert product.allocate(OrderLine("order3", "DAINTY-STOOL", 10)) == "speedy-batch"
+
+
+def test_batch_topped_up_after_running_out_is_preferred_again():
+    in_stock_batch = Batch("in-stock-batch", "BULKY-SOFA", 10, eta=None)
+    shipment_batch = Batch("shipment-batch", "BULKY-SOFA", 100, eta=tomorrow)
+    product = Product(sku="BULKY-SOFA", batches=[in_stock_batch, shipment_batch])
+    product.allocate(OrderLine("order1", "BULKY-SOFA", 10))
+
+    product.change_batch_quantity("in-stock-batch", 20)
+
+    assert product.allocate(OrderLine("order2", "BULKY-SOFA", 5)) == "in-stock-batch"
+
+
+def test_allocate_many_increments_version_number_once():
+    product = Product(
+        sku="SCANDI-PEN", batches=[Batch("b1", "SCANDI-PEN", 100, eta=None)]
+    )
+    product.version_number = 7
+    batchrefs = product.allocate_many(
+        [OrderLine("o1", "SCANDI-PEN", 10), OrderLine("o2", "SCANDI-PEN", 200)]
+    )
+    assert batchrefs == ["b1", None]
+    assert product.version_number == 8
+
+
+def test_finds_batches_by_reference():
+    first = Batch("first-batch", "PLAIN-MUG", 100, eta=None)
+    product = Product(sku="PLAIN-MUG", batches=[first])
+    assert product.get_batch("first-batch") is first
+
+    second = Batch("second-batch", "PLAIN-MUG", 100, eta=None)
+    product.add_batch(second)
+    third = Batch("third-batch", "PLAIN-MUG", 100, eta=None)
+    product.batches.append(third)
+
+    assert product.get_batch("second-batch") is second
+    assert product.get_batch("third-batch") is third
+    assert product.get_batch("no-such-batch") is None
+
+
+def make_product_with_lines(sku, batch_qty, line_qtys):
+    batch = Batch("batch1", sku, batch_qty, eta=None)
+    product = Product(sku=sku, batches=[batch])
+    for i, qty in enumerate(line_qtys):
+        product.allocate(OrderLine(f"order{i}", sku, qty))
+    return product, batch
+
+
+def deallocations(product):
+    return [e for e in product.events if isinstance(e, events.Deallocated)]
+
+
+def test_shrinking_a_batch_evicts_as_few_lines_as_possible():
+    product, batch = make_product_with_lines("CHEAP-BENCH", 30, [2, 2, 2, 2, 10])
+
+    product.change_batch_quantity("batch1", 15)
+
+    assert deallocations(product) == [events.Deallocated("order4", "CHEAP-BENCH", 10)]
+    assert batch.available_quantity == 7
+
+
+def test_eviction_policy_can_be_swapped():
+    product, batch = make_product_with_lines("CHEAP-BENCH", 30, [3, 4, 10])
+
+    product.change_batch_quantity("batch1", 13, evict=model.evict_closest_fit)
+
+    assert deallocations(product) == [events.Deallocated("order1", "CHEAP-BENCH", 4)]
+    assert batch.available_quantity == 0
+
+
+def test_eviction_policy_may_yield_lines_lazily():
+    product, batch = make_product_with_lines("CHEAP-BENCH", 30, [3, 4, 10])
+
+    def evict_lazily(allocations, shortfall):
+        for line in allocations:  # straight off the set, no copy
+            if shortfall <= 0:
+                return
+            shortfall -= line.qty
+            yield line
+
+    product.change_batch_quantity("batch1", 1, evict=evict_lazily)
+
+    assert len(deallocations(product)) == 3
+    assert batch.available_quantity == 1
+
+
+def test_evicted_lines_are_reallocated_straight_away():
+    batch1 = Batch("batch1", "COMFY-CHAIR", 50, eta=None)
+    batch2 = Batch("batch2", "COMFY-CHAIR", 50, eta=tomorrow)
+    product = Product(sku="COMFY-CHAIR", batches=[batch1, batch2])
+    product.allocate(OrderLine("order1", "COMFY-CHAIR", 20))
+    product.allocate(OrderLine("order2", "COMFY-CHAIR", 20))
+    version = product.version_number
+
+    product.change_batch_quantity("batch1", 25)
+
+    [deallocated] = deallocations(product)
+    assert product.events[-1] == events.Allocated(
+        orderid=deallocated.orderid, sku="COMFY-CHAIR", qty=20, batchref="batch2"
+    )
+    assert batch1.available_quantity == 5
+    assert batch2.available_quantity == 30
+    assert product.version_number == version + 1
+
+
+def test_evicted_lines_that_fit_nowhere_are_out_of_stock():
+    product, batch = make_product_with_lines("CHEAP-BENCH", 30, [10, 20])
+
+    product.change_batch_quantity("batch1", 15)
+
+    assert deallocations(product) == [events.Deallocated("order1", "CHEAP-BENCH", 20)]
+    assert product.events[-1] == events.OutOfStock(sku="CHEAP-BENCH")
+
+
+def test_eviction_policies_cover_the_shortfall():
+    lines = {
+        OrderLine(f"order{i}", "CHEAP-BENCH", qty)
+        for i, qty in enumerate([1, 5, 7, 2, 9])
+    }
+    for evict in [model.evict_any, model.evict_fewest_lines, model.evict_closest_fit]:
+        evicted = evict(lines, 12)
+        assert sum(line.qty for line in evicted) >= 12
+        assert set(evicted) <= lines
+    assert [l.qty for l in model.evict_fewest_lines(lines, 12)] == [9, 7]
+    assert [l.qty for l in model.evict_closest_fit(lines, 12)] == [9, 5]
@@ -0,0 +1,48 @@
+import json
+from unittest import mock
+
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+
+
+def message(data):
+    return {"channel": "change_batch_quantity", "data": data}
+
+
+def test_a_malformed_message_is_skipped_not_the_batch(caplog):
+    bus = mock.Mock()
+    bus.handle_many.return_value = [None, None]
+
+    redis_eventconsumer.handle_change_batch_quantities(
+        [
+            message(json.dumps({"batchref": "b1", "qty": 10})),
+            message("{not json"),
+            message(json.dumps({"batchref": "b2"})),
+            message(json.dumps({"batchref": "b3", "qty": 30})),
+        ],
+        bus,
+    )
+
+    bus.handle_many.assert_called_once_with(
+        [
+            commands.ChangeBatchQuantity("b1", 10),
+            commands.ChangeBatchQuantity("b3", 30),
+        ]
+    )
+    assert caplog.text.count("skipping malformed message") == 2
+
+
+def test_logs_the_commands_that_failed(caplog):
+    bus = mock.Mock()
+    bus.handle_many.return_value = [None, ValueError("no such batch")]
+
+    redis_eventconsumer.handle_change_batch_quantities(
+        [
+            message(json.dumps({"batchref": "b1", "qty": 10})),
+            message(json.dumps({"batchref": "b2", "qty": 20})),
+        ],
+        bus,
+    )
+
+    [failure] = [r.getMessage() for r in caplog.records if r.levelname == "ERROR"]
+    assert '"b2"' in failure and "no such batch" in failure